@@ -1,13 +1,15 @@
 from fastapi import APIRouter, HTTPException, Query
 from fastapi.responses import RedirectResponse
+import logging
 import secrets
 import os
 from ..services.strava import exchange_code_for_token, fetch_strava_user
+from ..services.sessions import user_sessions, athlete_session_key, PENDING_SESSION_TTL
+from ..services.tokens import token_vault
 
-router = APIRouter()
+logger = logging.getLogger(__name__)
 
-# In-memory storage for demo (use proper database in production)
-user_sessions = {}
+router = APIRouter()
 
 def get_strava_redirect_uri():
     """Get Strava redirect URI - use localhost for local development"""
@@ -22,8 +24,7 @@ def get_strava_redirect_uri():
 async def strava_auth():
     """Initiate Strava OAuth flow"""
     state = secrets.token_urlsafe(32)
-    user_sessions[state] = {"authenticated": False}
-    print(f"🔍 DEBUG: Auth initiated - state: {state[:10]}..., sessions count: {len(user_sessions)}")
+    user_sessions.set(state, {"authenticated": False}, ttl=PENDING_SESSION_TTL)
     
     auth_url = (
         f"https://www.strava.com/oauth/authorize?"
@@ -39,13 +40,8 @@ async def strava_auth():
 @router.get("/auth/callback")
 async def strava_callback(code: str = Query(...), state: str = Query(...)):
     """Handle Strava OAuth callback"""
-    print(f"🔍 DEBUG: Auth callback - state: {state[:10]}..., code: {code[:10]}...")
-    print(f"🔍 DEBUG: User sessions count: {len(user_sessions)}")
-    print(f"🔍 DEBUG: State in sessions: {state in user_sessions}")
-    
     if state not in user_sessions:
-        print(f"DEBUG: Invalid state - not found in sessions")
-        print(f"DEBUG: Available states: {list(user_sessions.keys())}")
+        logger.info("OAuth callback with an unknown or expired state")
         raise HTTPException(status_code=400, detail="Invalid state")
     
     try:
@@ -56,19 +52,22 @@ async def strava_callback(code: str = Query(...), state: str = Query(...)):
         # Fetch user profile
         user_data = await fetch_strava_user(access_token)
         
-        # Store user session
-        user_sessions[state] = {
-            "authenticated": True,
-            "access_token": access_token,
-            "athlete": user_data
-        }
+        # Store user session, and index it by athlete so webhook events can find it
+        session = {"authenticated": True, "athlete": user_data}
+        if "id" in user_data:
+            # Tokens are kept encrypted and refreshed server-side instead of in the session
+            token_vault.save(user_data["id"], token_data)
+            user_sessions[athlete_session_key(user_data["id"])] = session
+        else:
+            session["access_token"] = access_token
+        user_sessions[state] = session
         
         # Redirect to frontend with success and access token
         frontend_url = os.getenv("FRONTEND_URL", "https://frontend-beta-sandy-87.vercel.app")
         return RedirectResponse(url=f"{frontend_url}?auth_success=true&state={state}&access_token={access_token}")
         
     except Exception as e:
-        print(f"OAuth error: {e}")
+        logger.warning("OAuth error: %s", e)
         raise HTTPException(status_code=400, detail="OAuth failed")
 
 @router.get("/oauth/authorize")
@@ -1,50 +1,448 @@
-from fastapi import APIRouter, HTTPException, Query
-from ..api.auth import user_sessions
-from ..services.strava import fetch_user_activities
-from ..services.analysis import calculate_weekly_volume, calculate_monthly_volume
-from ..services.rag import generate_training_recommendations
+import asyncio
+import json
+import logging
+import time
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+from fastapi import APIRouter, Header, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from ..services.sessions import user_sessions
+from ..services.tokens import session_access_token, TokenRefreshError
+from ..services.strava import (
+    sync_user_activities, sync_athletes, iter_user_activity_pages, get_sync_interval, sync_activity_streams,
+    get_stream_fetch_limit, filling_streams, fill_activity_streams, token_athlete_key, StravaAPIError,
+    TOKEN_ATHLETE_PREFIX
+)
+from ..services.activity_store import activity_store
+from ..services.ratelimit import StravaRateLimitError
+from ..services.analysis import calculate_training_volume, group_training_volume
+from ..services.executor import cpu_executor
+from ..services.pipeline import SPORTS, Pipeline, VolumeAggregator, RecentAggregator, PaceAggregator
+from ..services.planner import build_training_plan, history_start, threshold_speed
+from ..services.streams import stream_store, analyze_activity_streams, zone_summary
+from ..services.rag import (
+    enrich_plan, enrich_training_plan, get_cached_training_recommendations, plan_enrichment_enabled
+)
+from ..services.jobs import Job, plan_jobs, stream_jobs, DONE
+from ..services.timeseries import MAX_RANGE_DAYS, epoch_day_of, load_payload, load_series
+from ..models.training import BatchVolumeRequest
+from ..utils.cache import TTLCache, make_etag, conditional_json_response
+from ..utils.metrics import span
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-@router.get("/training/volume")
-async def get_training_volume(state: str = Query(...), access_token: str = Query(None)):
-    """Get user's training volume analysis (weekly and monthly)"""
-    print(f"🔍 DEBUG: Training volume request - state: {state[:10]}..., access_token: {'present' if access_token else 'missing'}")
-    print(f"🔍 DEBUG: User sessions count: {len(user_sessions)}")
-    print(f"🔍 DEBUG: State in sessions: {state in user_sessions}")
-    
-    # Check authentication - either from session or direct token
-    if access_token:
+SPORT_PATTERN = f"^({'|'.join(SPORTS)})$"
+DATE_PATTERN = r"^\d{4}-\d{2}-\d{2}$"
+
+# Default /training/load range, ending today
+LOAD_RANGE_DAYS = 90
+
+# Most activities one /training/zones request analyzes, their streams fetched at most
+# get_stream_fetch_limit() per request
+MAX_ZONE_ACTIVITIES = 100
+
+# Last /training/volume payload per (athlete, sport), tagged with the data version it was built from
+volume_cache = TTLCache(max_size=1000, ttl=60 * 60, name="volume")
+
+async def enumerate_async(iterator: AsyncIterator[Any], start: int = 1) -> AsyncIterator[Tuple[int, Any]]:
+    """enumerate() for async iterators"""
+    index = start
+    async for item in iterator:
+        yield index, item
+        index += 1
+
+def plan_job_pointer(job: Job) -> Dict[str, Any]:
+    """Where the client can poll or stream a pending training plan"""
+    return {
+        "id": job.id,
+        "status": job.status,
+        "url": f"/training/plan/{job.id}",
+        "events_url": f"/training/plan/{job.id}/events"
+    }
+
+def plan_job_result(job: Job) -> Dict[str, Any]:
+    """Calendar payload of a finished plan job"""
+    if job.status == DONE:
+        return job.result
+    return {"error": "AI service temporarily unavailable", "message": job.error}
+
+def attach_finished_plan(cache_key: Tuple[str, str], cached: Dict[str, Any]) -> Dict[str, Any]:
+    """Swap in the enriched calendar once a cached payload's background plan job has finished"""
+    payload = cached["payload"]
+    pointer = payload.get("calendar_job") or {}
+    job = plan_jobs.get(pointer.get("id"))
+    if job is None or not job.finished or pointer.get("status") == job.status:
+        return cached
+    
+    # A failed enrichment keeps the local plan
+    calendar = job.result if job.status == DONE else payload["calendar"]
+    payload = {**payload, "calendar": calendar, "calendar_job": plan_job_pointer(job)}
+    cached = {**cached, "payload": payload, "etag": make_etag(payload)}
+    volume_cache.set(cache_key, cached)
+    return cached
+
+def volume_pipeline(sport: str) -> Pipeline:
+    """Weekly and monthly volume of one sport, as shown on the dashboard"""
+    return Pipeline(types=[sport]).aggregate(
+        weekly_volume=VolumeAggregator("week", "week_start", limit=8),
+        monthly_volume=VolumeAggregator("month", "month", limit=6),
+    )
+
+async def authenticate(state: str, access_token: Optional[str]) -> Tuple[str, str]:
+    """Resolve the Strava token and activity-store key for a request"""
+    session = user_sessions.get(state)
+    
+    # Check authentication - the session's (refreshed) token first, then a direct token
+    token = None
+    if session and session["authenticated"]:
+        try:
+            token = await session_access_token(session)
+        except TokenRefreshError as e:
+            logger.info("Token refresh failed: %s", e)
+            raise HTTPException(status_code=401, detail="Strava authorization expired")
+    if not token and access_token:
         # Direct token provided (from URL parameter)
-        print(f"DEBUG: Using direct access token")
         token = access_token
-    elif state in user_sessions and user_sessions[state]["authenticated"]:
-        # Session-based authentication
-        print(f"DEBUG: Using session-based token")
-        token = user_sessions[state]["access_token"]
-    else:
-        print(f"DEBUG: Authentication failed - no token or invalid state")
-        print(f"DEBUG: Available states: {list(user_sessions.keys())}")
+    if not token:
+        logger.debug("Training request not authenticated, session found: %s", session is not None)
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    # Fetch activities from Strava
-    activities = await fetch_user_activities(token)
-    running_activities = [act for act in activities if act.get("type") == "Run"]
+    # Key the stores by athlete when we know who it is, otherwise by a digest of the token
+    athlete = session.get("athlete") if session else None
+    athlete_key = str(athlete["id"]) if athlete and "id" in athlete else token_athlete_key(token)
+    return token, athlete_key
+
+async def build_volume_payload(athlete_key: str, sport: str = "Run") -> Dict[str, Any]:
+    """Volume response for the athlete's current data version, cached until it changes
+
+    Everything is read from the activity store's rollups and indexed queries, so the
+    athlete's full history is never loaded into memory.
+    """
+    # Serve the previous payload while the athlete's data has not changed
+    cache_key = (athlete_key, sport)
+    version = activity_store.version(athlete_key)
+    cached = volume_cache.get(cache_key)
+    if cached and cached["version"] == version:
+        return attach_finished_plan(cache_key, cached)
     
-    # Calculate training volume by week and month
-    weekly_volume = calculate_weekly_volume(running_activities)
-    monthly_volume = calculate_monthly_volume(running_activities)
+    with span("analyze"):
+        # Rebuilding rollups walks the athlete's whole history, keep large ones off the event loop
+        size = 0 if activity_store.rollups_current(athlete_key) else activity_store.count(athlete_key)
+        rollups = await cpu_executor.run_local(activity_store.ensure_rollups, athlete_key, size=size)
+        
+        # Calculate training volume by week and month from the athlete's rollups, held here
+        # so an eviction from the rollup store cannot take them away mid-request
+        weekly_volume, monthly_volume = calculate_training_volume(None, sport=sport, rollups=rollups)
+        
+        # The plan and pace stats only look at the last 2 weeks, read in one pass filtered by the index
+        total_activities = activity_store.count(athlete_key, types=[sport])
+        recent = Pipeline(types=[sport]).aggregate(
+            activities=RecentAggregator(14), pace=PaceAggregator()
+        ).run_store(activity_store, athlete_key, limit=14)
+        recent_activities = recent["activities"]
     
-    # Generate personalized training calendar using RAG
-    try:
-        calendar = await generate_training_recommendations(running_activities)
-    except Exception as e:
-        print(f"⚠️ DEBUG: AI calendar generation failed: {e}")
-        calendar = {"error": "AI service temporarily unavailable", "message": str(e)}
+    with span("plan"):
+        # The local planner answers in milliseconds, the model can only add to its plan in the background
+        history = activity_store.query_columns(athlete_key, start=history_start(), types=[sport])
+        if total_activities:
+            # Fitness and fatigue as the load series reports them, over the athlete's whole history
+            series = await cpu_executor.run_local(load_series.get, athlete_key, sport, size=total_activities)
+            calendar = build_training_plan(history, sport, load=series.training_load())
+        else:
+            calendar = {"error": "No training data available"}
+        calendar_job = None
+        if total_activities and plan_enrichment_enabled():
+            recommendations = get_cached_training_recommendations(recent_activities, total_activities, sport,
+                                                                  athlete_key)
+            if recommendations is not None:
+                calendar = enrich_plan(calendar, recommendations)
+            else:
+                plan = calendar
+                job = plan_jobs.submit(
+                    lambda: enrich_training_plan(plan, recent_activities, total_activities, sport, athlete_key),
+                    key=(athlete_key, sport, version)
+                )
+                calendar_job = plan_job_pointer(job)
     
-    return {
-        "total_activities": len(running_activities),
+    payload = {
+        "sport": sport,
+        "total_activities": total_activities,
         "weekly_volume": weekly_volume,
         "monthly_volume": monthly_volume,
-        "calendar": calendar
+        "recent_pace": recent["pace"],
+        "calendar": calendar,
+        "calendar_job": calendar_job
+    }
+    cached = {"version": version, "etag": make_etag(payload), "payload": payload}
+    volume_cache.set(cache_key, cached)
+    return cached
+
+@router.get("/training/volume")
+async def get_training_volume(state: str = Query(...), access_token: str = Query(None),
+                              sport: str = Query("Run", pattern=SPORT_PATTERN),
+                              if_none_match: str = Header(None)):
+    """Get user's training volume analysis (weekly and monthly) for one sport"""
+    token, athlete_key = await authenticate(state, access_token)
+    
+    # Fetch only new activities from Strava
+    try:
+        with span("fetch"):
+            await sync_user_activities(token, athlete_key, max_age=get_sync_interval())
+    except StravaRateLimitError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except StravaAPIError as e:
+        raise HTTPException(status_code=401 if e.status_code == 401 else 502, detail=str(e))
+    
+    cached = await build_volume_payload(athlete_key, sport)
+    return conditional_json_response(cached["payload"], cached["etag"], if_none_match)
+
+@router.get("/training/load")
+async def get_training_load(state: str = Query(...), access_token: str = Query(None),
+                            sport: str = Query("Run", pattern=SPORT_PATTERN),
+                            start: str = Query(None, pattern=DATE_PATTERN),
+                            end: str = Query(None, pattern=DATE_PATTERN),
+                            resolution: str = Query("day", pattern="^(day|week)$"),
+                            if_none_match: str = Header(None)):
+    """Daily or weekly training load, fitness and fatigue, volume and pace trends, and personal bests"""
+    token, athlete_key = await authenticate(state, access_token)
+    
+    try:
+        with span("fetch"):
+            await sync_user_activities(token, athlete_key, max_age=get_sync_interval())
+    except StravaRateLimitError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except StravaAPIError as e:
+        raise HTTPException(status_code=401 if e.status_code == 401 else 502, detail=str(e))
+    
+    try:
+        start_day = epoch_day_of(start) if start else None
+        end_day = epoch_day_of(end) if end else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid date: {e}")
+    
+    with span("analyze"):
+        series = await cpu_executor.run_local(load_series.get, athlete_key, sport,
+                                              size=activity_store.count(athlete_key, types=[sport]))
+    end_day = series.last_day if end_day is None else end_day
+    start_day = end_day - LOAD_RANGE_DAYS + 1 if start_day is None else start_day
+    if end_day < start_day:
+        raise HTTPException(status_code=400, detail="end must not be before start")
+    if end_day - start_day + 1 > MAX_RANGE_DAYS:
+        raise HTTPException(status_code=400, detail=f"Range is limited to {MAX_RANGE_DAYS} days")
+    
+    payload = load_payload(series, sport, start_day, end_day, resolution)
+    return conditional_json_response(payload, make_etag(payload), if_none_match)
+
+def athlete_threshold(athlete_key: str, sport: str) -> float:
+    """Threshold speed from the athlete's recent sessions of the sport, as the planner estimates it"""
+    columns = activity_store.query_columns(athlete_key, start=history_start(), types=[sport])
+    return threshold_speed(columns.distance, columns.moving_time, sport)
+
+@router.get("/training/activities/{activity_id}/analysis")
+async def get_activity_analysis(activity_id: int, state: str = Query(...), access_token: str = Query(None),
+                                split: float = Query(1000.0, ge=100, le=10000),
+                                max_hr: float = Query(None, ge=100, le=230),
+                                if_none_match: str = Header(None)):
+    """Splits and time in heart rate and pace zones of one activity, from its Strava streams"""
+    token, athlete_key = await authenticate(state, access_token)
+    
+    try:
+        with span("fetch"):
+            await sync_user_activities(token, athlete_key, max_age=get_sync_interval())
+            activity = activity_store.get_activity(athlete_key, activity_id)
+            if activity is None:
+                raise HTTPException(status_code=404, detail="Activity not found")
+            errors = await sync_activity_streams(token, athlete_key, [activity_id])
+    except StravaRateLimitError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except StravaAPIError as e:
+        raise HTTPException(status_code=401 if e.status_code == 401 else 502, detail=str(e))
+    if isinstance(errors.get(activity_id), StravaRateLimitError):
+        raise HTTPException(status_code=429, detail=str(errors[activity_id]))
+    if activity_id in errors:
+        raise HTTPException(status_code=502, detail="Strava stream fetch failed")
+    
+    with span("analyze"):
+        streams = stream_store.get(athlete_key, activity_id)
+        if not streams:
+            raise HTTPException(status_code=404, detail="Activity has no streams")
+        analysis = analyze_activity_streams(streams, activity.type, athlete_threshold(athlete_key, activity.type),
+                                            max_hr, split)
+    
+    payload = {"id": activity.id, "name": activity.name, "sport": activity.type,
+               "start_date": activity.start_date, **analysis}
+    return conditional_json_response(payload, make_etag(payload), if_none_match)
+
+@router.get("/training/zones")
+async def get_training_zones(state: str = Query(...), access_token: str = Query(None),
+                             sport: str = Query("Run", pattern=SPORT_PATTERN),
+                             days: int = Query(28, ge=1, le=90),
+                             max_hr: float = Query(None, ge=100, le=230),
+                             if_none_match: str = Header(None)):
+    """Time in heart rate and pace zones over the last days, from the streams of each activity
+
+    Streams missing from the cache are fetched concurrently for the newest activities,
+    up to the per-request fetch limit. Older ones are fetched in the background and
+    counted as pending, activities whose fetch failed are left out and counted as missing.
+    """
+    token, athlete_key = await authenticate(state, access_token)
+    
+    try:
+        with span("fetch"):
+            await sync_user_activities(token, athlete_key, max_age=get_sync_interval())
+            activities = activity_store.query(athlete_key, start=int(time.time()) - days * 24 * 60 * 60,
+                                              types=[sport], limit=MAX_ZONE_ACTIVITIES)
+            activity_ids = [activity.id for activity in activities]
+            # Newest first, one request must not spend the athlete's whole rate-limit window,
+            # and streams a background fill already took on are not fetched twice
+            filling = filling_streams(athlete_key)
+            missing = [activity_id for activity_id in stream_store.missing(athlete_key, activity_ids)
+                       if activity_id not in filling]
+            fetch_limit = get_stream_fetch_limit()
+            errors = await sync_activity_streams(token, athlete_key, missing[:fetch_limit])
+    except StravaRateLimitError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except StravaAPIError as e:
+        raise HTTPException(status_code=401 if e.status_code == 401 else 502, detail=str(e))
+    if missing[fetch_limit:]:
+        fill = fill_activity_streams(token, athlete_key, missing[fetch_limit:])
+        stream_jobs.submit(lambda: fill)
+    pending = stream_store.missing(athlete_key, filling.union(missing[fetch_limit:]).intersection(activity_ids))
+    
+    with span("analyze"):
+        skipped = set(errors).union(pending)
+        streams = [stream_store.get(athlete_key, activity_id) for activity_id in activity_ids
+                   if activity_id not in skipped]
+        streams = [activity_streams for activity_streams in streams if activity_streams]
+        summary = zone_summary(streams, athlete_threshold(athlete_key, sport), max_hr)
+    
+    payload = {"sport": sport, "days": days, "activities": len(activity_ids), "analyzed": len(streams),
+               "missing": len(errors), "pending": len(pending), **summary}
+    return conditional_json_response(payload, make_etag(payload), if_none_match)
+
+@router.post("/training/batch")
+async def get_batch_training_volume(request: BatchVolumeRequest):
+    """Weekly and monthly volume for many athletes at once, plus group rollups, e.g. for a coach's club view"""
+    athletes: Dict[str, Dict[str, Any]] = {}
+    tokens: Dict[str, str] = {}
+    keys_by_state: Dict[str, str] = {}
+    for state in dict.fromkeys(request.states):
+        try:
+            token, athlete_key = await authenticate(state, None)
+        except HTTPException as e:
+            athletes[state] = {"error": e.detail}
+            continue
+        tokens[athlete_key] = token
+        keys_by_state[state] = athlete_key
+    
+    # All syncs draw from the one Strava rate-limit budget, failures fall back to stored data
+    errors = await sync_athletes(tokens, max_age=get_sync_interval())
+    
+    # One pass over every athlete's activities of the sport, on the CPU executor for large clubs
+    columns = {key: activity_store.query_columns(key, types=[request.sport]) for key in tokens}
+    total_activities = sum(len(athlete_columns.start) for athlete_columns in columns.values())
+    volumes = await cpu_executor.run(group_training_volume, columns, size=total_activities)
+    
+    for state, athlete_key in keys_by_state.items():
+        athletes[state] = {
+            "athlete_id": None if athlete_key.startswith(TOKEN_ATHLETE_PREFIX) else athlete_key,
+            "total_activities": len(columns[athlete_key].start),
+            "weekly_volume": volumes["weekly"][athlete_key],
+            "monthly_volume": volumes["monthly"][athlete_key],
+        }
+        if athlete_key in errors:
+            athletes[state]["error"] = errors[athlete_key]
+    
+    return {
+        "sport": request.sport,
+        "athletes": athletes,
+        "group": {
+            "athletes": len(columns),
+            "total_activities": total_activities,
+            "weekly_volume": volumes["group_weekly"],
+            "monthly_volume": volumes["group_monthly"],
+        }
     }
+
+def format_stream_event(event: Dict[str, Any], stream_format: str) -> str:
+    """Encode one streamed update as an NDJSON line or a Server-Sent Event"""
+    if stream_format == "sse":
+        return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+    return json.dumps(event) + "\n"
+
+@router.get("/training/volume/stream")
+async def stream_training_volume(state: str = Query(...), access_token: str = Query(None),
+                                 sport: str = Query("Run", pattern=SPORT_PATTERN),
+                                 stream_format: str = Query("ndjson", alias="format", pattern="^(ndjson|sse)$")):
+    """Stream partial weekly/monthly volume as each page of activities arrives, then the full payload"""
+    token, athlete_key = await authenticate(state, access_token)
+    
+    async def updates():
+        if not activity_store.is_fresh(athlete_key, get_sync_interval()):
+            # Stored activities are aggregated once, each page then only adds its own
+            pipeline = volume_pipeline(sport)
+            await cpu_executor.run_local(pipeline.run_store, activity_store, athlete_key,
+                                         size=activity_store.count(athlete_key, types=[sport]))
+            new_activities = []
+            pages = iter_user_activity_pages(token, after=activity_store.latest_start(athlete_key))
+            try:
+                async for page_number, activities_batch in enumerate_async(pages):
+                    new_activities.extend(activities_batch)
+                    yield format_stream_event({
+                        "type": "partial",
+                        "page": page_number,
+                        "activities_fetched": len(new_activities),
+                        **pipeline.feed(activities_batch).results()
+                    }, stream_format)
+            except StravaRateLimitError as e:
+                yield format_stream_event({"type": "error", "status_code": 429, "detail": str(e)}, stream_format)
+                return
+            except StravaAPIError as e:
+                status_code = 401 if e.status_code == 401 else 502
+                yield format_stream_event({"type": "error", "status_code": status_code, "detail": str(e)},
+                                          stream_format)
+                return
+            
+            # Only store complete syncs, a partial one would move the cursor past missing pages
+            activity_store.add(athlete_key, new_activities)
+            activity_store.mark_synced(athlete_key)
+        
+        cached = await build_volume_payload(athlete_key, sport)
+        yield format_stream_event({"type": "final", "etag": cached["etag"], **cached["payload"]}, stream_format)
+    
+    media_type = "text/event-stream" if stream_format == "sse" else "application/x-ndjson"
+    return StreamingResponse(updates(), media_type=media_type, headers={"Cache-Control": "no-cache"})
+
+@router.get("/training/plan/{job_id}")
+async def get_training_plan(job_id: str, wait: float = Query(0, ge=0, le=30)):
+    """Poll a training plan job, optionally waiting up to `wait` seconds for it to finish"""
+    job = plan_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown plan job")
+    
+    if wait and not job.finished:
+        try:
+            await job.wait(wait)
+        except asyncio.TimeoutError:
+            pass
+    
+    return {**plan_job_pointer(job), "calendar": plan_job_result(job) if job.finished else None}
+
+@router.get("/training/plan/{job_id}/events")
+async def stream_training_plan(job_id: str):
+    """Stream a training plan job's status and result as Server-Sent Events"""
+    job = plan_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown plan job")
+    
+    async def events():
+        yield f"event: status\ndata: {json.dumps(plan_job_pointer(job))}\n\n"
+        while not job.finished:
+            try:
+                await job.wait(15)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+        yield f"event: plan\ndata: {json.dumps(plan_job_result(job))}\n\n"
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
@@ -1,22 +1,24 @@
-from fastapi import APIRouter, HTTPException, Query
-from ..api.auth import user_sessions
+from fastapi import APIRouter, Header, HTTPException, Query
+from ..services.sessions import user_sessions
+from ..utils.cache import make_etag, conditional_json_response
 
 router = APIRouter()
 
 @router.get("/user/profile")
-async def get_user_profile(state: str = Query(...)):
-    """Get user profile information"""
+async def get_user_profile(state: str = Query(...), if_none_match: str = Header(None)):
+    """Get user profile information from the athlete record cached in the session"""
     # Check authentication
-    if state not in user_sessions or not user_sessions[state]["authenticated"]:
+    user_session = user_sessions.get(state)
+    if not user_session or not user_session["authenticated"]:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
     # Get user session data
-    user_session = user_sessions[state]
     athlete = user_session["athlete"]
     
-    return {
+    profile = {
         "username": athlete.get("username", ""),
         "firstname": athlete.get("firstname", ""),
         "lastname": athlete.get("lastname", ""),
         "profile_medium": athlete.get("profile_medium", "")
     }
+    return conditional_json_response(profile, make_etag(profile), if_none_match)
@@ -0,0 +1,38 @@
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Query, Request
+import logging
+import os
+from ..services.strava import webhooks_enabled
+from ..services.webhooks import webhook_queue, process_event
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+@router.get("/webhooks/strava")
+async def verify_strava_subscription(hub_mode: str = Query(..., alias="hub.mode"),
+                                     hub_challenge: str = Query(..., alias="hub.challenge"),
+                                     hub_verify_token: str = Query(..., alias="hub.verify_token")):
+    """Answer Strava's subscription validation handshake"""
+    verify_token = os.getenv("STRAVA_VERIFY_TOKEN")
+    if hub_mode != "subscribe" or not verify_token or hub_verify_token != verify_token:
+        raise HTTPException(status_code=403, detail="Invalid verify token")
+    return {"hub.challenge": hub_challenge}
+
+@router.post("/webhooks/strava")
+async def receive_strava_event(request: Request, background_tasks: BackgroundTasks):
+    """Receive an activity or athlete event, Strava expects a 200 within two seconds
+
+    Events are not signed, so they only trigger a check with Strava, which decides what changes.
+    """
+    if not webhooks_enabled():
+        raise HTTPException(status_code=404, detail="Webhooks are not configured")
+    event = await request.json()
+    logger.debug("Webhook event %s %s %s", event.get("aspect_type"), event.get("object_type"), event.get("object_id"))
+    subscription_id = os.getenv("STRAVA_SUBSCRIPTION_ID")
+    if subscription_id and str(event.get("subscription_id")) != subscription_id:
+        raise HTTPException(status_code=403, detail="Unknown subscription")
+
+    if not webhook_queue.enqueue(event):
+        # No worker running (e.g. serverless), process after the response is sent
+        background_tasks.add_task(process_event, event)
+    return {"status": "received"}
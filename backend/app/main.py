@@ -1,13 +1,65 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from dotenv import load_dotenv
+from fastapi.responses import PlainTextResponse
+from contextlib import asynccontextmanager
+from typing import Dict
+import logging
 import os
-from app.api import auth, user, training
+import time
 
-# Load environment variables from .env file
-load_dotenv(override=True)
+# Local development reads .env, deployments get their environment from the platform.
+# Loaded before the app modules, some read their settings on import
+if not os.getenv("VERCEL_URL"):
+    from dotenv import load_dotenv
+    load_dotenv(override=True)
 
-app = FastAPI()
+from app.api import auth, user, training, webhooks  # noqa: E402
+from app.services.http import start_http_client, close_http_client  # noqa: E402
+from app.services.webhooks import webhook_queue  # noqa: E402
+from app.services.tokens import token_refresher, token_vault  # noqa: E402
+from app.services.executor import cpu_executor  # noqa: E402
+from app.utils.log import configure_logging  # noqa: E402
+from app.utils.metrics import REQUEST_LATENCY, registry, start_spans, finish_spans, server_timing  # noqa: E402
+
+configure_logging()
+
+logger = logging.getLogger(__name__)
+
+async def warm_up() -> Dict[str, float]:
+    """Create the pooled HTTP client and load the token vault's JWE backend, returns milliseconds per step
+
+    Modules are only loaded as a side effect: building the client imports httpx and a vault
+    round trip imports jose, the two modules the app defers.
+    Runs on startup, and from GET /warmup where the platform skips the lifespan (serverless).
+    """
+    steps = {}
+    started = time.perf_counter()
+    
+    def lap(name: str):
+        nonlocal started
+        now = time.perf_counter()
+        steps[name] = round((now - started) * 1000, 3)
+        started = now
+    
+    await start_http_client()
+    lap("http_client")
+    token_vault.warm_up()
+    lap("token_vault")
+    return steps
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create shared resources on startup and release them on shutdown"""
+    await warm_up()
+    await webhook_queue.start()
+    await token_refresher.start()
+    yield
+    await token_refresher.stop()
+    await webhook_queue.stop()
+    await close_http_client()
+    cpu_executor.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 @app.get("/debug/env-vars")
 def debug_env_vars():
@@ -16,7 +68,6 @@ def debug_env_vars():
         "project": os.getenv("VERCEL_PROJECT_PRODUCTION_URL", "unknown"),
         "client_id": os.getenv("STRAVA_CLIENT_ID"),
         "client_secret_prefix": os.getenv("STRAVA_CLIENT_SECRET", "")[:5],
-        "openai_key_prefix": os.getenv("OPENAI_API_KEY", "")[:5],
     }
 
 # CORS middleware
@@ -35,6 +86,56 @@ app.add_middleware(
 app.include_router(auth.router)
 app.include_router(user.router)
 app.include_router(training.router)
+app.include_router(webhooks.router)
+
+def timing_spans_enabled(request: Request) -> bool:
+    """Spans are collected for every request with STRYDE_TIMING_SPANS, or when a request asks for them"""
+    if os.getenv("STRYDE_TIMING_SPANS", "false").lower() in ("1", "true", "yes"):
+        return True
+    return request.headers.get("X-Stryde-Timing", "").lower() in ("1", "true", "yes")
+
+def route_template(request: Request) -> str:
+    """The matched route's path template, so metrics are not labelled by ids and tokens"""
+    endpoint = request.scope.get("endpoint")
+    for route in request.app.routes:
+        if getattr(route, "endpoint", None) is endpoint:
+            return route.path
+    return "unmatched"
+
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    """Record route latency, and report timing spans in a Server-Timing header when asked to
+
+    Streaming responses are timed until their headers are sent.
+    """
+    spans_token = start_spans() if timing_spans_enabled(request) else None
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        elapsed = time.perf_counter() - started
+        route = route_template(request)
+        REQUEST_LATENCY.observe(elapsed, method=request.method, route=route, status=status)
+        spans = finish_spans(spans_token) if spans_token is not None else None
+    
+    if spans is not None:
+        spans.append(("total", elapsed * 1000))
+        response.headers["Server-Timing"] = server_timing(spans)
+        logger.info("%s %s timing: %s", request.method, route, server_timing(spans),
+                    extra={"route": route, "spans": dict(spans)})
+    return response
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus metrics"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/warmup")
+async def warmup():
+    """Prepare a fresh instance before real traffic, e.g. from a scheduled ping after deploys or idle periods"""
+    return {"warmed": await warm_up()}
 
 @app.get("/ping")
 async def ping():
@@ -0,0 +1,56 @@
+import time
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from typing import Any, Dict, Optional, Union
+
+def _float(value: Any) -> float:
+    return float(value) if value is not None else 0.0
+
+def _optional_float(value: Any) -> Optional[float]:
+    return float(value) if value is not None else None
+
+@dataclass(slots=True)
+class Activity:
+    """The handful of Strava activity fields the pipeline uses, everything else is dropped on parse"""
+    id: int
+    type: str
+    start: int  # epoch seconds (UTC)
+    distance: float = 0.0  # meters
+    moving_time: float = 0.0  # seconds
+    elapsed_time: float = 0.0  # seconds
+    total_elevation_gain: float = 0.0  # meters
+    average_speed: Optional[float] = None  # meters per second
+    average_heartrate: Optional[float] = None
+    name: str = ""
+
+    @classmethod
+    def from_strava(cls, data: Dict[str, Any]) -> "Activity":
+        """Project a Strava activity JSON object"""
+        start_date = datetime.fromisoformat(data.get("start_date", "").replace("Z", "+00:00"))
+        return cls(
+            id=data.get("id"),
+            type=data.get("type", ""),
+            start=int(start_date.timestamp()),
+            distance=_float(data.get("distance")),
+            moving_time=_float(data.get("moving_time")),
+            elapsed_time=_float(data.get("elapsed_time")),
+            total_elevation_gain=_float(data.get("total_elevation_gain")),
+            average_speed=_optional_float(data.get("average_speed")),
+            average_heartrate=_optional_float(data.get("average_heartrate")),
+            name=data.get("name") or "",
+        )
+
+    @classmethod
+    def coerce(cls, activity: Union["Activity", Dict[str, Any]]) -> "Activity":
+        """Accept an Activity or a raw Strava dict"""
+        return activity if isinstance(activity, Activity) else cls.from_strava(activity)
+
+    @property
+    def start_date(self) -> str:
+        """Start time in Strava's ISO format"""
+        return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.start))
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = asdict(self)
+        data["start_date"] = self.start_date
+        return data
@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Optional
 
 class WeeklyVolume(BaseModel):
@@ -28,3 +28,7 @@ class TrainingVolumeResponse(BaseModel):
     weekly_volume: List[WeeklyVolume]
     monthly_volume: List[MonthlyVolume]
     calendar: Optional[TrainingCalendar] = None
+
+class BatchVolumeRequest(BaseModel):
+    states: List[str] = Field(..., min_length=1, max_length=100)
+    sport: str = Field("Run", pattern="^(Run|Ride|TrailRun|VirtualRun)$")
@@ -0,0 +1,193 @@
+import os
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+import numpy as np
+from .analysis import ActivityColumns, concat_columns, to_columns
+from ..models.activity import Activity
+from ..utils.db import connect_sqlite
+from ..utils.helpers import get_data_path
+
+# Activity fields in column order, `start` is stored in the start_date column as epoch seconds
+ACTIVITY_FIELDS = (
+    "id", "type", "name", "start", "distance", "moving_time",
+    "elapsed_time", "total_elevation_gain", "average_speed", "average_heartrate",
+)
+COLUMNS = tuple("start_date" if field == "start" else field for field in ACTIVITY_FIELDS)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS activities (
+    athlete TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    type TEXT,
+    name TEXT,
+    start_date INTEGER NOT NULL,
+    distance REAL,
+    moving_time REAL,
+    elapsed_time REAL,
+    total_elevation_gain REAL,
+    average_speed REAL,
+    average_heartrate REAL,
+    PRIMARY KEY (athlete, id)
+);
+CREATE INDEX IF NOT EXISTS activities_athlete_start ON activities (athlete, start_date);
+CREATE INDEX IF NOT EXISTS activities_athlete_type ON activities (athlete, type, start_date);
+CREATE TABLE IF NOT EXISTS athletes (
+    athlete TEXT PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0,
+    synced_at REAL
+);
+"""
+
+UPSERT = f"""
+INSERT INTO activities (athlete, {", ".join(COLUMNS)})
+VALUES (?, {", ".join("?" for _ in COLUMNS)})
+ON CONFLICT (athlete, id) DO UPDATE SET
+{", ".join(f"{column} = excluded.{column}" for column in COLUMNS if column != "id")}
+"""
+
+def _row_values(athlete_key: str, activity: Union[Activity, Dict[str, Any]]) -> Tuple:
+    activity = Activity.coerce(activity)
+    return (athlete_key, *(getattr(activity, field) for field in ACTIVITY_FIELDS))
+
+def _row_activity(row: Sequence[Any]) -> Activity:
+    values = dict(zip(ACTIVITY_FIELDS, row))
+    for field in ("distance", "moving_time", "elapsed_time", "total_elevation_gain"):
+        values[field] = values[field] or 0.0
+    values["name"] = values["name"] or ""
+    return Activity(**values)
+
+def _where(athlete_key: str, start: Optional[int], end: Optional[int],
+           types: Optional[Iterable[str]]) -> Tuple[str, List[Any]]:
+    """WHERE clause that the (athlete, start_date) and (athlete, type) indexes can serve"""
+    clauses, params = ["athlete = ?"], [athlete_key]
+    if types is not None:
+        types = list(types)
+        clauses.append(f"type IN ({', '.join('?' for _ in types)})")
+        params.extend(types)
+    if start is not None:
+        clauses.append("start_date >= ?")
+        params.append(start)
+    if end is not None:
+        clauses.append("start_date < ?")
+        params.append(end)
+    return " AND ".join(clauses), params
+
+class ActivityDatabase:
+    """Embedded SQLite store of projected Strava activities"""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = connect_sqlite(path)
+        self._conn.executescript(SCHEMA)
+
+    def upsert(self, athlete_key: str, activities: Iterable[Union[Activity, Dict[str, Any]]]) -> int:
+        """Insert or update activities in one transaction"""
+        rows = [_row_values(athlete_key, activity) for activity in activities]
+        if not rows:
+            return 0
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(UPSERT, rows)
+            self._conn.execute("COMMIT")
+        return len(rows)
+
+    def delete(self, athlete_key: str, activity_ids: Iterable[Any]) -> int:
+        """Delete activities by id, returns how many existed"""
+        ids = [(athlete_key, activity_id) for activity_id in activity_ids]
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany("DELETE FROM activities WHERE athlete = ? AND id = ?", ids)
+            return self._conn.total_changes - before
+
+    def delete_athlete(self, athlete_key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM activities WHERE athlete = ?", (athlete_key,))
+
+    def latest_start(self, athlete_key: str) -> Optional[int]:
+        """Epoch start of the newest activity, served from the (athlete, start_date) index"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT MAX(start_date) FROM activities WHERE athlete = ?", (athlete_key,)
+            ).fetchone()[0]
+
+    def count(self, athlete_key: str, start: Optional[int] = None, end: Optional[int] = None,
+              types: Optional[Iterable[str]] = None) -> int:
+        where, params = _where(athlete_key, start, end, types)
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM activities WHERE {where}", params).fetchone()[0]
+
+    def query(self, athlete_key: str, start: Optional[int] = None, end: Optional[int] = None,
+              types: Optional[Iterable[str]] = None, limit: Optional[int] = None) -> List[Activity]:
+        """Activities in a date range and of the given types, newest first"""
+        where, params = _where(athlete_key, start, end, types)
+        sql = f"SELECT {', '.join(COLUMNS)} FROM activities WHERE {where} ORDER BY start_date DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [_row_activity(row) for row in rows]
+
+    def get(self, athlete_key: str, activity_id: Any) -> Optional[Activity]:
+        """One activity by id, served from the primary key"""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM activities WHERE athlete = ? AND id = ?", (athlete_key, activity_id)
+            ).fetchone()
+        return _row_activity(row) if row else None
+
+    def iter_columns(self, athlete_key: str, start: Optional[int] = None, end: Optional[int] = None,
+                     types: Optional[Iterable[str]] = None, limit: Optional[int] = None,
+                     chunk_size: int = 1000) -> Iterator[ActivityColumns]:
+        """Columns for a date range, newest first, one chunk at a time without building per-activity objects"""
+        where, params = _where(athlete_key, start, end, types)
+        sql = (f"SELECT start_date, COALESCE(distance, 0), COALESCE(moving_time, 0) FROM activities "
+               f"WHERE {where} ORDER BY start_date DESC")
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            chunk = np.array(rows, dtype=np.float64)
+            yield ActivityColumns(chunk[:, 0].astype(np.int64), chunk[:, 1], chunk[:, 2])
+
+    def query_columns(self, athlete_key: str, start: Optional[int] = None, end: Optional[int] = None,
+                      types: Optional[Iterable[str]] = None, chunk_size: int = 1000) -> ActivityColumns:
+        """Columns for a date range, filled chunk by chunk without building per-activity objects"""
+        chunks = list(self.iter_columns(athlete_key, start, end, types, chunk_size=chunk_size))
+        return concat_columns(*chunks) if chunks else to_columns([])
+
+    def version(self, athlete_key: str) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT version FROM athletes WHERE athlete = ?", (athlete_key,)).fetchone()
+        return row[0] if row else 0
+
+    def bump_version(self, athlete_key: str) -> int:
+        """Mark the athlete's data as changed, visible to every worker sharing the file"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO athletes (athlete, version) VALUES (?, 1) "
+                "ON CONFLICT (athlete) DO UPDATE SET version = version + 1", (athlete_key,)
+            )
+            return self._conn.execute("SELECT version FROM athletes WHERE athlete = ?", (athlete_key,)).fetchone()[0]
+
+    def synced_at(self, athlete_key: str) -> Optional[float]:
+        with self._lock:
+            row = self._conn.execute("SELECT synced_at FROM athletes WHERE athlete = ?", (athlete_key,)).fetchone()
+        return row[0] if row else None
+
+    def set_synced_at(self, athlete_key: str, synced_at: Optional[float]):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO athletes (athlete, synced_at) VALUES (?, ?) "
+                "ON CONFLICT (athlete) DO UPDATE SET synced_at = excluded.synced_at", (athlete_key, synced_at)
+            )
+
+def create_activity_database() -> ActivityDatabase:
+    """Open the activity database at STRYDE_ACTIVITY_DB, or activities.db in the data directory"""
+    return ActivityDatabase(os.getenv("STRYDE_ACTIVITY_DB") or get_data_path("activities.db"))
@@ -0,0 +1,126 @@
+import threading
+import time
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Union
+from .activity_db import ActivityDatabase, create_activity_database
+from .analysis import aggregate_store, ActivityColumns, AthleteRollups
+from ..models.activity import Activity
+
+class ActivityStore:
+    """Per-athlete store of already fetched Strava activities, persisted in the activity database
+
+    In-process rollups are tagged with the data version they were built from and
+    rebuilt when another worker sharing the database has changed the athlete.
+    Rebuilds run without the lock, possibly on an executor thread, and are swapped
+    in under it. The lock only covers in-memory rollup changes, so taking it from
+    the event loop never waits on a rebuild or on the database.
+    """
+
+    def __init__(self, db: ActivityDatabase):
+        self.db = db
+        self._rollup_versions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def latest_start(self, athlete_key: str) -> Optional[int]:
+        """Epoch start time of the newest stored activity, used as Strava's `after` cursor"""
+        return self.db.latest_start(athlete_key)
+
+    def version(self, athlete_key: str) -> int:
+        """Data version, bumped whenever the athlete's activities change"""
+        return self.db.version(athlete_key)
+
+    def mark_synced(self, athlete_key: str):
+        """Record that the athlete was just checked against Strava"""
+        self.db.set_synced_at(athlete_key, time.time())
+
+    def is_fresh(self, athlete_key: str, max_age: float) -> bool:
+        """Whether the athlete was synced within the last `max_age` seconds"""
+        synced_at = self.db.synced_at(athlete_key)
+        return synced_at is not None and time.time() - synced_at < max_age
+
+    def rollups_current(self, athlete_key: str) -> bool:
+        """Whether the athlete's rollups match the data version in the database"""
+        return (self._rollup_versions.get(athlete_key) == self.version(athlete_key)
+                and aggregate_store.has(athlete_key))
+
+    def ensure_rollups(self, athlete_key: str) -> AthleteRollups:
+        """The athlete's rollups, rebuilt from the database if they are missing or stale
+
+        Callers read the returned rollups, the store may evict them at any time.
+        """
+        rollups = aggregate_store.get(athlete_key)
+        if rollups is not None and self._rollup_versions.get(athlete_key) == self.version(athlete_key):
+            return rollups
+        version = self.version(athlete_key)
+        built = aggregate_store.build(athlete_key, self.db.query(athlete_key))
+        with self._lock:
+            # Writes that landed meanwhile were applied to newer rollups, keep those
+            current = aggregate_store.get(athlete_key)
+            if current is None or self._rollup_versions.get(athlete_key, -1) < version:
+                aggregate_store.replace(athlete_key, built)
+                self._rollup_versions[athlete_key] = version
+                current = aggregate_store.get(athlete_key)
+        return current or built.get(athlete_key) or AthleteRollups()
+
+    def _apply(self, athlete_key: str, version: int, **changes):
+        """Apply a write to the rollups if they were current right before it, else leave them to a rebuild"""
+        with self._lock:
+            if self._rollup_versions.get(athlete_key) == version - 1 and aggregate_store.has(athlete_key):
+                aggregate_store.apply(athlete_key, **changes)
+                self._rollup_versions[athlete_key] = version
+
+    def add(self, athlete_key: str, activities: List[Union[Activity, Dict[str, Any]]]) -> int:
+        """Insert or replace activities by id, returns how many were stored"""
+        if not activities:
+            return 0
+
+        activities = [Activity.coerce(activity) for activity in activities]
+        self.ensure_rollups(athlete_key)
+        stored = self.db.upsert(athlete_key, activities)
+        self._apply(athlete_key, self.db.bump_version(athlete_key), upserted=activities)
+        return stored
+
+    def remove(self, athlete_key: str, activity_ids: Iterable[Any]) -> int:
+        """Delete activities by id, returns how many were removed"""
+        activity_ids = list(activity_ids)
+        self.ensure_rollups(athlete_key)
+        removed = self.db.delete(athlete_key, activity_ids)
+        if removed:
+            self._apply(athlete_key, self.db.bump_version(athlete_key), deleted_ids=activity_ids)
+        return removed
+
+    def get(self, athlete_key: str) -> List[Activity]:
+        """All stored activities for an athlete, newest first (Strava's default order)"""
+        return self.db.query(athlete_key)
+
+    def get_activity(self, athlete_key: str, activity_id: Any) -> Optional[Activity]:
+        return self.db.get(athlete_key, activity_id)
+
+    def query(self, athlete_key: str, start: Optional[int] = None, end: Optional[int] = None,
+              types: Optional[Iterable[str]] = None, limit: Optional[int] = None) -> List[Activity]:
+        """Stored activities in a date range and of the given types, newest first"""
+        return self.db.query(athlete_key, start, end, types, limit)
+
+    def query_columns(self, athlete_key: str, start: Optional[int] = None, end: Optional[int] = None,
+                      types: Optional[Iterable[str]] = None) -> ActivityColumns:
+        """Stored activities as analysis columns, without building per-activity objects"""
+        return self.db.query_columns(athlete_key, start, end, types)
+
+    def iter_columns(self, athlete_key: str, start: Optional[int] = None, end: Optional[int] = None,
+                     types: Optional[Iterable[str]] = None, limit: Optional[int] = None) -> Iterator[ActivityColumns]:
+        """Stored activities as chunks of analysis columns, newest first"""
+        return self.db.iter_columns(athlete_key, start, end, types, limit)
+
+    def count(self, athlete_key: str, types: Optional[Iterable[str]] = None) -> int:
+        return self.db.count(athlete_key, types=types)
+
+    def clear(self, athlete_key: str):
+        """Forget everything stored for an athlete"""
+        self.db.delete_athlete(athlete_key)
+        self.db.set_synced_at(athlete_key, None)
+        self.db.bump_version(athlete_key)
+        with self._lock:
+            self._rollup_versions.pop(athlete_key, None)
+            aggregate_store.clear(athlete_key)
+
+# Shared by all requests in this process, persisted across restarts
+activity_store = ActivityStore(create_activity_database())
@@ -1,57 +1,308 @@
-from datetime import datetime, timedelta
-from typing import List, Dict, Any
-
-def calculate_weekly_volume(running_activities: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    """Calculate weekly training volume"""
-    weekly_data = {}
-    
-    for activity in running_activities:
-        # Parse activity date
-        start_date = datetime.fromisoformat(activity.get("start_date", "").replace("Z", "+00:00"))
-        
-        # Get week start (Monday)
-        week_start = start_date - timedelta(days=start_date.weekday())
-        week_key = week_start.strftime("%Y-%m-%d")
-        
-        if week_key not in weekly_data:
-            weekly_data[week_key] = {
-                "week_start": week_key,
-                "runs": 0,
-                "distance_km": 0,
-                "time_minutes": 0
-            }
-        
-        weekly_data[week_key]["runs"] += 1
-        weekly_data[week_key]["distance_km"] += activity.get("distance", 0) / 1000  # Convert to km
-        weekly_data[week_key]["time_minutes"] += activity.get("moving_time", 0) / 60  # Convert to minutes
-    
-    # Sort by week and return last 8 weeks
-    sorted_weeks = sorted(weekly_data.items(), key=lambda x: x[0], reverse=True)[:8]
-    return [week_data for week_key, week_data in sorted_weeks]
-
-def calculate_monthly_volume(running_activities: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    """Calculate monthly training volume"""
-    monthly_data = {}
-    
-    for activity in running_activities:
-        # Parse activity date
-        start_date = datetime.fromisoformat(activity.get("start_date", "").replace("Z", "+00:00"))
-        
-        # Get month key
-        month_key = start_date.strftime("%Y-%m")
-        
-        if month_key not in monthly_data:
-            monthly_data[month_key] = {
-                "month": month_key,
-                "runs": 0,
-                "distance_km": 0,
-                "time_minutes": 0
-            }
-        
-        monthly_data[month_key]["runs"] += 1
-        monthly_data[month_key]["distance_km"] += activity.get("distance", 0) / 1000  # Convert to km
-        monthly_data[month_key]["time_minutes"] += activity.get("moving_time", 0) / 60  # Convert to minutes
-    
-    # Sort by month and return last 6 months
-    sorted_months = sorted(monthly_data.items(), key=lambda x: x[0], reverse=True)[:6]
-    return [month_data for month_key, month_data in sorted_months]
+import os
+from collections import OrderedDict
+import numpy as np
+from ..models.activity import Activity
+from typing import List, Dict, Any, Iterable, NamedTuple, Optional, Tuple, Union
+
+SECONDS_PER_DAY = 86400
+# 1970-01-01 was a Thursday, shifting by 3 days makes weeks start on Monday
+EPOCH_WEEKDAY_OFFSET = 3
+
+class ActivityColumns(NamedTuple):
+    """Columnar view of activities, one NumPy array per field"""
+    start: np.ndarray        # int64 epoch seconds (UTC)
+    distance: np.ndarray     # float64 meters
+    moving_time: np.ndarray  # float64 seconds
+
+# One record per activity, the compact form columns are handed to worker processes in
+PACKED_COLUMNS_DTYPE = np.dtype([("start", "<i8"), ("distance", "<f8"), ("moving_time", "<f8")])
+
+ActivitiesInput = Union[List[Activity], List[Dict[str, Any]], ActivityColumns]
+
+def to_columns(activities: ActivitiesInput) -> ActivityColumns:
+    """Convert activities to columns once so every aggregation can reuse them"""
+    if isinstance(activities, ActivityColumns):
+        return activities
+
+    activities = [Activity.coerce(act) for act in activities]
+    count = len(activities)
+    start = np.fromiter((act.start for act in activities), dtype=np.int64, count=count)
+    distance = np.fromiter((act.distance for act in activities), dtype=np.float64, count=count)
+    moving_time = np.fromiter((act.moving_time for act in activities), dtype=np.float64, count=count)
+    return ActivityColumns(start, distance, moving_time)
+
+def concat_columns(*columns: ActivityColumns) -> ActivityColumns:
+    """Append activity columns, e.g. as pages of activities arrive"""
+    return ActivityColumns(*(np.concatenate(field) for field in zip(*columns)))
+
+def pack_columns(columns: ActivityColumns) -> bytes:
+    """Serialize columns to 24 bytes per activity"""
+    packed = np.empty(len(columns.start), dtype=PACKED_COLUMNS_DTYPE)
+    packed["start"], packed["distance"], packed["moving_time"] = columns
+    return packed.tobytes()
+
+def unpack_columns(data: bytes) -> ActivityColumns:
+    packed = np.frombuffer(data, dtype=PACKED_COLUMNS_DTYPE)
+    return ActivityColumns(packed["start"], packed["distance"], packed["moving_time"])
+
+def period_keys(start: np.ndarray, period: str) -> np.ndarray:
+    """Map epoch seconds to an integer bucket per period ("day", "week", "month" or "year")"""
+    days = start // SECONDS_PER_DAY
+    if period == "day":
+        return days
+    if period == "week":
+        return (days + EPOCH_WEEKDAY_OFFSET) // 7 * 7 - EPOCH_WEEKDAY_OFFSET
+    if period == "month":
+        return start.astype("datetime64[s]").astype("datetime64[M]").astype(np.int64)
+    if period == "year":
+        return start.astype("datetime64[s]").astype("datetime64[Y]").astype(np.int64)
+    raise ValueError(f"Unknown period: {period}")
+
+def period_labels(keys: np.ndarray, period: str) -> List[str]:
+    """Format bucket keys from `period_keys` as ISO strings"""
+    unit = {"day": "D", "week": "D", "month": "M", "year": "Y"}[period]
+    return np.datetime_as_string(keys.astype(f"datetime64[{unit}]")).tolist()
+
+def volume_rows(labels: List[str], label: str, runs, distance_m, time_s) -> List[Dict[str, Any]]:
+    """Build the weekly/monthly response rows from per-period sums"""
+    return [
+        {
+            label: key,
+            "runs": int(runs[i]),
+            "distance_km": float(distance_m[i]) / 1000,  # Convert to km
+            "time_minutes": float(time_s[i]) / 60  # Convert to minutes
+        }
+        for i, key in enumerate(labels)
+    ]
+
+def aggregate_volume(activities: ActivitiesInput, period: str, label: str,
+                     limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Group activities by period in one vectorized pass, newest period first"""
+    columns = to_columns(activities)
+    if len(columns.start) == 0:
+        return []
+
+    keys, inverse = np.unique(period_keys(columns.start, period), return_inverse=True)
+    runs = np.bincount(inverse, minlength=len(keys))
+    distance = np.bincount(inverse, weights=columns.distance, minlength=len(keys))
+    moving_time = np.bincount(inverse, weights=columns.moving_time, minlength=len(keys))
+
+    newest_first = np.arange(len(keys))[::-1][:limit]
+    return volume_rows(period_labels(keys[newest_first], period), label,
+                       runs[newest_first], distance[newest_first], moving_time[newest_first])
+
+def aggregate_group_volume(columns_by_athlete: Dict[str, ActivityColumns], period: str, label: str,
+                           limit: Optional[int] = None) -> Tuple[Dict[str, List[Dict[str, Any]]], List[Dict[str, Any]]]:
+    """Per-athlete and whole-group volume from one vectorized pass over the combined activities
+
+    Group rows also count how many athletes were active in each period.
+    """
+    athletes = list(columns_by_athlete)
+    per_athlete: Dict[str, List[Dict[str, Any]]] = {athlete: [] for athlete in athletes}
+    if not athletes:
+        return per_athlete, []
+
+    combined = concat_columns(*columns_by_athlete.values())
+    if len(combined.start) == 0:
+        return per_athlete, []
+    owner = np.repeat(np.arange(len(athletes)), [len(columns.start) for columns in columns_by_athlete.values()])
+    keys = period_keys(combined.start, period)
+
+    # One (athlete, period) grouping serves both the per-athlete and the group rollups
+    pairs, inverse = np.unique(np.stack([owner, keys], axis=1), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    runs = np.bincount(inverse, minlength=len(pairs))
+    distance = np.bincount(inverse, weights=combined.distance, minlength=len(pairs))
+    moving_time = np.bincount(inverse, weights=combined.moving_time, minlength=len(pairs))
+
+    # Pairs are sorted by athlete, then period
+    bounds = np.searchsorted(pairs[:, 0], np.arange(len(athletes) + 1))
+    for i, athlete in enumerate(athletes):
+        newest_first = np.arange(bounds[i], bounds[i + 1])[::-1][:limit]
+        per_athlete[athlete] = volume_rows(period_labels(pairs[newest_first, 1], period), label,
+                                           runs[newest_first], distance[newest_first], moving_time[newest_first])
+
+    group_keys, group_inverse = np.unique(pairs[:, 1], return_inverse=True)
+    active = np.bincount(group_inverse, minlength=len(group_keys))
+    newest_first = np.arange(len(group_keys))[::-1][:limit]
+    group = volume_rows(period_labels(group_keys[newest_first], period), label,
+                        np.bincount(group_inverse, weights=runs, minlength=len(group_keys))[newest_first],
+                        np.bincount(group_inverse, weights=distance, minlength=len(group_keys))[newest_first],
+                        np.bincount(group_inverse, weights=moving_time, minlength=len(group_keys))[newest_first])
+    for row, count in zip(group, active[newest_first]):
+        row["athletes"] = int(count)
+    return per_athlete, group
+
+def group_training_volume(columns_by_athlete: Dict[str, ActivityColumns]) -> Dict[str, Any]:
+    """Weekly and monthly volume per athlete and for the whole group"""
+    weekly, group_weekly = aggregate_group_volume(columns_by_athlete, "week", "week_start", limit=8)
+    monthly, group_monthly = aggregate_group_volume(columns_by_athlete, "month", "month", limit=6)
+    return {"weekly": weekly, "monthly": monthly, "group_weekly": group_weekly, "group_monthly": group_monthly}
+
+class AthleteRollups:
+    """Rollups of one athlete and the activity contributions they were summed from"""
+
+    def __init__(self):
+        # (sport, period) -> period key -> [runs, distance m, moving time s]
+        self.buckets: Dict[Tuple[str, str], Dict[int, List[float]]] = {}
+        # activity id -> (sport, start epoch, distance m, moving time s)
+        self.contributions: Dict[Any, Tuple[str, int, float, float]] = {}
+
+    def sums(self, sport: str, period: str) -> Dict[int, Tuple[int, float, float]]:
+        """Copy of the sums per period key: (activities, distance m, moving time s)"""
+        return {key: tuple(sums) for key, sums in self.buckets.get((sport, period), {}).items()}
+
+    def read(self, sport: str, period: str, label: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Rollups for one sport and period, newest period first"""
+        buckets = self.buckets.get((sport, period), {})
+        keys = sorted(buckets, reverse=True)[:limit]
+        sums = [buckets[key] for key in keys]
+        return volume_rows(period_labels(np.array(keys, dtype=np.int64), period), label,
+                           [s[0] for s in sums], [s[1] for s in sums], [s[2] for s in sums])
+
+class AggregateStore:
+    """Per-athlete weekly/monthly rollups kept up to date by applying activity diffs
+
+    Each activity's contribution is remembered so edits and deletes subtract exactly
+    what was added before. Reading a dashboard is then O(periods), not O(activities).
+    At most `max_athletes` athletes are kept, least recently used first out; an
+    evicted athlete's rollups are rebuilt from the database on their next request.
+    """
+
+    PERIODS = ("week", "month")
+
+    def __init__(self, max_athletes: int = 1000):
+        self.max_athletes = max_athletes
+        self._athletes: "OrderedDict[str, AthleteRollups]" = OrderedDict()
+
+    def get(self, athlete_key: str) -> Optional[AthleteRollups]:
+        """The athlete's rollups, None if they were never built or have been evicted"""
+        rollups = self._athletes.get(athlete_key)
+        if rollups is not None:
+            try:
+                self._athletes.move_to_end(athlete_key)
+            except KeyError:
+                # Evicted by another thread meanwhile
+                pass
+        return rollups
+
+    def _set(self, athlete_key: str, rollups: AthleteRollups):
+        self._athletes[athlete_key] = rollups
+        self._athletes.move_to_end(athlete_key)
+        while len(self._athletes) > self.max_athletes:
+            self._athletes.popitem(last=False)
+
+    def has(self, athlete_key: str) -> bool:
+        """Whether rollups have been built for this athlete and are still held"""
+        return athlete_key in self._athletes
+
+    def apply(self, athlete_key: str, upserted: Iterable[Union[Activity, Dict[str, Any]]] = (),
+              deleted_ids: Iterable[Any] = ()):
+        """Add new or changed activities and remove deleted ones from the affected buckets"""
+        athlete = self.get(athlete_key)
+        if athlete is None:
+            athlete = AthleteRollups()
+            self._set(athlete_key, athlete)
+        contributions = athlete.contributions
+        rows = []  # (sport, start, distance, moving time, +1/-1)
+
+        for activity_id in deleted_ids:
+            previous = contributions.pop(activity_id, None)
+            if previous:
+                rows.append((*previous, -1))
+
+        for activity in map(Activity.coerce, upserted):
+            previous = contributions.get(activity.id)
+            if previous:
+                rows.append((*previous, -1))
+            current = (activity.type, activity.start, activity.distance, activity.moving_time)
+            contributions[activity.id] = current
+            rows.append((*current, 1))
+
+        if not rows:
+            return
+
+        sports = np.array([row[0] for row in rows])
+        start = np.array([row[1] for row in rows], dtype=np.int64)
+        distance = np.array([row[2] for row in rows], dtype=np.float64)
+        moving_time = np.array([row[3] for row in rows], dtype=np.float64)
+        sign = np.array([row[4] for row in rows], dtype=np.float64)
+
+        for sport in np.unique(sports):
+            selected = sports == sport
+            for period in self.PERIODS:
+                keys, inverse = np.unique(period_keys(start[selected], period), return_inverse=True)
+                runs = np.bincount(inverse, weights=sign[selected], minlength=len(keys))
+                dist = np.bincount(inverse, weights=(distance * sign)[selected], minlength=len(keys))
+                time = np.bincount(inverse, weights=(moving_time * sign)[selected], minlength=len(keys))
+
+                buckets = athlete.buckets.setdefault((str(sport), period), {})
+                for i, key in enumerate(keys.tolist()):
+                    bucket = buckets.setdefault(key, [0, 0.0, 0.0])
+                    bucket[0] += int(runs[i])
+                    bucket[1] += dist[i]
+                    bucket[2] += time[i]
+                    if bucket[0] <= 0:
+                        del buckets[key]
+
+    def buckets(self, athlete_key: str, sport: str, period: str) -> Dict[int, Tuple[int, float, float]]:
+        """Copy of the sums per period key: (activities, distance m, moving time s)"""
+        athlete = self.get(athlete_key)
+        return athlete.sums(sport, period) if athlete is not None else {}
+
+    def read(self, athlete_key: str, sport: str, period: str, label: str,
+             limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Rollups for one sport and period, newest period first"""
+        return (self.get(athlete_key) or AthleteRollups()).read(sport, period, label, limit)
+
+    @classmethod
+    def build(cls, athlete_key: str, activities: Iterable[Union[Activity, Dict[str, Any]]]) -> "AggregateStore":
+        """Rollups of one athlete in a store of their own, to be swapped in with `replace`"""
+        rollups = cls()
+        rollups.apply(athlete_key, upserted=activities)
+        return rollups
+
+    def replace(self, athlete_key: str, rollups: "AggregateStore"):
+        """Swap in an athlete's rollups built by `build`, readers see either the old or the new ones"""
+        self._set(athlete_key, rollups.get(athlete_key) or AthleteRollups())
+
+    def clear(self, athlete_key: str):
+        """Drop all rollups for an athlete"""
+        self._athletes.pop(athlete_key, None)
+
+# In-memory rollups shared by all requests in this process, for up to STRYDE_ROLLUP_CACHE_SIZE athletes
+aggregate_store = AggregateStore(int(os.getenv("STRYDE_ROLLUP_CACHE_SIZE", "1000")))
+
+def _athlete_rollups(athlete_key: Optional[str], rollups: Optional[AthleteRollups]) -> Optional[AthleteRollups]:
+    if rollups is None and athlete_key is not None:
+        return aggregate_store.get(athlete_key)
+    return rollups
+
+def calculate_weekly_volume(running_activities: Optional[ActivitiesInput], athlete_key: Optional[str] = None,
+                            sport: str = "Run", rollups: Optional[AthleteRollups] = None) -> List[Dict[str, Any]]:
+    """Calculate weekly training volume for the last 8 weeks, from rollups when the athlete has them"""
+    rollups = _athlete_rollups(athlete_key, rollups)
+    if rollups is not None:
+        return rollups.read(sport, "week", "week_start", limit=8)
+    return aggregate_volume(running_activities, "week", "week_start", limit=8)
+
+def calculate_monthly_volume(running_activities: Optional[ActivitiesInput], athlete_key: Optional[str] = None,
+                             sport: str = "Run", rollups: Optional[AthleteRollups] = None) -> List[Dict[str, Any]]:
+    """Calculate monthly training volume for the last 6 months, from rollups when the athlete has them"""
+    rollups = _athlete_rollups(athlete_key, rollups)
+    if rollups is not None:
+        return rollups.read(sport, "month", "month", limit=6)
+    return aggregate_volume(running_activities, "month", "month", limit=6)
+
+def calculate_training_volume(running_activities: Optional[ActivitiesInput], athlete_key: Optional[str] = None,
+                              sport: str = "Run", rollups: Optional[AthleteRollups] = None
+                              ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Weekly and monthly volume, converting activities to columns at most once
+
+    Activities are only needed when neither `rollups` nor the athlete's stored rollups are at hand.
+    """
+    rollups = _athlete_rollups(athlete_key, rollups)
+    if rollups is None:
+        running_activities = to_columns(running_activities)
+    return (calculate_weekly_volume(running_activities, sport=sport, rollups=rollups),
+            calculate_monthly_volume(running_activities, sport=sport, rollups=rollups))
@@ -0,0 +1,86 @@
+import asyncio
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+from .analysis import ActivityColumns, pack_columns, unpack_columns
+
+INLINE = "inline"
+THREAD = "thread"
+PROCESS = "process"
+
+def _pack(value: Any) -> Any:
+    """Replace activity columns, alone or in a dict, by their packed bytes"""
+    if isinstance(value, ActivityColumns):
+        return ("columns", pack_columns(value))
+    if isinstance(value, dict) and value and all(isinstance(v, ActivityColumns) for v in value.values()):
+        return ("columns_by_key", {key: pack_columns(v) for key, v in value.items()})
+    return ("value", value)
+
+def _unpack(packed: Tuple[str, Any]) -> Any:
+    kind, value = packed
+    if kind == "columns":
+        return unpack_columns(value)
+    if kind == "columns_by_key":
+        return {key: unpack_columns(v) for key, v in value.items()}
+    return value
+
+def _call_packed(fn: Callable, packed_args: Tuple) -> Any:
+    """Entry point in the worker process"""
+    return fn(*(_unpack(arg) for arg in packed_args))
+
+class CPUExecutor:
+    """Runs CPU-heavy analysis inline, in a thread pool or in a process pool
+
+    Work smaller than `threshold` activities stays on the event loop, handing it
+    off would cost more than it saves.
+    """
+
+    def __init__(self, mode: str = THREAD, max_workers: Optional[int] = None, threshold: int = 2000):
+        if mode not in (INLINE, THREAD, PROCESS):
+            raise ValueError(f"Unknown executor mode: {mode}")
+        self.mode = mode
+        self.max_workers = max_workers
+        self.threshold = threshold
+        self._pools: Dict[str, Executor] = {}
+
+    def _pool(self, mode: str) -> Executor:
+        if mode not in self._pools:
+            pool_class = ProcessPoolExecutor if mode == PROCESS else ThreadPoolExecutor
+            self._pools[mode] = pool_class(max_workers=self.max_workers)
+        return self._pools[mode]
+
+    async def run(self, fn: Callable, *args: Any, size: int = 0) -> Any:
+        """Run a pure function of `args`, process workers get activity columns as packed bytes
+
+        `fn` must be a module-level function when the process pool is used.
+        """
+        if self.mode == INLINE or size < self.threshold:
+            return fn(*args)
+        loop = asyncio.get_running_loop()
+        if self.mode == PROCESS:
+            return await loop.run_in_executor(self._pool(PROCESS), _call_packed, fn, tuple(map(_pack, args)))
+        return await loop.run_in_executor(self._pool(THREAD), fn, *args)
+
+    async def run_local(self, fn: Callable, *args: Any, size: int = 0) -> Any:
+        """Run work that reads or updates this process's state, never in another process"""
+        if self.mode == INLINE or size < self.threshold:
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._pool(THREAD), fn, *args)
+
+    def shutdown(self):
+        """Stop the worker pools, called from the FastAPI lifespan"""
+        for pool in self._pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        self._pools = {}
+
+def create_cpu_executor() -> CPUExecutor:
+    """Executor selected by STRYDE_CPU_EXECUTOR ("inline", "thread" or "process")"""
+    workers = os.getenv("STRYDE_CPU_WORKERS")
+    return CPUExecutor(
+        mode=os.getenv("STRYDE_CPU_EXECUTOR", THREAD),
+        max_workers=int(workers) if workers else None,
+        threshold=int(os.getenv("STRYDE_CPU_OFFLOAD_THRESHOLD", "2000")),
+    )
+
+# Shared by the training endpoints
+cpu_executor = create_cpu_executor()
@@ -0,0 +1,74 @@
+import asyncio
+import os
+from typing import TYPE_CHECKING, Optional, Set
+
+if TYPE_CHECKING:
+    import httpx
+
+# Application-scoped client shared by the Strava and inference services. httpx is imported
+# when the first client is built, so a cold start that never calls out does not load it
+_client: Optional["httpx.AsyncClient"] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+# Tasks closing clients built outside the lifespan when their loop shuts down, held so they are not collected
+_closers: Set[asyncio.Task] = set()
+
+def _http2_available() -> bool:
+    """HTTP/2 needs the optional `h2` package (installed with httpx[http2])"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def build_http_client() -> "httpx.AsyncClient":
+    """Create a pooled keep-alive client configured from environment variables"""
+    import httpx
+
+    limits = httpx.Limits(
+        max_connections=int(os.getenv("STRYDE_HTTP_MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(os.getenv("STRYDE_HTTP_MAX_KEEPALIVE", "20")),
+        keepalive_expiry=float(os.getenv("STRYDE_HTTP_KEEPALIVE_EXPIRY", "30")),
+    )
+    timeout = httpx.Timeout(
+        float(os.getenv("STRYDE_HTTP_TIMEOUT", "10")),
+        connect=float(os.getenv("STRYDE_HTTP_CONNECT_TIMEOUT", "5")),
+    )
+    return httpx.AsyncClient(http2=_http2_available(), limits=limits, timeout=timeout)
+
+async def start_http_client():
+    """Create the shared client, called from the FastAPI lifespan"""
+    global _client, _client_loop
+    if _client is None:
+        _client = build_http_client()
+        _client_loop = asyncio.get_running_loop()
+
+async def close_http_client():
+    """Close the shared client and its connection pool"""
+    global _client, _client_loop
+    if _client is not None:
+        await _client.aclose()
+    _client = None
+    _client_loop = None
+
+async def _close_on_shutdown(client: "httpx.AsyncClient"):
+    """Close `client` when its loop cancels the remaining tasks on shutdown, as asyncio.run does"""
+    try:
+        await asyncio.get_running_loop().create_future()
+    finally:
+        await client.aclose()
+
+def get_http_client() -> "httpx.AsyncClient":
+    """Return the shared client, creating it if the lifespan did not run (serverless, tests)"""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        # Connections are bound to the loop that opened them, so the old client is closed on
+        # its own loop: now if that loop is still open, else it was closed as the loop shut down
+        if _client is not None and not _client_loop.is_closed():
+            asyncio.run_coroutine_threadsafe(_client.aclose(), _client_loop)
+        _client = build_http_client()
+        _client_loop = loop
+        closer = loop.create_task(_close_on_shutdown(_client))
+        _closers.add(closer)
+        closer.add_done_callback(_closers.discard)
+    return _client
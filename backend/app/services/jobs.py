@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import secrets
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+from ..utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+class Job:
+    """A background computation the client can poll by id"""
+
+    __slots__ = ("id", "key", "status", "result", "error", "created_at", "finished_at", "_task")
+
+    def __init__(self, key: Optional[Hashable] = None):
+        self.id = secrets.token_urlsafe(16)
+        self.key = key
+        self.status = PENDING
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+    async def wait(self, timeout: Optional[float] = None):
+        """Wait for the job to finish without cancelling it on timeout"""
+        if self._task is not None and not self.finished:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+        }
+
+class JobManager:
+    """Runs coroutines as background tasks and keeps their outcome for polling"""
+
+    def __init__(self, max_size: int = 1000, ttl: float = 60 * 60):
+        self._jobs = TTLCache(max_size=max_size, ttl=ttl)
+        self._by_key = TTLCache(max_size=max_size, ttl=ttl)
+
+    def submit(self, fn: Callable[[], Awaitable[Any]], key: Optional[Hashable] = None) -> Job:
+        """Start `fn` in the background, reusing a job already submitted for the same key"""
+        if key is not None:
+            existing = self.get(self._by_key.get(key))
+            if existing is not None and existing.status != FAILED:
+                return existing
+
+        job = Job(key)
+        job._task = asyncio.ensure_future(self._run(job, fn))
+        self._jobs.set(job.id, job)
+        if key is not None:
+            self._by_key.set(key, job.id)
+        return job
+
+    async def _run(self, job: Job, fn: Callable[[], Awaitable[Any]]):
+        job.status = RUNNING
+        try:
+            job.result = await fn()
+            job.status = DONE
+        except Exception as e:
+            logger.warning("Background job %s failed: %s", job.id, e)
+            job.error = str(e)
+            job.status = FAILED
+        finally:
+            job.finished_at = time.time()
+
+    def get(self, job_id: Optional[str]) -> Optional[Job]:
+        if job_id is None:
+            return None
+        return self._jobs.get(job_id)
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+# Training-plan generation runs here so /training/volume never waits on the model
+plan_jobs = JobManager()
+
+# Stream fetches left over by /training/zones fill the cache here, at the rate-limit budget's pace
+stream_jobs = JobManager()
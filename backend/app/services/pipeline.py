@@ -0,0 +1,166 @@
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+import numpy as np
+from .analysis import (
+    ActivityColumns, ActivitiesInput, to_columns, concat_columns, period_keys, period_labels, volume_rows
+)
+from ..models.activity import Activity
+
+# Sports the training endpoints can be asked about, by Strava activity type
+SPORTS = ("Run", "Ride", "TrailRun", "VirtualRun")
+
+class Aggregator(ABC):
+    """Consumes chunks of activity columns and produces one result"""
+
+    @abstractmethod
+    def update(self, columns: ActivityColumns):
+        ...
+
+    @abstractmethod
+    def result(self) -> Any:
+        ...
+
+class VolumeAggregator(Aggregator):
+    """Per-period activity count, distance and moving time, newest period first"""
+
+    def __init__(self, period: str, label: str, limit: Optional[int] = None):
+        self.period = period
+        self.label = label
+        self.limit = limit
+        # period key -> [activities, distance m, moving time s]
+        self._buckets: Dict[int, List[float]] = {}
+
+    def update(self, columns: ActivityColumns):
+        if len(columns.start) == 0:
+            return
+        keys, inverse = np.unique(period_keys(columns.start, self.period), return_inverse=True)
+        runs = np.bincount(inverse, minlength=len(keys))
+        distance = np.bincount(inverse, weights=columns.distance, minlength=len(keys))
+        moving_time = np.bincount(inverse, weights=columns.moving_time, minlength=len(keys))
+        for i, key in enumerate(keys.tolist()):
+            bucket = self._buckets.setdefault(key, [0, 0.0, 0.0])
+            bucket[0] += int(runs[i])
+            bucket[1] += distance[i]
+            bucket[2] += moving_time[i]
+
+    def result(self) -> List[Dict[str, Any]]:
+        keys = sorted(self._buckets, reverse=True)[:self.limit]
+        sums = [self._buckets[key] for key in keys]
+        return volume_rows(period_labels(np.array(keys, dtype=np.int64), self.period), self.label,
+                           [s[0] for s in sums], [s[1] for s in sums], [s[2] for s in sums])
+
+class CountAggregator(Aggregator):
+    def __init__(self):
+        self.count = 0
+
+    def update(self, columns: ActivityColumns):
+        self.count += len(columns.start)
+
+    def result(self) -> int:
+        return self.count
+
+class RecentAggregator(Aggregator):
+    """The newest `limit` activities as columns, newest first"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._columns = to_columns([])
+
+    def update(self, columns: ActivityColumns):
+        merged = concat_columns(self._columns, columns)
+        newest_first = np.argsort(-merged.start, kind="stable")[:self.limit]
+        self._columns = ActivityColumns(*(field[newest_first] for field in merged))
+
+    def result(self) -> ActivityColumns:
+        return self._columns
+
+class PaceAggregator(Aggregator):
+    """Totals and average/best pace of the activities seen"""
+
+    def __init__(self):
+        self.activities = 0
+        self.distance = 0.0
+        self.moving_time = 0.0
+        self._paced = 0
+        self._pace_sum = 0.0
+        self._best_pace: Optional[float] = None
+
+    def update(self, columns: ActivityColumns):
+        self.activities += len(columns.start)
+        self.distance += float(columns.distance.sum())
+        self.moving_time += float(columns.moving_time.sum())
+
+        moved = columns.distance > 0
+        if moved.any():
+            paces = columns.moving_time[moved] / (columns.distance[moved] / 1000)  # seconds per km
+            self._paced += int(moved.sum())
+            self._pace_sum += float(paces.sum())
+            best = float(paces.min())
+            self._best_pace = best if self._best_pace is None else min(self._best_pace, best)
+
+    def result(self) -> Dict[str, Any]:
+        return {
+            "activities": self.activities,
+            "distance_km": self.distance / 1000,
+            "time_minutes": self.moving_time / 60,
+            "avg_pace_min_km": self._pace_sum / self._paced / 60 if self._paced else None,
+            "best_pace_min_km": self._best_pace / 60 if self._best_pace is not None else None,
+        }
+
+class Pipeline:
+    """source → filter → project → aggregators, every aggregator fed in the same pass
+
+    Filters are pushed down to the activity store's indexed query when the pipeline
+    runs against it; activities fed directly are filtered before being projected
+    to columns.
+    """
+
+    def __init__(self, types: Optional[Iterable[str]] = None, start: Optional[int] = None,
+                 end: Optional[int] = None):
+        self.types = set(types) if types is not None else None
+        self.start = start
+        self.end = end
+        self.aggregators: Dict[str, Aggregator] = {}
+
+    def aggregate(self, **aggregators: Aggregator) -> "Pipeline":
+        """Add named consumers, their results are returned under the same names"""
+        self.aggregators.update(aggregators)
+        return self
+
+    def _keep(self, activity: Activity) -> bool:
+        return ((self.types is None or activity.type in self.types)
+                and (self.start is None or activity.start >= self.start)
+                and (self.end is None or activity.start < self.end))
+
+    def _update(self, columns: ActivityColumns):
+        for aggregator in self.aggregators.values():
+            aggregator.update(columns)
+
+    def feed(self, activities: ActivitiesInput) -> "Pipeline":
+        """Filter, project and aggregate a batch of activities, e.g. a page as it arrives
+
+        Columns carry no activity type, they must already be of the pipeline's types.
+        """
+        if isinstance(activities, ActivityColumns):
+            selected = np.ones(len(activities.start), dtype=bool)
+            if self.start is not None:
+                selected &= activities.start >= self.start
+            if self.end is not None:
+                selected &= activities.start < self.end
+            self._update(ActivityColumns(*(field[selected] for field in activities)))
+        else:
+            self._update(to_columns([act for act in map(Activity.coerce, activities) if self._keep(act)]))
+        return self
+
+    def run(self, chunks: Iterator[ActivityColumns]) -> Dict[str, Any]:
+        """Feed already filtered column chunks and return every aggregator's result"""
+        for columns in chunks:
+            self._update(columns)
+        return self.results()
+
+    def run_store(self, store, athlete_key: str, limit: Optional[int] = None) -> Dict[str, Any]:
+        """Run over an athlete's stored activities, newest first, with the filter pushed into the query"""
+        return self.run(store.iter_columns(athlete_key, self.start, self.end, self.types, limit))
+
+    def results(self) -> Dict[str, Any]:
+        return {name: aggregator.result() for name, aggregator in self.aggregators.items()}
@@ -0,0 +1,233 @@
+import time
+from typing import Any, Dict, List, Optional
+import numpy as np
+from .analysis import ActivitiesInput, to_columns
+
+DAY = 24 * 60 * 60
+
+# Exponentially weighted load time constants, in days
+ATL_DAYS = 7
+CTL_DAYS = 42
+# Days of history the planner reads, enough for CTL to settle
+HISTORY_DAYS = 84
+
+PLAN_WEEKS = 4
+# Weekly volume relative to the athlete's recent weeks, three build weeks then a recovery week
+BUILD_CYCLE = (1.0, 1.05, 1.10, 0.80)
+# A fatigued athlete starts with the recovery week
+RECOVERY_FIRST_CYCLE = (0.80, 1.0, 1.05, 1.10)
+# Long run growth per build week, and its share of the week it may not exceed
+LONG_RUN_GROWTH = 0.10
+LONG_RUN_MAX_SHARE = 0.40
+
+# Floors for athletes with little recent history, in km per week
+MIN_WEEKLY_KM = {"Run": 15.0, "TrailRun": 15.0, "VirtualRun": 15.0, "Ride": 60.0}
+# Threshold speed in m/s when the history cannot tell
+DEFAULT_THRESHOLD_SPEED = {"Run": 3.3, "TrailRun": 2.7, "VirtualRun": 3.3, "Ride": 8.3}
+
+# Speed range of each zone as a share of threshold speed
+PACE_ZONES = {
+    "recovery": (0.65, 0.75),
+    "easy": (0.75, 0.85),
+    "steady": (0.85, 0.93),
+    "threshold": (0.95, 1.02),
+    "interval": (1.05, 1.12),
+}
+
+# (weekday, session) of a plan week, Monday first
+WEEK_LAYOUT = (
+    ("Monday", "rest"),
+    ("Tuesday", "intervals"),
+    ("Wednesday", "easy"),
+    ("Thursday", "tempo"),
+    ("Friday", "rest"),
+    ("Saturday", "easy"),
+    ("Sunday", "long"),
+)
+# Share of the week's volume outside the long run
+SESSION_SHARES = {"intervals": 0.25, "tempo": 0.30, "easy": 0.225, "strides": 0.225, "rest": 0.0}
+# Lighter sessions replacing the hard ones in a recovery week
+RECOVERY_SESSIONS = {"intervals": "strides", "tempo": "easy"}
+
+# session -> (workout, effort, zone, reason)
+SESSIONS = {
+    "rest": ("Rest", "Rest", None, "Recovery is when the training turns into fitness"),
+    "easy": ("Easy {noun}", "Easy", "easy", "Aerobic volume at a conversational effort"),
+    "strides": ("Easy {noun} + Strides", "Easy", "easy", "Keeps the legs sharp in a lighter week, finish with 6x20s"),
+    "intervals": ("Intervals", "Hard", "interval", "5-6 x 3 min at interval pace, equal easy recovery between"),
+    "tempo": ("Tempo {noun}", "Moderate", "threshold", "20-30 min continuous at threshold pace"),
+    "long": ("Long {noun}", "Easy", "easy", "Builds endurance, the longest session of the week"),
+}
+
+def workout_noun(sport: str) -> str:
+    return "Ride" if sport == "Ride" else "Run"
+
+def epoch_day(timestamp: float) -> int:
+    return int(timestamp // DAY)
+
+def history_start(today: Optional[float] = None) -> int:
+    """Epoch seconds of the oldest activity the planner looks at"""
+    today = time.time() if today is None else today
+    return (epoch_day(today) - HISTORY_DAYS + 1) * DAY
+
+def threshold_speed(distance: np.ndarray, moving_time: np.ndarray, sport: str = "Run") -> float:
+    """Estimated threshold speed in m/s, from the fastest sustained efforts of at least 20 minutes"""
+    sustained = (moving_time >= 20 * 60) & (distance > 0)
+    if sustained.sum() >= 3:
+        return float(np.percentile(distance[sustained] / moving_time[sustained], 90))
+    moved = (moving_time > 0) & (distance > 0)
+    if moved.any():
+        # Mostly easy sessions, which are run at about 80% of threshold
+        return float(np.median(distance[moved] / moving_time[moved])) / 0.80
+    return DEFAULT_THRESHOLD_SPEED.get(sport, DEFAULT_THRESHOLD_SPEED["Run"])
+
+def daily_load(start: np.ndarray, distance: np.ndarray, moving_time: np.ndarray, threshold: float,
+               today: float, days: int = HISTORY_DAYS) -> np.ndarray:
+    """Training stress per day over the last `days` days, oldest first
+
+    Each session scores hours x intensity^2 x 100, intensity being its speed relative to threshold.
+    """
+    first_day = epoch_day(today) - days + 1
+    day_index = start // DAY - first_day
+    in_range = (day_index >= 0) & (day_index < days) & (moving_time > 0)
+    speed = np.divide(distance, moving_time, out=np.zeros_like(distance), where=moving_time > 0)
+    intensity = np.clip(speed / threshold, 0.5, 1.2)
+    stress = moving_time / 3600 * intensity ** 2 * 100
+    return np.bincount(day_index[in_range], weights=stress[in_range], minlength=days).astype(np.float64)
+
+def ewma(load: np.ndarray, time_constant: float) -> float:
+    """Exponentially weighted average of a daily series on its last day
+
+    Weights are normalized, so a history shorter than the time constant does not read as detraining.
+    """
+    if not len(load):
+        return 0.0
+    weights = (1 - 1 / time_constant) ** np.arange(len(load) - 1, -1, -1)
+    return float(load @ weights / weights.sum())
+
+def training_load(load: np.ndarray) -> Dict[str, float]:
+    """Acute and chronic load, their balance and how fast chronic load is rising per week"""
+    atl = ewma(load, ATL_DAYS)
+    ctl = ewma(load, CTL_DAYS)
+    ctl_week_ago = ewma(load[:-7], CTL_DAYS) if len(load) > 7 else 0.0
+    return {
+        "atl": round(atl, 1),
+        "ctl": round(ctl, 1),
+        "tsb": round(ctl - atl, 1),
+        "ramp_rate": round(ctl - ctl_week_ago, 1),
+    }
+
+def _pace(speed: float) -> str:
+    seconds = round(1000 / speed)
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+def format_speed(speed: float, sport: str) -> str:
+    """Pace per km for running, km/h for riding"""
+    return f"{speed * 3.6:.0f} km/h" if sport == "Ride" else f"{_pace(speed)}/km"
+
+def format_zone(low: float, high: float, sport: str) -> str:
+    if sport == "Ride":
+        return f"{low * 3.6:.0f}-{high * 3.6:.0f} km/h"
+    return f"{_pace(low)}-{_pace(high)}/km"
+
+def pace_zones(threshold: float, sport: str = "Run") -> Dict[str, str]:
+    return {zone: format_zone(threshold * low, threshold * high, sport) for zone, (low, high) in PACE_ZONES.items()}
+
+def plan_week(week_km: float, long_km: float, recovery: bool, week_start_day: int, zones: Dict[str, str],
+              sport: str) -> List[Dict[str, Any]]:
+    """Days of one plan week, the long run first and the rest of the volume shared between sessions"""
+    noun = workout_noun(sport)
+    sessions = [(weekday, RECOVERY_SESSIONS.get(session, session) if recovery else session)
+                for weekday, session in WEEK_LAYOUT]
+    shares = sum(SESSION_SHARES[session] for _, session in sessions if session != "long")
+    remaining = max(week_km - long_km, 0.0)
+
+    days = []
+    for offset, (weekday, session) in enumerate(sessions):
+        workout, effort, zone, reason = SESSIONS[session]
+        if session == "long":
+            distance = long_km
+        else:
+            distance = remaining * SESSION_SHARES[session] / shares if shares else 0.0
+        days.append({
+            "day": weekday,
+            "date": time.strftime("%Y-%m-%d", time.gmtime((week_start_day + offset) * DAY)),
+            "workout": workout.format(noun=noun),
+            "distance_km": round(distance, 1),
+            "effort": effort,
+            "pace": zones[zone] if zone else None,
+            "reason": reason,
+        })
+    return days
+
+def build_training_plan(activities: ActivitiesInput, sport: str = "Run", today: Optional[float] = None,
+                        weeks: int = PLAN_WEEKS, load: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+    """Periodized plan for the coming weeks from the athlete's load history, deterministic for a given day
+
+    `activities` are the athlete's sessions of `sport` over the last HISTORY_DAYS days, in any order.
+    `load` is the athlete's training load over their whole history (see AthleteSeries.training_load),
+    estimated from `activities` alone if not given.
+    """
+    today = time.time() if today is None else today
+    columns = to_columns(activities)
+    start, distance, moving_time = columns.start, columns.distance, columns.moving_time
+
+    threshold = threshold_speed(distance, moving_time, sport)
+    if load is None:
+        load = training_load(daily_load(start, distance, moving_time, threshold, today))
+    zones = pace_zones(threshold, sport)
+
+    # The last 4 weeks set the starting volume and long run
+    recent = start >= (epoch_day(today) - 27) * DAY
+    min_week_km = MIN_WEEKLY_KM.get(sport, MIN_WEEKLY_KM["Run"])
+    base_week_km = max(float(distance[recent].sum()) / 1000 / 4, min_week_km)
+    longest_km = float(distance[recent].max()) / 1000 if recent.any() else 0.0
+    base_long_km = max(longest_km, base_week_km * 0.25)
+
+    fatigued = load["tsb"] < -0.3 * max(load["ctl"], 1.0)
+    cycle = RECOVERY_FIRST_CYCLE if fatigued else BUILD_CYCLE
+
+    # Plans start on the coming Monday, epoch day 0 was a Thursday
+    today_day = epoch_day(today)
+    first_day = today_day + (7 - (today_day + 3) % 7) % 7
+
+    plan_weeks: List[Dict[str, Any]] = []
+    long_km = base_long_km
+    for week in range(weeks):
+        factor = cycle[week % len(cycle)]
+        recovery = factor < 1.0
+        week_km = base_week_km * factor
+        if recovery:
+            week_long_km = long_km * 0.8
+        else:
+            if week:
+                long_km *= 1 + LONG_RUN_GROWTH
+            week_long_km = long_km
+        # Capped at a share of the week so the other sessions always keep some volume
+        week_long_km = min(week_long_km, week_km * LONG_RUN_MAX_SHARE)
+        days = plan_week(week_km, week_long_km, recovery, first_day + 7 * week, zones, sport)
+        plan_weeks.append({
+            "week": week + 1,
+            "week_of": days[0]["date"],
+            "phase": "recovery" if recovery else "build",
+            "distance_km": round(sum(day["distance_km"] for day in days), 1),
+            "long_run_km": round(week_long_km, 1),
+            "days": days,
+        })
+
+    if fatigued:
+        focus = "Absorbing recent load before building again"
+    elif load["ctl"] < 20:
+        focus = "Building an aerobic base"
+    else:
+        focus = "Progressive build with a recovery week every fourth week"
+    return {
+        "week_of": plan_weeks[0]["week_of"] if plan_weeks else None,
+        "days": plan_weeks[0]["days"] if plan_weeks else [],
+        "weeks": plan_weeks,
+        "load": load,
+        "pace_zones": zones,
+        "threshold": format_speed(threshold, sport),
+        "focus": focus,
+        "source": "planner",
+    }
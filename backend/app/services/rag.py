@@ -1,13 +1,44 @@
 import os
 import json
-import httpx
-from typing import List, Dict, Any
-from openai import OpenAI
+import hashlib
+import logging
+import time
+from typing import Optional, Tuple
+from .http import get_http_client
+from .analysis import ActivityColumns, ActivitiesInput, to_columns
+from .retrieval import training_index, format_context
+from ..utils.cache import TTLCache, SingleFlight
+from ..utils.metrics import INFERENCE_LATENCY
 
 # Hugging Face configuration - using a more reliable model
 HF_MODEL = "distilbert-base-uncased"
 HF_API_URL = f"https://api-inference.huggingface.co/models/{HF_MODEL}"
 
+logger = logging.getLogger(__name__)
+
+# Generated plans keyed by the fingerprint of their inputs
+plan_cache = TTLCache(
+    max_size=int(os.getenv("STRYDE_PLAN_CACHE_SIZE", "1000")),
+    ttl=float(os.getenv("STRYDE_PLAN_CACHE_TTL", str(6 * 60 * 60))),
+    name="plan",
+)
+plan_requests = SingleFlight()
+
+# How the prompt and summary refer to each sport: (plan, athlete, activities, sessions of a week)
+SPORT_WORDING = {
+    "Run": ("running", "runner", "runs", "easy runs, intervals, tempo runs, and a long run"),
+    "TrailRun": ("trail running", "trail runner", "trail runs",
+                 "easy trail runs, hill repeats, tempo runs, and a long trail run"),
+    "VirtualRun": ("treadmill running", "runner", "treadmill runs",
+                   "easy runs, intervals, tempo runs, and a long run"),
+    "Ride": ("cycling", "cyclist", "rides", "endurance rides, intervals, tempo rides, and a long ride"),
+}
+
+def count_activities(activities: ActivitiesInput) -> int:
+    if isinstance(activities, ActivityColumns):
+        return len(activities.start)
+    return len(activities)
+
 async def query_huggingface(prompt: str) -> str:
     """Send a prompt to the Hugging Face Inference API."""
     HF_TOKEN = os.getenv("STRYDE_HF_TOKEN")
@@ -17,12 +48,10 @@ async def query_huggingface(prompt: str) -> str:
     headers = {"Authorization": f"Bearer {HF_TOKEN}"}
     payload = {"inputs": prompt}
 
-    async with httpx.AsyncClient(timeout=90.0) as client:
-        response = await client.post(HF_API_URL, headers=headers, json=payload)
+    client = get_http_client()
+    response = await client.post(HF_API_URL, headers=headers, json=payload, timeout=90.0)
 
-    print(f"DEBUG: HF response status: {response.status_code}")
-    print(f"DEBUG: HF response headers: {dict(response.headers)}")
-    print(f"DEBUG: HF response text: {response.text[:500]}...")
+    logger.debug("Hugging Face response: %s, %d bytes", response.status_code, len(response.content))
 
     # Parse response safely
     try:
@@ -30,7 +59,6 @@ async def query_huggingface(prompt: str) -> str:
             raise RuntimeError(f"Hugging Face API returned status {response.status_code}: {response.text}")
         
         data = response.json()
-        print(f"DEBUG: HF parsed data: {data}")
         
         if isinstance(data, list) and len(data) > 0 and "generated_text" in data[0]:
             return data[0]["generated_text"].strip()
@@ -39,97 +67,148 @@ async def query_huggingface(prompt: str) -> str:
         else:
             return str(data)
     except json.JSONDecodeError as e:
-        print(f"DEBUG: JSON decode error: {e}")
-        print(f"DEBUG: Raw response: {response.text}")
         raise RuntimeError(f"Error parsing Hugging Face response: {e}. Raw response: {response.text}")
     except Exception as e:
         raise RuntimeError(f"Error parsing Hugging Face response: {e}")
 
-def generate_simple_training_plan(avg_distance: float, weekly_volume: float, historical_summary: str) -> dict:
-    """Generate a simple training plan without external APIs"""
-    # Calculate appropriate distances based on current fitness
-    base_distance = max(3.0, avg_distance * 0.8)  # Slightly less than average
-    long_run_distance = max(5.0, avg_distance * 1.5)  # Longer than average
-    interval_distance = max(2.0, avg_distance * 0.6)  # Shorter, faster
+def summarize_recent_training(running_activities: ActivitiesInput, total_activities: Optional[int] = None,
+                              sport: str = "Run") -> Tuple[float, float, str]:
+    """Average distance, weekly volume and a text summary of the last 2 weeks
+
+    `running_activities` must be newest first, `total_activities` defaults to its length.
+    """
+    # Analyze recent training patterns (last 2 weeks)
+    if isinstance(running_activities, ActivityColumns):
+        recent = ActivityColumns(*(field[:14] for field in running_activities))
+    else:
+        recent = to_columns(running_activities[:14])
+    recent_count = len(recent.start)
     
-    return {
-        "week_plan": [
-            {"day": "Monday", "workout": "Easy Run", "distance": f"{base_distance:.1f}km", "effort": "Easy", "notes": "Recovery pace"},
-            {"day": "Tuesday", "workout": "Interval Training", "distance": f"{interval_distance:.1f}km", "effort": "Hard", "notes": "5x800m at 5K pace"},
-            {"day": "Wednesday", "workout": "Rest", "distance": "0km", "effort": "Rest", "notes": "Active recovery or complete rest"},
-            {"day": "Thursday", "workout": "Easy Run", "distance": f"{base_distance:.1f}km", "effort": "Easy", "notes": "Conversational pace"},
-            {"day": "Friday", "workout": "Tempo Run", "distance": f"{base_distance:.1f}km", "effort": "Moderate", "notes": "20 min at half marathon pace"},
-            {"day": "Saturday", "workout": "Long Run", "distance": f"{long_run_distance:.1f}km", "effort": "Easy", "notes": "Build endurance"},
-            {"day": "Sunday", "workout": "Easy Run", "distance": f"{base_distance:.1f}km", "effort": "Easy", "notes": "Recovery run"}
-        ],
-        "weekly_total": f"{weekly_volume:.1f}km",
-        "focus": "Building base fitness and endurance",
-        "progression": "Gradually increase long run distance by 1-2km weekly",
-        "source": "Generated based on your training data"
-    }
-
-async def generate_training_recommendations(running_activities: List[Dict[str, Any]]):
-    """Generate personalized training calendar using Hugging Face AI"""
-    print(f"DEBUG: RAG service called with {len(running_activities)} activities")
+    # Create training summary
+    total_distance = float(recent.distance.sum()) / 1000
+    total_time = float(recent.moving_time.sum()) / 60
     
-    if not running_activities:
-        print("DEBUG: No running activities provided")
-        return {"error": "No training data available"}
+    # Calculate averages for prompt
+    avg_distance = total_distance / recent_count if recent_count else 0
+    weekly_volume = total_distance / 2  # 2 weeks of data
+    
+    # Create historical context from all activities
+    if total_activities is None:
+        total_activities = count_activities(running_activities)
+    noun = SPORT_WORDING.get(sport, SPORT_WORDING["Run"])[2]
+    historical_summary = f"Total activities: {total_activities} {noun}\n"
+    historical_summary += (f"Recent 2 weeks: {recent_count} {noun}, "
+                           f"{total_distance:.1f}km, {total_time:.1f} minutes\n")
+    
+    # Add pace analysis
+    moved = recent.distance > 0
+    if moved.any():
+        avg_pace_min_km = float((recent.moving_time[moved] / (recent.distance[moved] / 1000)).mean())
+        historical_summary += f"Average pace: {avg_pace_min_km:.1f} min/km\n"
     
+    return avg_distance, weekly_volume, historical_summary
+
+def retrieval_context(athlete_key: Optional[str], sport: str = "Run") -> str:
+    """Prompt lines retrieved from the athlete's indexed history and the workout library"""
+    if athlete_key is None:
+        return ""
+    return format_context(training_index.context(athlete_key, sport))
+
+def plan_fingerprint(avg_distance: float, weekly_volume: float, historical_summary: str,
+                     sport: str = "Run", context: str = "") -> str:
+    """Cache key for a plan, it only changes when the athlete's recent training does"""
+    key = f"{HF_MODEL}|{sport}|{avg_distance:.3f}|{weekly_volume:.3f}|{historical_summary}|{context}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+async def generate_plan(avg_distance: float, weekly_volume: float, historical_summary: str,
+                        sport: str = "Run", context: str = "") -> Optional[dict]:
+    """Ask Hugging Face for a plan, None if it fails
+
+    A reply that is not JSON is kept as free-text notes.
+    """
+    plan_name, athlete, noun, sessions = SPORT_WORDING.get(sport, SPORT_WORDING["Run"])
+    retrieved = f"\nRelevant history and workouts:\n{context}\n" if context else ""
+    
+    prompt = (
+        f"Create a 7-day {plan_name} training plan for a {athlete} who averages {avg_distance:.1f}km per activity "
+        f"and covers {weekly_volume:.1f}km per week across {noun}. \n\n"
+        f"Recent training: {historical_summary}{retrieved}\n\n"
+        f"Generate a structured weekly plan with {sessions}. Include rest days and progression. "
+        "Format as JSON with day, workout type, distance, and effort level."
+    )
+    
+    started = time.perf_counter()
     try:
-        # Analyze recent training patterns (last 2 weeks)
-        recent_activities = running_activities[:14]
-        
-        # Create training summary
-        total_distance = sum(act.get("distance", 0) for act in recent_activities) / 1000
-        total_time = sum(act.get("moving_time", 0) for act in recent_activities) / 60
-        
-        # Calculate averages for prompt
-        avg_distance = total_distance / len(recent_activities) if recent_activities else 0
-        weekly_volume = total_distance / 2  # 2 weeks of data
-        
-        # Create historical context from all activities
-        historical_summary = f"Total activities: {len(running_activities)} runs\n"
-        historical_summary += (f"Recent 2 weeks: {len(recent_activities)} runs, "
-                               f"{total_distance:.1f}km, {total_time:.1f} minutes\n")
-        
-        # Add pace analysis
-        paces = [act.get("moving_time", 0) / (act.get("distance", 1) / 1000)
-                 for act in recent_activities if act.get("distance", 0) > 0]
-        if paces:
-            avg_pace_min_km = sum(paces) / len(paces)
-            historical_summary += f"Average pace: {avg_pace_min_km:.1f} min/km\n"
-        
-        # Generate recommendations using Hugging Face (with fallback)
-        print(f"DEBUG: Creating Hugging Face prompt...")
-        
-        prompt = f"""Create a 7-day running training plan for a runner who averages {avg_distance:.1f}km per run and runs {weekly_volume:.1f}km per week. 
+        plan_text = await query_huggingface(prompt)
+    except Exception as hf_error:
+        INFERENCE_LATENCY.observe(time.perf_counter() - started, outcome="error")
+        logger.warning("Hugging Face API failed: %s", hf_error)
+        return None
+    elapsed = time.perf_counter() - started
+    
+    try:
+        recommendations = json.loads(plan_text)
+    except json.JSONDecodeError as e:
+        INFERENCE_LATENCY.observe(elapsed, outcome="unparsed")
+        logger.info("Hugging Face response is not a JSON plan: %s", e)
+        return {"notes": plan_text}
+    INFERENCE_LATENCY.observe(elapsed, outcome="success")
+    return recommendations
+
+def get_cached_training_recommendations(running_activities: ActivitiesInput, total_activities: Optional[int] = None,
+                                        sport: str = "Run", athlete_key: Optional[str] = None) -> Optional[dict]:
+    """Return the plan for these activities if it is already known, without calling the model"""
+    if not count_activities(running_activities):
+        return {"error": "No training data available"}
+    summary = summarize_recent_training(running_activities, total_activities, sport)
+    return plan_cache.get(plan_fingerprint(*summary, sport, retrieval_context(athlete_key, sport)))
 
-Recent training: {historical_summary}
+async def generate_training_recommendations(running_activities: ActivitiesInput,
+                                            total_activities: Optional[int] = None, sport: str = "Run",
+                                            athlete_key: Optional[str] = None):
+    """Ask the model for recommendations, memoized on the training summary, None if it failed
 
-Generate a structured weekly plan with easy runs, intervals, tempo runs, and a long run. Include rest days and progression. Format as JSON with day, workout type, distance, and effort level."""
+    With `athlete_key`, context retrieved from the athlete's indexed history goes into the prompt.
+    """
+    if not count_activities(running_activities):
+        return {"error": "No training data available"}
+    
+    try:
+        avg_distance, weekly_volume, historical_summary = summarize_recent_training(running_activities,
+                                                                                    total_activities, sport)
+        context = retrieval_context(athlete_key, sport)
         
-        try:
-            print(f"DEBUG: Making API call to Hugging Face...")
-            plan_text = await query_huggingface(prompt)
-            
-            print(f"DEBUG: Hugging Face API call successful!")
-            print(f"DEBUG: Response received: {len(plan_text)} characters")
-            
-            try:
-                recommendations = json.loads(plan_text)
-                print(f"DEBUG: Successfully parsed JSON response")
-                return recommendations
-            except json.JSONDecodeError as e:
-                print(f"DEBUG: JSON parsing failed: {e}")
-                return {"error": "Failed to generate recommendations", "raw_response": plan_text}
-        except Exception as hf_error:
-            print(f"DEBUG: Hugging Face API failed: {hf_error}")
-            print(f"DEBUG: Falling back to simple training plan...")
-            
-            # Fallback: Generate a simple training plan
-            return generate_simple_training_plan(avg_distance, weekly_volume, historical_summary)
+        fingerprint = plan_fingerprint(avg_distance, weekly_volume, historical_summary, sport, context)
+        cached_plan = plan_cache.get(fingerprint)
+        if cached_plan is not None:
+            return cached_plan
+        
+        # Concurrent requests for the same inputs share one inference call
+        plan = await plan_requests.do(
+            fingerprint, lambda: generate_plan(avg_distance, weekly_volume, historical_summary, sport, context)
+        )
+        if plan is not None:
+            plan_cache.set(fingerprint, plan)
+        return plan
     
     except Exception as e:
-        print(f"DEBUG: Exception occurred: {type(e).__name__}: {str(e)}")
+        logger.exception("Training recommendations failed")
         return {"error": f"AI system error: {str(e)}"}
+
+def plan_enrichment_enabled() -> bool:
+    """Whether local plans are sent to the model for enrichment, off unless STRYDE_PLAN_ENRICHMENT is set"""
+    return os.getenv("STRYDE_PLAN_ENRICHMENT", "false").lower() in ("1", "true", "yes")
+
+def enrich_plan(plan: dict, recommendations: Optional[dict]) -> dict:
+    """The local plan with the model's recommendations attached, unchanged if there are none"""
+    if not recommendations or "error" in recommendations:
+        return plan
+    return {**plan, "enrichment": recommendations, "source": "planner+model"}
+
+async def enrich_training_plan(plan: dict, running_activities: ActivitiesInput,
+                               total_activities: Optional[int] = None, sport: str = "Run",
+                               athlete_key: Optional[str] = None) -> dict:
+    """Attach the model's recommendations to a plan from the local planner, meant to run in the background"""
+    recommendations = await generate_training_recommendations(running_activities, total_activities, sport,
+                                                              athlete_key)
+    return enrich_plan(plan, recommendations)
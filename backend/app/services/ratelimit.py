@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import time
+from typing import Mapping, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SHORT_WINDOW_SECONDS = 15 * 60
+DAY_SECONDS = 24 * 60 * 60
+
+class StravaRateLimitError(Exception):
+    """Raised when Strava's rate-limit budget is exhausted for longer than we are willing to wait"""
+
+def _parse_pair(value: Optional[str]) -> Optional[Tuple[int, int]]:
+    """Parse a Strava "15-minute,daily" header value"""
+    if not value:
+        return None
+    try:
+        short, daily = value.split(",")[:2]
+        return int(short), int(daily)
+    except ValueError:
+        return None
+
+def _seconds_until_window_reset(now: float) -> float:
+    """Strava's short window resets at :00, :15, :30 and :45 of every hour"""
+    return SHORT_WINDOW_SECONDS - (now % SHORT_WINDOW_SECONDS)
+
+def _seconds_until_day_reset(now: float) -> float:
+    """Strava's daily window resets at midnight UTC"""
+    return DAY_SECONDS - (now % DAY_SECONDS)
+
+class StravaRateLimiter:
+    """Process-wide view of Strava's rate-limit budget, built from X-RateLimit-* response headers"""
+
+    def __init__(self, slowdown_ratio: float = 0.8, stop_ratio: float = 0.95, max_wait: float = 30.0):
+        self.slowdown_ratio = slowdown_ratio
+        self.stop_ratio = stop_ratio
+        self.max_wait = max_wait
+        self.limit: Optional[Tuple[int, int]] = None
+        self.usage: Tuple[int, int] = (0, 0)
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.updated_at = 0.0
+
+    def _current_usage(self, now: float) -> Tuple[int, int]:
+        """Usage as last reported, reset if the window it was reported in has rolled over"""
+        short, daily = self.usage
+        if now // SHORT_WINDOW_SECONDS != self.updated_at // SHORT_WINDOW_SECONDS:
+            short = 0
+        if now // DAY_SECONDS != self.updated_at // DAY_SECONDS:
+            daily = 0
+        return short, daily
+
+    def remaining(self, now: Optional[float] = None) -> Optional[int]:
+        """Requests left in the short window, counting requests already in flight"""
+        if self.limit is None:
+            return None
+        now = time.time() if now is None else now
+        short, daily = self._current_usage(now)
+        return max(0, min(self.limit[0] - short, self.limit[1] - daily) - self.in_flight)
+
+    def delay(self, now: Optional[float] = None) -> float:
+        """Seconds to wait before the next request to stay under the budget"""
+        now = time.time() if now is None else now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.limit is None:
+            return 0.0
+
+        short, daily = self._current_usage(now)
+        short_used = short + self.in_flight
+        daily_used = daily + self.in_flight
+        if daily_used >= self.limit[1] * self.stop_ratio:
+            return _seconds_until_day_reset(now)
+        if short_used >= self.limit[0] * self.stop_ratio:
+            return _seconds_until_window_reset(now)
+        if short_used >= self.limit[0] * self.slowdown_ratio:
+            # Spread what is left of the budget over what is left of the window
+            budget_left = self.limit[0] * self.stop_ratio - short_used
+            return _seconds_until_window_reset(now) / max(budget_left, 1)
+        return 0.0
+
+    def allowed_concurrency(self, requested: int) -> int:
+        """Shrink a batch of concurrent requests to what the budget can absorb"""
+        remaining = self.remaining()
+        if remaining is None:
+            return requested
+        headroom = remaining - round(self.limit[0] * (1 - self.stop_ratio))
+        return max(1, min(requested, headroom))
+
+    async def acquire(self):
+        """Wait until a request may be sent and reserve a slot for it"""
+        wait = self.delay()
+        if wait > self.max_wait:
+            raise StravaRateLimitError(f"Strava rate limit reached, retry in {wait:.0f}s")
+        if wait > 0:
+            logger.info("Slowing down Strava requests by %.1fs to stay under the rate limit", wait)
+            await asyncio.sleep(wait)
+        self.in_flight += 1
+
+    def release(self, headers: Optional[Mapping[str, str]] = None, status_code: Optional[int] = None):
+        """Free a reserved slot and record the budget reported by the response"""
+        self.in_flight = max(0, self.in_flight - 1)
+        if headers is None:
+            return
+
+        now = time.time()
+        limit = _parse_pair(headers.get("X-RateLimit-Limit"))
+        usage = _parse_pair(headers.get("X-RateLimit-Usage"))
+        if limit and usage:
+            self.limit = limit
+            self.usage = usage
+            self.updated_at = now
+        if status_code == 429:
+            self.blocked_until = now + _seconds_until_window_reset(now)
+
+# Shared by every athlete's requests in this process
+strava_rate_limiter = StravaRateLimiter()
@@ -0,0 +1,271 @@
+import re
+import threading
+import zlib
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+import numpy as np
+from .activity_store import activity_store, ActivityStore
+from .analysis import SECONDS_PER_DAY, period_keys, period_labels
+from ..utils.cache import TTLCache
+
+# Width of the hashed feature vectors
+EMBEDDING_DIM = 512
+
+# How much context goes into a prompt
+CONTEXT_WEEKS = 3
+CONTEXT_TEMPLATES = 3
+MAX_CONTEXT_CHARS = 1200
+
+_TOKEN = re.compile(r"[a-z0-9:+.\-]+")
+
+def tokenize(text: str) -> List[str]:
+    """Lower-case words and feature tokens, plus word bigrams"""
+    words = _TOKEN.findall(text.lower())
+    return words + [f"{a}_{b}" for a, b in zip(words, words[1:])]
+
+def embed(tokens: Iterable[str], dim: int = EMBEDDING_DIM) -> np.ndarray:
+    """Unit vector of signed hashed token counts, stable across processes unlike hash()"""
+    vector = np.zeros(dim, dtype=np.float32)
+    for token in tokens:
+        hashed = zlib.crc32(token.encode())
+        vector[hashed % dim] += 1.0 if hashed & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+class VectorIndex:
+    """Unit vectors in a NumPy matrix with cosine top-k search
+
+    Entries are upserted by key, so a week that gets new activities replaces its
+    own row. The matrix grows by doubling and deletes swap in the last row.
+    """
+
+    def __init__(self, dim: int = EMBEDDING_DIM, capacity: int = 64):
+        self.dim = dim
+        self._matrix = np.zeros((capacity, dim), dtype=np.float32)
+        self._keys: List[Hashable] = []
+        self._payloads: List[Any] = []
+        self._rows: Dict[Hashable, int] = {}
+
+    def upsert(self, key: Hashable, vector: np.ndarray, payload: Any):
+        row = self._rows.get(key)
+        if row is None:
+            row = len(self._keys)
+            if row == len(self._matrix):
+                self._matrix = np.concatenate([self._matrix, np.zeros_like(self._matrix)])
+            self._keys.append(key)
+            self._payloads.append(payload)
+            self._rows[key] = row
+        self._matrix[row] = vector
+        self._payloads[row] = payload
+
+    def delete(self, key: Hashable):
+        row = self._rows.pop(key, None)
+        if row is None:
+            return
+        last = len(self._keys) - 1
+        if row != last:
+            self._matrix[row] = self._matrix[last]
+            self._keys[row] = self._keys[last]
+            self._payloads[row] = self._payloads[last]
+            self._rows[self._keys[row]] = row
+        self._keys.pop()
+        self._payloads.pop()
+
+    def get(self, key: Hashable) -> Any:
+        row = self._rows.get(key)
+        return None if row is None else self._payloads[row]
+
+    def search(self, query: np.ndarray, k: int, exclude: Iterable[Hashable] = ()) -> List[Tuple[float, Any]]:
+        """The `k` payloads most similar to `query`, best first"""
+        count = len(self._keys)
+        if not count or k <= 0:
+            return []
+        scores = self._matrix[:count] @ query
+        for key in exclude:
+            if key in self._rows:
+                scores[self._rows[key]] = -np.inf
+        k = min(k, count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(float(scores[row]), self._payloads[row]) for row in top if np.isfinite(scores[row])]
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._rows
+
+# Weekly volume (km) bounds of "low", "moderate", "high" and above, per sport
+VOLUME_BOUNDS = {"Ride": (60, 150, 250)}
+DEFAULT_VOLUME_BOUNDS = (15, 35, 60)
+VOLUME_LEVELS = ("low", "moderate", "high", "very-high")
+
+def week_features(sport: str, sessions: int, distance_km: float, long_km: float,
+                  previous_km: Optional[float]) -> List[str]:
+    """Feature tokens of a training week, shared vocabulary with the workout templates"""
+    bounds = VOLUME_BOUNDS.get(sport, DEFAULT_VOLUME_BOUNDS)
+    features = [
+        f"sport:{sport.lower()}",
+        f"volume:{VOLUME_LEVELS[int(np.searchsorted(bounds, distance_km, side='right'))]}",
+        f"sessions:{min(sessions, 6)}",
+    ]
+    long_share = long_km / distance_km if distance_km else 0.0
+    features.append("long:dominant" if long_share >= 0.45 else "long:balanced" if long_share >= 0.25 else "long:short")
+    if not previous_km:
+        features.append("trend:break")
+    elif distance_km > previous_km * 1.1:
+        features.append("trend:rising")
+    elif distance_km < previous_km * 0.8:
+        features.append("trend:falling")
+    else:
+        features.append("trend:steady")
+    return features
+
+# Workouts the prompt can draw on, matched to a week through the same feature tokens
+WORKOUT_TEMPLATES = [
+    {"id": "base-building", "sports": ("Run", "TrailRun", "VirtualRun", "Ride"),
+     "features": "volume:low volume:moderate trend:steady trend:rising long:balanced sessions:3 sessions:4",
+     "text": "Base building: keep 80% of sessions easy and add at most 10% volume per week."},
+    {"id": "return-from-break", "sports": ("Run", "TrailRun", "VirtualRun", "Ride"),
+     "features": "trend:break volume:low sessions:1 sessions:2 long:short",
+     "text": "Return after a break: short easy sessions on alternate days for two weeks before any intensity."},
+    {"id": "consistency", "sports": ("Run", "TrailRun", "VirtualRun", "Ride"),
+     "features": "trend:falling sessions:1 sessions:2 long:dominant",
+     "text": "Consistency first: spread the volume over more, shorter sessions instead of one big day."},
+    {"id": "recovery-week", "sports": ("Run", "TrailRun", "VirtualRun", "Ride"),
+     "features": "trend:rising volume:high volume:very-high sessions:5 sessions:6",
+     "text": "Recovery week: cut volume by 20-30%, drop the intervals and keep a few strides."},
+    {"id": "long-run-progression", "sports": ("Run", "TrailRun", "VirtualRun"),
+     "features": "long:short long:balanced trend:steady volume:moderate sessions:3 sessions:4",
+     "text": "Long run progression: extend the long run by 1-2 km a week, up to a third of weekly volume."},
+    {"id": "threshold-intervals", "sports": ("Run", "TrailRun", "VirtualRun"),
+     "features": "volume:moderate volume:high trend:steady sessions:4 sessions:5",
+     "text": "Threshold intervals: 3-4 x 8 min at threshold pace with 2 min jog recoveries."},
+    {"id": "vo2max-intervals", "sports": ("Run", "VirtualRun"),
+     "features": "volume:high volume:very-high trend:steady sessions:5 sessions:6",
+     "text": "VO2max intervals: 5 x 3 min at 5K pace with equal jog recoveries, once a week at most."},
+    {"id": "hill-repeats", "sports": ("Run", "TrailRun"),
+     "features": "sport:trailrun volume:moderate volume:high trend:steady sessions:3 sessions:4",
+     "text": "Hill repeats: 6-8 x 60-90 s uphill at a hard effort, walk or jog down to recover."},
+    {"id": "taper", "sports": ("Run", "TrailRun", "VirtualRun", "Ride"),
+     "features": "trend:falling volume:high volume:very-high long:balanced",
+     "text": "Taper: reduce volume 40-60% over two weeks while keeping short race-pace efforts."},
+    {"id": "endurance-ride", "sports": ("Ride",),
+     "features": "sport:ride volume:low volume:moderate long:dominant long:balanced trend:steady",
+     "text": "Endurance ride: a long zone 2 ride, fuelled from the first hour, growing 15-30 min a week."},
+    {"id": "sweet-spot", "sports": ("Ride",),
+     "features": "sport:ride volume:moderate volume:high sessions:3 sessions:4 trend:steady",
+     "text": "Sweet spot: 2-3 x 15 min at 88-94% of FTP with 5 min easy spinning between."},
+]
+
+def format_week(sport: str, week_start: str, sessions: int, distance_km: float, moving_h: float,
+                long_km: float) -> str:
+    noun = "ride" if sport == "Ride" else "run"
+    noun += "" if sessions == 1 else "s"
+    pace = f", avg {moving_h * 60 / distance_km:.2f} min/km" if distance_km and sport != "Ride" else ""
+    return (f"Week of {week_start}: {sessions} {noun}, {distance_km:.1f} km in {moving_h:.1f} h, "
+            f"longest {long_km:.1f} km{pace}")
+
+class AthleteHistory:
+    """One athlete's weekly summaries of one sport, indexed for retrieval"""
+
+    def __init__(self):
+        self.index = VectorIndex()
+        self.version: Optional[int] = None
+        # week key -> rollup sums the entry was built from
+        self.signatures: Dict[int, Tuple[int, float, float]] = {}
+
+class TrainingIndex:
+    """Retrieval over athletes' weekly training summaries and the workout template library
+
+    Weeks are re-embedded only when their rollup sums change, so keeping an
+    athlete's index current after a sync touches just the new or edited weeks.
+    """
+
+    def __init__(self, store: ActivityStore, max_athletes: int = 1000):
+        self.store = store
+        self._histories = TTLCache(max_size=max_athletes)
+        self._lock = threading.RLock()
+        self.templates = VectorIndex(capacity=len(WORKOUT_TEMPLATES))
+        for template in WORKOUT_TEMPLATES:
+            self.templates.upsert(template["id"], embed(tokenize(template["features"] + " " + template["text"])),
+                                  template)
+
+    def update(self, athlete_key: str, sport: str = "Run") -> AthleteHistory:
+        """Bring the athlete's week index in line with their stored activities"""
+        with self._lock:
+            history = self._histories.get((athlete_key, sport))
+            if history is None:
+                history = AthleteHistory()
+                self._histories.set((athlete_key, sport), history)
+            version = self.store.version(athlete_key)
+            if history.version == version:
+                return history
+
+            buckets = self.store.ensure_rollups(athlete_key).sums(sport, "week")
+            deleted = [week for week in history.signatures if week not in buckets]
+            for week in deleted:
+                history.index.delete(week)
+                del history.signatures[week]
+
+            changed = {week for week, sums in buckets.items() if history.signatures.get(week) != sums}
+            # A week's trend feature depends on the week before it, which may also have been emptied
+            changed |= {week + 7 for week in changed.union(deleted) if week + 7 in buckets}
+            if changed:
+                self._embed_weeks(athlete_key, sport, sorted(changed), buckets, history)
+            history.version = version
+            return history
+
+    def _embed_weeks(self, athlete_key: str, sport: str, weeks: List[int],
+                     buckets: Dict[int, Tuple[int, float, float]], history: AthleteHistory):
+        # One indexed query covers every changed week, for the longest session of each
+        columns = self.store.query_columns(athlete_key, start=weeks[0] * SECONDS_PER_DAY,
+                                           end=(weeks[-1] + 7) * SECONDS_PER_DAY, types=[sport])
+        week_of = period_keys(columns.start, "week")
+        labels = period_labels(np.array(weeks, dtype=np.int64), "week")
+        for week, label in zip(weeks, labels):
+            sessions, distance_m, moving_s = buckets[week]
+            in_week = week_of == week
+            long_km = float(columns.distance[in_week].max()) / 1000 if in_week.any() else 0.0
+            previous = buckets.get(week - 7)
+            features = week_features(sport, int(sessions), distance_m / 1000, long_km,
+                                     previous[1] / 1000 if previous else None)
+            text = format_week(sport, label, int(sessions), distance_m / 1000, moving_s / 3600, long_km)
+            history.index.upsert(week, embed(features), {"week": label, "text": text, "features": features})
+            history.signatures[week] = buckets[week]
+
+    def context(self, athlete_key: str, sport: str = "Run", weeks: int = CONTEXT_WEEKS,
+                templates: int = CONTEXT_TEMPLATES) -> Dict[str, Any]:
+        """The athlete's latest week, their past weeks most like it and the best matching templates"""
+        history = self.update(athlete_key, sport)
+        if not history.signatures:
+            return {"current": None, "similar_weeks": [], "templates": []}
+        latest = max(history.signatures)
+        current = history.index.get(latest)
+        query = embed(current["features"])
+
+        similar = history.index.search(query, weeks, exclude=[latest])
+        matches = self.templates.search(query, len(WORKOUT_TEMPLATES))
+        return {
+            "current": current,
+            "similar_weeks": [week for _, week in similar],
+            "templates": [template for _, template in matches if sport in template["sports"]][:templates],
+        }
+
+def format_context(context: Dict[str, Any], max_chars: int = MAX_CONTEXT_CHARS) -> str:
+    """Retrieved context as prompt lines, most relevant first, cut at whole lines to `max_chars`"""
+    lines = []
+    if context["current"]:
+        lines.append(f"This week: {context['current']['text']}")
+    lines += [f"Similar past week: {week['text']}" for week in context["similar_weeks"]]
+    lines += [f"Suggested workout: {template['text']}" for template in context["templates"]]
+
+    kept, size = [], 0
+    for line in lines:
+        if size + len(line) + 1 > max_chars:
+            break
+        kept.append(line)
+        size += len(line) + 1
+    return "\n".join(kept)
+
+# Shared by the recommendation service
+training_index = TrainingIndex(activity_store)
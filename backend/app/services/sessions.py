@@ -0,0 +1,177 @@
+import json
+import os
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional
+from ..utils.cache import TTLCache
+from ..utils.db import connect_sqlite
+from ..utils.helpers import get_data_path
+from ..utils.metrics import Gauge, registry
+
+# Sessions for OAuth flows that were started but never completed expire quickly
+PENDING_SESSION_TTL = 10 * 60
+# Seconds between writes of a SQLite session's last access, reads in between only read
+ACCESS_WRITE_INTERVAL = 60
+
+def athlete_session_key(athlete_id: Any) -> str:
+    """Session key under which the latest login of an athlete is kept, for server-initiated work"""
+    return f"athlete:{athlete_id}"
+
+class SessionStore(ABC):
+    """Dict-like session backend with TTL expiry and a size bound
+
+    Persistent backends hand out copies, so update a session by assigning it
+    again rather than mutating the returned dict.
+    """
+
+    @abstractmethod
+    def get(self, key: str, default: Any = None) -> Any:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: Dict[str, Any], ttl: Optional[float] = None):
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    def keys(self) -> List[str]:
+        """Keys of the sessions that have not expired"""
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """Number of sessions that have not expired"""
+
+    def __getitem__(self, key: str) -> Dict[str, Any]:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Dict[str, Any]):
+        self.set(key, value)
+
+    def __delitem__(self, key: str):
+        self.delete(key)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+class MemorySessionStore(SessionStore):
+    """Sessions held in this process only, `max_size` None keeps every entry"""
+
+    def __init__(self, max_size: Optional[int] = 10000, ttl: Optional[float] = None):
+        self._cache = TTLCache(max_size=sys.maxsize if max_size is None else max_size, ttl=ttl)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self._cache.get(key, default)
+
+    def set(self, key: str, value: Dict[str, Any], ttl: Optional[float] = None):
+        self._cache.set(key, value, ttl=ttl)
+
+    def delete(self, key: str):
+        self._cache.delete(key)
+
+    def keys(self) -> List[str]:
+        self._cache.purge()
+        return list(self._cache)
+
+    def __len__(self) -> int:
+        self._cache.purge()
+        return len(self._cache)
+
+class SQLiteSessionStore(SessionStore):
+    """Sessions in a SQLite file, shared by every worker process on the host
+
+    Each store has its own `table`, `max_size` None keeps every entry. Reads record the
+    access time at most every ACCESS_WRITE_INTERVAL seconds, which is as fine as the LRU
+    eviction needs and keeps most reads from taking the database write lock.
+    """
+
+    def __init__(self, path: str, max_size: Optional[int] = 10000, ttl: Optional[float] = None,
+                 table: str = "sessions"):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.table = table
+        self._lock = threading.Lock()
+        self._conn = connect_sqlite(path)
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed_at ON {table} (accessed_at)")
+
+    def get(self, key: str, default: Any = None) -> Any:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, expires_at, accessed_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return default
+            if row[1] is not None and row[1] <= now:
+                self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                return default
+            if now - row[2] >= ACCESS_WRITE_INTERVAL:
+                self._conn.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Dict[str, Any], ttl: Optional[float] = None):
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = now + ttl if ttl is not None else None
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires_at, now)
+            )
+            self._conn.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (now,))
+            if self.max_size is not None:
+                # Keep only the most recently used sessions
+                self._conn.execute(
+                    f"DELETE FROM {self.table} WHERE key IN "
+                    f"(SELECT key FROM {self.table} ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_size,)
+                )
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def keys(self) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT key FROM {self.table} WHERE expires_at IS NULL OR expires_at > ?", (time.time(),)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT COUNT(*) FROM {self.table} WHERE expires_at IS NULL OR expires_at > ?", (time.time(),)
+            ).fetchone()[0]
+
+def get_session_backend() -> str:
+    """Session backend selected by STRYDE_SESSION_BACKEND, "memory" or "sqlite" """
+    return os.getenv("STRYDE_SESSION_BACKEND", "memory")
+
+def get_session_db_path() -> str:
+    return os.getenv("STRYDE_SESSION_DB") or get_data_path("sessions.db")
+
+def create_session_store() -> SessionStore:
+    """Build the session backend selected by STRYDE_SESSION_BACKEND ("memory" or "sqlite")"""
+    max_size = int(os.getenv("STRYDE_SESSION_MAX_SIZE", "10000"))
+    ttl = float(os.getenv("STRYDE_SESSION_TTL", str(7 * 24 * 60 * 60)))
+
+    if get_session_backend() == "sqlite":
+        return SQLiteSessionStore(get_session_db_path(), max_size=max_size, ttl=ttl)
+    return MemorySessionStore(max_size=max_size, ttl=ttl)
+
+# Session backend shared by the auth, user and training routers
+user_sessions = create_session_store()
+
+registry.register(Gauge("stryde_session_store_size", "Sessions currently stored", lambda: len(user_sessions)))
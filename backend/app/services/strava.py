@@ -1,50 +1,342 @@
-import httpx
+import asyncio
+import hashlib
+import logging
 import os
-from typing import List, Dict, Any
+from typing import AsyncIterator, Awaitable, Collection, List, Dict, Any, Optional, Set, Tuple
+from .activity_store import activity_store
+from .streams import STREAM_KEYS, stream_store
+from ..models.activity import Activity
+from ..utils.jsonstream import iter_json_array
+from ..utils.metrics import STRAVA_LATENCY, SYNC_PAGES
+from .http import get_http_client
+from .ratelimit import strava_rate_limiter, StravaRateLimitError
 
-async def fetch_user_activities(access_token: str, max_pages: int = 10) -> List[Dict[str, Any]]:
-    """Fetch user activities from Strava API"""
-    all_activities = []
+STRAVA_ACTIVITIES_URL = "https://www.strava.com/api/v3/athlete/activities"
+
+# Prefix of the store keys of athletes known only by an access token
+TOKEN_ATHLETE_PREFIX = "token:"
+
+logger = logging.getLogger(__name__)
+
+class StravaAPIError(Exception):
+    """Strava answered with an unexpected status, the request's data is incomplete"""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+def get_page_concurrency() -> int:
+    """How many activity pages may be requested at once"""
+    return max(1, int(os.getenv("STRYDE_STRAVA_PAGE_CONCURRENCY", "5")))
+
+def streaming_json_enabled() -> bool:
+    """Whether activity pages are decoded incrementally instead of with response.json()"""
+    return os.getenv("STRYDE_STRAVA_STREAMING_JSON", "true").lower() not in ("0", "false", "no")
+
+async def _iter_list(items: List[Any]) -> AsyncIterator[Any]:
+    for item in items:
+        yield item
+
+async def parse_activity_page(response, types: Optional[Collection[str]] = None) -> Tuple[List[Activity], int]:
+    """Project a page response into activities of the given types
+
+    Returns the kept activities and how many Strava sent, the latter decides
+    whether more pages follow. In streaming mode each activity is decoded from
+    the body as it arrives and dropped as soon as its fields are projected.
+    """
+    if streaming_json_enabled():
+        raw_activities = iter_json_array(response.aiter_text())
+    else:
+        await response.aread()
+        raw_activities = _iter_list(response.json())
+
+    activities, received = [], 0
+    async for activity in raw_activities:
+        received += 1
+        if types is None or activity.get("type") in types:
+            activities.append(Activity.from_strava(activity))
+    return activities, received
+
+async def fetch_activity_page(access_token: str, page: int, params: Dict[str, Any],
+                              types: Optional[Collection[str]] = None) -> Tuple[List[Activity], int]:
+    """Fetch one page of activities, raises StravaAPIError if Strava refused the request"""
+    client = get_http_client()
+    await strava_rate_limiter.acquire()
+    released = False
+    try:
+        with STRAVA_LATENCY.time(endpoint="athlete/activities", status="error") as labels:
+            async with client.stream(
+                "GET",
+                STRAVA_ACTIVITIES_URL,
+                headers={"Authorization": f"Bearer {access_token}"},
+                params={**params, "page": page}
+            ) as response:
+                strava_rate_limiter.release(response.headers, response.status_code)
+                released = True
+                labels["status"] = response.status_code
+
+                if response.status_code == 429:
+                    raise StravaRateLimitError("Strava rate limit exceeded")
+                if response.status_code != 200:
+                    await response.aread()
+                    logger.warning("Failed to fetch activities: %s - %s", response.status_code, response.text)
+                    raise StravaAPIError(response.status_code,
+                                         f"Strava returned {response.status_code} for activity page {page}")
+
+                activities_batch, received = await parse_activity_page(response, types)
+    except Exception:
+        if not released:
+            strava_rate_limiter.release()
+        raise
+
+    logger.debug("Got %d of %d activities on page %d", len(activities_batch), received, page)
+    return activities_batch, received
+
+async def iter_user_activity_pages(access_token: str, max_pages: int = 10, after: Optional[int] = None,
+                                   concurrency: Optional[int] = None,
+                                   types: Optional[Collection[str]] = None) -> AsyncIterator[List[Activity]]:
+    """Yield pages of user activities from Strava API in page order as they arrive
+
+    Pages are requested in concurrent windows. An incremental sync (`after` set)
+    usually fits on one page, so it starts with a single request. With `types`
+    set, other activities are skipped while parsing and never projected. A page
+    Strava refuses raises StravaAPIError or StravaRateLimitError, it is never
+    mistaken for the end of the history.
+    """
     page = 1
     per_page = 200
+    concurrency = concurrency or get_page_concurrency()
+    
+    params = {"per_page": per_page}
+    if after is not None:
+        params["after"] = after
     
-    async with httpx.AsyncClient() as client:
+    window = 1 if after is not None else concurrency
+    requested = 0
+    try:
         while page <= max_pages:
-            print(f"📥 Fetching page {page} of activities...")
+            window = strava_rate_limiter.allowed_concurrency(min(window, max_pages - page + 1))
+            pages = list(range(page, page + window))
+            logger.debug("Fetching pages %d-%d of activities", pages[0], pages[-1])
+            
+            requested += window
+            batches = await asyncio.gather(*(fetch_activity_page(access_token, p, params, types) for p in pages),
+                                           return_exceptions=True)
+            
+            for batch in batches:
+                # A failure after the last page does not matter, earlier pages end the sync first
+                if isinstance(batch, BaseException):
+                    raise batch
+                activities_batch, received = batch
+                if not received:
+                    return
+                yield activities_batch
+                
+                # A short page is the last one, later pages in the window are empty
+                if received < per_page:
+                    return
             
+            page += window
+            window = concurrency
+    finally:
+        SYNC_PAGES.observe(requested)
+
+async def fetch_user_activities(access_token: str, max_pages: int = 10, after: Optional[int] = None,
+                                concurrency: Optional[int] = None,
+                                types: Optional[Collection[str]] = None) -> List[Activity]:
+    """Fetch user activities from Strava API, optionally only those started after an epoch timestamp"""
+    all_activities = []
+    async for activities_batch in iter_user_activity_pages(access_token, max_pages, after, concurrency, types):
+        all_activities.extend(activities_batch)
+    return all_activities
+
+async def fetch_activity(access_token: str, activity_id: int) -> Optional[Activity]:
+    """Fetch a single activity, returns None if it no longer exists or is not visible"""
+    client = get_http_client()
+    await strava_rate_limiter.acquire()
+    try:
+        with STRAVA_LATENCY.time(endpoint="activities/{id}", status="error") as labels:
             response = await client.get(
-                "https://www.strava.com/api/v3/athlete/activities",
+                f"https://www.strava.com/api/v3/activities/{activity_id}",
+                headers={"Authorization": f"Bearer {access_token}"}
+            )
+            labels["status"] = response.status_code
+    except Exception:
+        strava_rate_limiter.release()
+        raise
+    strava_rate_limiter.release(response.headers, response.status_code)
+    
+    if response.status_code == 429:
+        raise StravaRateLimitError("Strava rate limit exceeded")
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise StravaAPIError(response.status_code,
+                             f"Failed to fetch activity {activity_id}: {response.status_code} - {response.text}")
+    return Activity.from_strava(response.json())
+
+async def fetch_activity_streams(access_token: str, activity_id: int) -> Dict[str, List[float]]:
+    """Fetch an activity's time, distance, heart rate and velocity streams, empty if it has none"""
+    client = get_http_client()
+    await strava_rate_limiter.acquire()
+    try:
+        with STRAVA_LATENCY.time(endpoint="activities/{id}/streams", status="error") as labels:
+            response = await client.get(
+                f"https://www.strava.com/api/v3/activities/{activity_id}/streams",
                 headers={"Authorization": f"Bearer {access_token}"},
-                params={"page": page, "per_page": per_page}
+                params={"keys": ",".join(STREAM_KEYS), "key_by_type": "true"}
             )
-            
-            if response.status_code != 200:
-                print(f"Failed to fetch activities: {response.status_code} - {response.text}")
-                break
-            
-            activities_batch = response.json()
-            print(f"Got {len(activities_batch)} activities on page {page}")
-            if not activities_batch:
-                break
-                
-            all_activities.extend(activities_batch)
-            page += 1
+            labels["status"] = response.status_code
+    except Exception:
+        strava_rate_limiter.release()
+        raise
+    strava_rate_limiter.release(response.headers, response.status_code)
     
-    return all_activities
+    if response.status_code == 429:
+        raise StravaRateLimitError("Strava rate limit exceeded")
+    if response.status_code == 404:
+        # Manual activities have no streams
+        return {}
+    if response.status_code != 200:
+        raise StravaAPIError(response.status_code,
+                             f"Failed to fetch streams of {activity_id}: {response.status_code} - {response.text}")
+    
+    data = response.json()
+    if isinstance(data, list):
+        data = {stream.get("type"): stream for stream in data}
+    return {key: stream.get("data") or [] for key, stream in data.items() if key in STREAM_KEYS}
+
+def get_stream_concurrency() -> int:
+    """How many activities' streams are requested at once"""
+    return max(1, int(os.getenv("STRYDE_STRAVA_STREAM_CONCURRENCY", "5")))
+
+def get_stream_fetch_limit() -> int:
+    """How many activities' streams one request fetches before answering, the rest are filled in the background"""
+    return max(1, int(os.getenv("STRYDE_STRAVA_STREAM_FETCHES", "15")))
+
+async def sync_activity_streams(access_token: str, athlete_key: str, activity_ids: Collection[int],
+                                concurrency: Optional[int] = None) -> Dict[int, Exception]:
+    """Fetch the streams of activities not stored yet, returns the error of each activity that failed
+
+    Stored streams are never fetched again, a recorded activity's streams do not change.
+    """
+    missing = stream_store.missing(athlete_key, activity_ids)
+    semaphore = asyncio.Semaphore(concurrency or get_stream_concurrency())
+    
+    async def fetch_one(activity_id: int) -> Optional[Exception]:
+        async with semaphore:
+            try:
+                streams = await fetch_activity_streams(access_token, activity_id)
+            except StravaRateLimitError as e:
+                return e
+            except Exception as e:
+                logger.warning("Stream fetch failed for activity %s: %s", activity_id, e)
+                return e
+        stream_store.put(athlete_key, activity_id, streams)
+        return None
+    
+    errors = await asyncio.gather(*(fetch_one(activity_id) for activity_id in missing))
+    logger.debug("Fetched streams of %d activities for athlete %s", len(missing), athlete_key)
+    return {activity_id: error for activity_id, error in zip(missing, errors) if error}
+
+# Activity ids per athlete whose streams a background fill has taken on
+_stream_fills: Dict[str, Set[int]] = {}
+
+def filling_streams(athlete_key: str) -> Set[int]:
+    """Activities whose streams a background fill will fetch, requests leave them alone"""
+    return set(_stream_fills.get(athlete_key, ()))
+
+def fill_activity_streams(access_token: str, athlete_key: str,
+                          activity_ids: Collection[int]) -> Awaitable[Dict[int, Exception]]:
+    """Take on the activities at once and fetch their streams one at a time, for a background job"""
+    activity_ids = [activity_id for activity_id in activity_ids if activity_id not in filling_streams(athlete_key)]
+    _stream_fills.setdefault(athlete_key, set()).update(activity_ids)
+
+    async def fill() -> Dict[int, Exception]:
+        try:
+            return await sync_activity_streams(access_token, athlete_key, activity_ids, concurrency=1)
+        finally:
+            claimed = _stream_fills.get(athlete_key, set())
+            claimed.difference_update(activity_ids)
+            if not claimed:
+                _stream_fills.pop(athlete_key, None)
+    return fill()
+
+def webhooks_enabled() -> bool:
+    """Webhook events keep stored activities current once a verify token is configured"""
+    return bool(os.getenv("STRAVA_VERIFY_TOKEN"))
+
+def get_sync_interval() -> float:
+    """Seconds during which an athlete's stored activities are served without asking Strava"""
+    if webhooks_enabled():
+        # Polling is only a safety net for missed events
+        return float(os.getenv("STRYDE_WEBHOOK_SYNC_INTERVAL", str(6 * 60 * 60)))
+    return float(os.getenv("STRYDE_SYNC_INTERVAL", "60"))
+
+def token_athlete_key(access_token: str) -> str:
+    """Store key of an athlete known only by an access token, a digest so the token never ends up in a store"""
+    return TOKEN_ATHLETE_PREFIX + hashlib.sha256(access_token.encode()).hexdigest()
+
+async def sync_user_activities(access_token: str, athlete_key: Optional[str] = None,
+                               max_age: float = 0) -> int:
+    """Fetch only activities newer than the ones already stored for the athlete, returns how many were new
+
+    Nothing is stored unless every page was read, a partial sync would move the
+    `after` cursor past the pages that failed.
+    """
+    key = athlete_key or token_athlete_key(access_token)
+    if max_age and activity_store.is_fresh(key, max_age):
+        return 0
+    
+    after = activity_store.latest_start(key)
+    new_activities = await fetch_user_activities(access_token, after=after)
+    activity_store.add(key, new_activities)
+    activity_store.mark_synced(key)
+    logger.info("Synced %d new activities for athlete %s (after=%s)", len(new_activities), key, after)
+    
+    return len(new_activities)
+
+def get_batch_concurrency() -> int:
+    """How many athletes a batch request syncs at once, their pages still share the rate limiter"""
+    return max(1, int(os.getenv("STRYDE_BATCH_SYNC_CONCURRENCY", "8")))
+
+async def sync_athletes(tokens: Dict[str, str], max_age: float = 0,
+                        concurrency: Optional[int] = None) -> Dict[str, str]:
+    """Sync several athletes concurrently, returns an error message per athlete whose sync failed
+
+    Any refused page (rate limit, expired token, Strava error) fails the athlete's whole sync.
+    A failed sync stores nothing, so the athlete's previously stored activities stay consistent.
+    """
+    semaphore = asyncio.Semaphore(concurrency or get_batch_concurrency())
+    
+    async def sync_one(athlete_key: str, access_token: str) -> Optional[str]:
+        async with semaphore:
+            try:
+                await sync_user_activities(access_token, athlete_key, max_age)
+            except StravaRateLimitError as e:
+                return str(e)
+            except StravaAPIError as e:
+                logger.warning("Sync failed for athlete %s: %s", athlete_key, e)
+                if e.status_code == 401:
+                    return "Strava authorization expired"
+                return f"Strava sync failed ({e.status_code})"
+            except Exception as e:
+                logger.warning("Sync failed for athlete %s: %s", athlete_key, e)
+                return "Strava sync failed"
+        return None
+    
+    errors = await asyncio.gather(*(sync_one(key, token) for key, token in tokens.items()))
+    return {key: error for key, error in zip(tokens, errors) if error}
 
 async def exchange_code_for_token(code: str) -> Dict[str, Any]:
     """Exchange Strava authorization code for access token"""
-    print(f"🔍 DEBUG: Exchanging code for token - code: {code[:10]}...")
-    
     client_id = os.getenv("STRAVA_CLIENT_ID")
     client_secret = os.getenv("STRAVA_CLIENT_SECRET")
+    if not client_id or not client_secret:
+        logger.warning("STRAVA_CLIENT_ID or STRAVA_CLIENT_SECRET is not set")
     
-    print(f"🔑 DEBUG: Client ID present: {bool(client_id)}")
-    print(f"🔑 DEBUG: Client Secret present: {bool(client_secret)}")
-    print(f"🔑 DEBUG: Client ID value: {client_id}")
-    print(f"🔑 DEBUG: Client Secret: {client_secret[:5] if client_secret else 'None'}...")
-    
-    async with httpx.AsyncClient() as client:
+    client = get_http_client()
+    with STRAVA_LATENCY.time(endpoint="oauth/token", status="error") as labels:
         response = await client.post(
             "https://www.strava.com/oauth/token",
             data={
@@ -54,25 +346,44 @@ async def exchange_code_for_token(code: str) -> Dict[str, Any]:
                 "grant_type": "authorization_code"
             }
         )
-        
-        print(f"📡 DEBUG: Token exchange response: {response.status_code}")
-        
-        if response.status_code == 200:
-            print(f"✅ DEBUG: Token exchange successful")
-            return response.json()
-        else:
-            print(f"❌ DEBUG: Token exchange failed: {response.text}")
-            raise Exception(f"Token exchange failed: {response.status_code} - {response.text}")
+        labels["status"] = response.status_code
+    
+    if response.status_code == 200:
+        return response.json()
+    else:
+        logger.warning("Token exchange failed: %s - %s", response.status_code, response.text)
+        raise Exception(f"Token exchange failed: {response.status_code} - {response.text}")
+
+async def refresh_access_token(refresh_token: str) -> Dict[str, Any]:
+    """Exchange a refresh token for a new access token (Strava may rotate the refresh token too)"""
+    client = get_http_client()
+    with STRAVA_LATENCY.time(endpoint="oauth/token", status="error") as labels:
+        response = await client.post(
+            "https://www.strava.com/oauth/token",
+            data={
+                "client_id": os.getenv("STRAVA_CLIENT_ID"),
+                "client_secret": os.getenv("STRAVA_CLIENT_SECRET"),
+                "refresh_token": refresh_token,
+                "grant_type": "refresh_token"
+            }
+        )
+        labels["status"] = response.status_code
+    
+    if response.status_code == 200:
+        return response.json()
+    raise StravaAPIError(response.status_code, f"Token refresh failed: {response.status_code} - {response.text}")
 
 async def fetch_strava_user(access_token: str) -> Dict[str, Any]:
     """Fetch user profile from Strava API"""
-    async with httpx.AsyncClient() as client:
+    client = get_http_client()
+    with STRAVA_LATENCY.time(endpoint="athlete", status="error") as labels:
         response = await client.get(
             "https://www.strava.com/api/v3/athlete",
             headers={"Authorization": f"Bearer {access_token}"}
         )
-        
-        if response.status_code == 200:
-            return response.json()
-        else:
-            raise Exception(f"Failed to fetch user: {response.status_code} - {response.text}")
+        labels["status"] = response.status_code
+    
+    if response.status_code == 200:
+        return response.json()
+    else:
+        raise Exception(f"Failed to fetch user: {response.status_code} - {response.text}")
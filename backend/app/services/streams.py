@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import shutil
+import struct
+import threading
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+import numpy as np
+from .planner import PACE_ZONES, format_speed
+from ..utils.helpers import get_data_path
+from ..utils.metrics import CACHE_REQUESTS
+
+# Strava stream types analyzed per activity
+STREAM_KEYS = ("time", "distance", "heartrate", "velocity_smooth")
+
+# Stored width and scale of each stream, values are kept as round(value * scale) in the narrowest
+# type that holds them: about a third of the float64 size, and still readable through a memory map
+STREAM_ENCODING = {
+    "time": ("<u4", 1),  # seconds since the start
+    "distance": ("<u4", 10),  # decimeters
+    "heartrate": ("<u1", 1),  # bpm
+    "velocity_smooth": ("<u2", 1000),  # mm/s
+}
+
+MAGIC = b"STRM1\n"
+ALIGNMENT = 8
+
+# Gaps between samples longer than this are pauses, not moving time
+MAX_SAMPLE_GAP = 10
+
+# Lower bound of each heart rate zone as a share of max heart rate
+HEART_RATE_ZONES = (
+    ("Z1 recovery", 0.50),
+    ("Z2 endurance", 0.60),
+    ("Z3 tempo", 0.70),
+    ("Z4 threshold", 0.80),
+    ("Z5 VO2max", 0.90),
+)
+
+Streams = Dict[str, np.ndarray]
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+def encode_streams(streams: Mapping[str, Sequence[float]]) -> bytes:
+    """Magic, header length, JSON header with each column's dtype, scale and offset, then the columns"""
+    present = [key for key in STREAM_KEYS if streams.get(key)]
+    length = min((len(streams[key]) for key in present), default=0)
+    columns, blocks, offset = {}, [], 0
+    for key in present:
+        dtype, scale = STREAM_ENCODING[key]
+        limit = np.iinfo(dtype).max
+        values = np.nan_to_num(np.asarray(streams[key][:length], dtype=np.float64))
+        block = np.clip(np.round(values * scale), 0, limit).astype(dtype).tobytes()
+        columns[key] = [dtype, scale, offset]
+        blocks.append(block + b"\0" * (_aligned(len(block)) - len(block)))
+        offset += _aligned(len(block))
+
+    header = json.dumps({"length": length, "columns": columns}).encode()
+    prefix = MAGIC + struct.pack("<I", len(header)) + header
+    prefix += b"\0" * (_aligned(len(prefix)) - len(prefix))
+    # Column offsets in the header are relative to the end of the padded prefix
+    return prefix + b"".join(blocks)
+
+def decode_streams(buffer: np.ndarray) -> Streams:
+    """Columns of an encoded file, `buffer` being its bytes as uint8 (usually a memory map)"""
+    if bytes(buffer[:len(MAGIC)]) != MAGIC:
+        raise ValueError("Not a stream file")
+    (header_length,) = struct.unpack("<I", bytes(buffer[len(MAGIC):len(MAGIC) + 4]))
+    header_end = len(MAGIC) + 4 + header_length
+    header = json.loads(bytes(buffer[len(MAGIC) + 4:header_end]))
+    base, length = _aligned(header_end), header["length"]
+
+    streams = {}
+    for key, (dtype, scale, offset) in header["columns"].items():
+        size = length * np.dtype(dtype).itemsize
+        raw = buffer[base + offset:base + offset + size].view(dtype)
+        streams[key] = raw / scale if scale != 1 else raw.astype(np.float64)
+    return streams
+
+class StreamStore:
+    """Activity streams on disk, one file per activity with each stream as a fixed-width column
+
+    Streams of a recorded activity do not change, so a stored file is never
+    fetched again. Activities without streams (manual entries) are stored
+    empty so they are not asked for again either. Files are written under a
+    temporary name and renamed, so workers sharing the directory never read a
+    partial one.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _athlete_dir(self, athlete_key: str) -> str:
+        # Hashed so any store key makes a safe, fixed-length directory name
+        return os.path.join(self.directory, hashlib.sha256(athlete_key.encode()).hexdigest()[:32])
+
+    def _path(self, athlete_key: str, activity_id: Any) -> str:
+        return os.path.join(self._athlete_dir(athlete_key), f"{int(activity_id)}.streams")
+
+    def __contains__(self, key: Tuple[str, Any]) -> bool:
+        return os.path.exists(self._path(*key))
+
+    def missing(self, athlete_key: str, activity_ids: Iterable[Any]) -> List[Any]:
+        """Activities whose streams were never stored"""
+        return [activity_id for activity_id in activity_ids if (athlete_key, activity_id) not in self]
+
+    def put(self, athlete_key: str, activity_id: Any, streams: Mapping[str, Sequence[float]]):
+        path = self._path(athlete_key, activity_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(encode_streams(streams))
+        os.replace(temporary, path)
+
+    def get(self, athlete_key: str, activity_id: Any) -> Optional[Streams]:
+        """Stored streams, empty if the activity has none, None if they were never stored"""
+        path = self._path(athlete_key, activity_id)
+        try:
+            buffer = np.memmap(path, dtype=np.uint8, mode="r")
+        except FileNotFoundError:
+            CACHE_REQUESTS.inc(cache="streams", result="miss")
+            return None
+        CACHE_REQUESTS.inc(cache="streams", result="hit")
+        return decode_streams(buffer)
+
+    def remove(self, athlete_key: str, activity_ids: Iterable[Any]):
+        for activity_id in activity_ids:
+            try:
+                os.remove(self._path(athlete_key, activity_id))
+            except FileNotFoundError:
+                pass
+
+    def clear(self, athlete_key: str):
+        """Forget every stored stream of an athlete"""
+        shutil.rmtree(self._athlete_dir(athlete_key), ignore_errors=True)
+
+def create_stream_store() -> StreamStore:
+    """Stream files under STRYDE_STREAM_DIR, or streams/ in the data directory"""
+    return StreamStore(os.getenv("STRYDE_STREAM_DIR") or get_data_path("streams"))
+
+def sample_durations(time: np.ndarray) -> np.ndarray:
+    """Seconds each sample stands for, pauses count as zero"""
+    gaps = np.diff(time, prepend=time[:1])
+    return np.where(gaps <= MAX_SAMPLE_GAP, gaps, 0.0)
+
+def zone_times(values: np.ndarray, durations: np.ndarray, lower_bounds: Sequence[float]) -> np.ndarray:
+    """Seconds spent below the first bound and in each zone, the last zone being open-ended"""
+    zone = np.searchsorted(np.asarray(lower_bounds), values, side="right")
+    return np.bincount(zone, weights=durations, minlength=len(lower_bounds) + 1)
+
+def heart_rate_zone_times(streams: Streams, max_hr: float) -> np.ndarray:
+    if "heartrate" not in streams or "time" not in streams:
+        return np.zeros(len(HEART_RATE_ZONES) + 1)
+    durations = sample_durations(streams["time"])
+    recorded = streams["heartrate"] > 0
+    return zone_times(streams["heartrate"][recorded], durations[recorded],
+                      [share * max_hr for _, share in HEART_RATE_ZONES])
+
+def pace_zone_times(streams: Streams, threshold: float) -> np.ndarray:
+    """Seconds per pace zone, zones running from their lower bound up to the next zone's"""
+    if "velocity_smooth" not in streams or "time" not in streams:
+        return np.zeros(len(PACE_ZONES) + 1)
+    bounds = [low * threshold for low, _ in PACE_ZONES.values()]
+    return zone_times(streams["velocity_smooth"], sample_durations(streams["time"]), bounds)
+
+def format_zones(names: Sequence[str], seconds: np.ndarray, below: str) -> List[Dict[str, Any]]:
+    """Zones with their time and share, the time below the first zone first"""
+    total = float(seconds.sum())
+    return [{"zone": name, "seconds": round(float(value)), "share": round(float(value) / total, 3) if total else 0.0}
+            for name, value in zip((below, *names), seconds)]
+
+def splits(streams: Streams, sport: str = "Run", split_meters: float = 1000.0) -> List[Dict[str, Any]]:
+    """Moving time, pace and average heart rate of each split, the last one possibly short"""
+    if "distance" not in streams or "time" not in streams or not len(streams["distance"]):
+        return []
+    distance = np.maximum.accumulate(streams["distance"])
+    durations = sample_durations(streams["time"])
+    moving = np.cumsum(durations)
+    ends = np.append(np.arange(split_meters, distance[-1], split_meters), distance[-1])
+    ends = ends[ends > 0]
+    if not len(ends):
+        return []
+    times = np.diff(np.interp(ends, distance, moving), prepend=0.0)
+    lengths = np.diff(ends, prepend=0.0)
+
+    index = np.minimum((distance // split_meters).astype(np.int64), len(ends) - 1)
+    heart_rate = streams.get("heartrate")
+    if heart_rate is not None:
+        weights = durations * (heart_rate > 0)
+        seconds = np.bincount(index, weights=weights, minlength=len(ends))
+        beats = np.bincount(index, weights=heart_rate * weights, minlength=len(ends))
+        average_hr = np.divide(beats, seconds, out=np.zeros_like(beats), where=seconds > 0)
+
+    result = []
+    for i, (length, seconds_taken) in enumerate(zip(lengths.tolist(), times.tolist())):
+        split = {"split": i + 1, "distance_km": round(length / 1000, 2), "time": round(seconds_taken),
+                 "pace": format_speed(length / seconds_taken, sport) if seconds_taken > 0 else None}
+        if heart_rate is not None:
+            split["average_heartrate"] = round(float(average_hr[i])) if average_hr[i] else None
+        result.append(split)
+    return result
+
+def max_heart_rate(streams_list: Iterable[Streams]) -> Optional[float]:
+    """Highest heart rate recorded in the streams, None without heart rate data"""
+    peaks = [float(streams["heartrate"].max()) for streams in streams_list
+             if "heartrate" in streams and len(streams["heartrate"])]
+    return max(peaks) if peaks and max(peaks) > 0 else None
+
+def zone_summary(streams_list: Sequence[Streams], threshold: float, max_hr: Optional[float]) -> Dict[str, Any]:
+    """Time in heart rate and pace zones summed over activities"""
+    max_hr = max_hr or max_heart_rate(streams_list)
+    heart_rate = np.zeros(len(HEART_RATE_ZONES) + 1)
+    pace = np.zeros(len(PACE_ZONES) + 1)
+    for streams in streams_list:
+        if max_hr:
+            heart_rate += heart_rate_zone_times(streams, max_hr)
+        pace += pace_zone_times(streams, threshold)
+    return {
+        "max_hr": max_hr,
+        "heart_rate_zones": format_zones([name for name, _ in HEART_RATE_ZONES], heart_rate, "below Z1")
+        if max_hr else [],
+        "pace_zones": format_zones(list(PACE_ZONES), pace, "slower"),
+    }
+
+def analyze_activity_streams(streams: Streams, sport: str, threshold: float, max_hr: Optional[float] = None,
+                             split_meters: float = 1000.0) -> Dict[str, Any]:
+    """Splits and time in zones of one activity"""
+    return {"splits": splits(streams, sport, split_meters), **zone_summary([streams], threshold, max_hr)}
+
+# Shared by the Strava sync and the training endpoints
+stream_store = create_stream_store()
@@ -0,0 +1,311 @@
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+import numpy as np
+from .activity_store import activity_store, ActivityStore
+from .analysis import ActivityColumns, SECONDS_PER_DAY, period_keys
+from .planner import ATL_DAYS, CTL_DAYS, HISTORY_DAYS, format_speed, threshold_speed
+from ..utils.cache import TTLCache
+
+# EWMA segments are computed in blocks so the rescaling factors stay well inside float64
+EWMA_BLOCK = 128
+
+# Load is scored against the threshold speed estimated when the series was built, re-estimated this often
+THRESHOLD_REFRESH_DAYS = 28
+
+# Longest range one request may ask for
+MAX_RANGE_DAYS = 10 * 366
+
+# Distances personal bests are reported for, per sport (name, meters)
+BEST_EFFORTS = {
+    "Ride": (("20 km", 20000.0), ("40 km", 40000.0), ("100 km", 100000.0)),
+}
+DEFAULT_BEST_EFFORTS = (("5K", 5000.0), ("10K", 10000.0), ("Half marathon", 21097.5), ("Marathon", 42195.0))
+# Best pace (or negative distance for "Longest") per effort name, with the activity start
+Bests = Dict[str, Tuple[float, int]]
+
+def ewma_series(values: np.ndarray, time_constant: float, initial: float = 0.0) -> np.ndarray:
+    """y[i] = y[i-1] + (values[i] - y[i-1]) / time_constant, continuing from `initial`, vectorized per block"""
+    alpha = 1 / time_constant
+    out = np.empty(len(values), dtype=np.float64)
+    previous = initial
+    for offset in range(0, len(values), EWMA_BLOCK):
+        block = values[offset:offset + EWMA_BLOCK]
+        powers = (1 - alpha) ** np.arange(1, len(block) + 1)
+        out[offset:offset + len(block)] = powers * (previous + alpha * np.cumsum(block / powers))
+        previous = out[offset + len(block) - 1]
+    return out
+
+def weight_coverage(days: np.ndarray, time_constant: float) -> np.ndarray:
+    """Sum of the EWMA weights after each number of days
+
+    Dividing by it normalizes the averages like planner.ewma, so a short history does not read as detraining.
+    """
+    return 1 - (1 - 1 / time_constant) ** days
+
+def rolling_sum(values: np.ndarray, window: int) -> np.ndarray:
+    """Sum of each value and the `window - 1` before it"""
+    cumulative = np.concatenate([[0.0], np.cumsum(values)])
+    ends = np.arange(1, len(values) + 1)
+    return cumulative[ends] - cumulative[np.maximum(ends - window, 0)]
+
+def epoch_day_of(date: str) -> int:
+    """Epoch day of an ISO date"""
+    return int(np.datetime64(date, "D").astype(np.int64))
+
+def day_label(day: int) -> str:
+    return str(np.datetime64(day, "D"))
+
+def best_efforts(columns: ActivityColumns, sport: str) -> Bests:
+    """Fastest pace (seconds per meter) over activities at least as long as each distance, with its start"""
+    bests = {}
+    moved = (columns.distance > 0) & (columns.moving_time > 0)
+    for name, meters in BEST_EFFORTS.get(sport, DEFAULT_BEST_EFFORTS):
+        candidates = np.flatnonzero(moved & (columns.distance >= meters))
+        if len(candidates):
+            paces = columns.moving_time[candidates] / columns.distance[candidates]
+            best = candidates[np.argmin(paces)]
+            bests[name] = (float(paces.min()), int(columns.start[best]))
+    if moved.any():
+        longest = int(np.argmax(np.where(moved, columns.distance, -1)))
+        bests["Longest"] = (-float(columns.distance[longest]), int(columns.start[longest]))
+    return bests
+
+def merge_bests(current: Bests, new: Bests) -> Bests:
+    """Keep the better (lower) value per effort, the earlier one on ties"""
+    merged = dict(current)
+    for name, value in new.items():
+        if name not in merged or value < merged[name]:
+            merged[name] = value
+    return merged
+
+def format_duration(seconds: float) -> str:
+    seconds = round(seconds)
+    hours, rest = divmod(seconds, 3600)
+    return f"{hours}:{rest // 60:02d}:{rest % 60:02d}" if hours else f"{rest // 60}:{rest % 60:02d}"
+
+class AthleteSeries:
+    """Daily training series of one athlete and sport, from their first activity to the last day computed"""
+
+    def __init__(self, first_day: int, threshold: float, built_day: int):
+        self.first_day = first_day
+        self.threshold = threshold
+        self.built_day = built_day
+        self.version: Optional[int] = None
+        self.last_start: Optional[int] = None
+        self.distance = np.zeros(0)
+        self.moving_time = np.zeros(0)
+        self.count = np.zeros(0)
+        self.load = np.zeros(0)
+        self.atl = np.zeros(0)
+        self.ctl = np.zeros(0)
+        self.bests: Bests = {}
+
+    @property
+    def last_day(self) -> int:
+        return self.first_day + len(self.load) - 1
+
+    def recompute_from(self, day: int, today: int, columns: ActivityColumns):
+        """Replace every day from `day` on with the activities in `columns`, which start on or after it"""
+        keep = max(day - self.first_day, 0)
+        days = today - self.first_day - keep + 1
+        index = columns.start // SECONDS_PER_DAY - (self.first_day + keep)
+        in_range = (index >= 0) & (index < days)
+        index, columns = index[in_range], ActivityColumns(*(field[in_range] for field in columns))
+
+        speed = np.divide(columns.distance, columns.moving_time, out=np.zeros_like(columns.distance),
+                          where=columns.moving_time > 0)
+        # hours x intensity^2 x 100, as in the planner
+        stress = columns.moving_time / 3600 * np.clip(speed / self.threshold, 0.5, 1.2) ** 2 * 100
+
+        def daily(weights: Optional[np.ndarray]) -> np.ndarray:
+            return np.bincount(index, weights=weights, minlength=days).astype(np.float64)
+
+        load = daily(stress)
+        # The averages are kept normalized over the days since the first activity, continue from the raw level
+        elapsed = np.arange(keep + 1, keep + days + 1)
+
+        def levels(previous: np.ndarray, time_constant: float) -> np.ndarray:
+            initial = previous[keep - 1] * weight_coverage(keep, time_constant) if keep else 0.0
+            raw = ewma_series(load, time_constant, initial)
+            return np.concatenate([previous[:keep], raw / weight_coverage(elapsed, time_constant)])
+
+        self.atl = levels(self.atl, ATL_DAYS)
+        self.ctl = levels(self.ctl, CTL_DAYS)
+        self.distance = np.concatenate([self.distance[:keep], daily(columns.distance)])
+        self.moving_time = np.concatenate([self.moving_time[:keep], daily(columns.moving_time)])
+        self.count = np.concatenate([self.count[:keep], daily(None)])
+        self.load = np.concatenate([self.load[:keep], load])
+        if len(columns.start):
+            self.last_start = max(self.last_start or 0, int(columns.start.max()))
+
+    def extend_to(self, today: int):
+        """Add rest days up to `today`, fitness and fatigue decay over them"""
+        if today > self.last_day:
+            self.recompute_from(self.last_day + 1, today, ActivityColumns(np.zeros(0, dtype=np.int64),
+                                                                          np.zeros(0), np.zeros(0)))
+
+    def training_load(self) -> Dict[str, float]:
+        """Acute and chronic load on the last day, as planner.training_load reports them"""
+        if not len(self.load):
+            return {"atl": 0.0, "ctl": 0.0, "tsb": 0.0, "ramp_rate": 0.0}
+        atl, ctl = float(self.atl[-1]), float(self.ctl[-1])
+        ctl_week_ago = float(self.ctl[-8]) if len(self.ctl) > 7 else 0.0
+        return {
+            "atl": round(atl, 1),
+            "ctl": round(ctl, 1),
+            "tsb": round(ctl - atl, 1),
+            "ramp_rate": round(ctl - ctl_week_ago, 1),
+        }
+
+    def weekly_sums(self) -> Dict[int, Tuple[int, float, float]]:
+        """Activities, distance and moving time per week key, comparable with the weekly rollups"""
+        days = np.arange(self.first_day, self.first_day + len(self.load), dtype=np.int64)
+        keys, inverse = np.unique(period_keys(days * SECONDS_PER_DAY, "week"), return_inverse=True)
+        counts = np.bincount(inverse, weights=self.count, minlength=len(keys))
+        distance = np.bincount(inverse, weights=self.distance, minlength=len(keys))
+        moving_time = np.bincount(inverse, weights=self.moving_time, minlength=len(keys))
+        return {key: (int(round(counts[i])), float(distance[i]), float(moving_time[i]))
+                for i, key in enumerate(keys.tolist()) if counts[i]}
+
+class TimeSeriesStore:
+    """Per-athlete training load series, extended as days pass and patched as activities change
+
+    Changes are found by comparing the series with the weekly rollups. Days from
+    the first changed week on are recomputed, continuing the weighted averages
+    from the day before, so a sync that adds this week's activities leaves the
+    rest of the history untouched.
+    """
+
+    def __init__(self, store: ActivityStore, max_athletes: int = 1000):
+        self.store = store
+        self._series = TTLCache(max_size=max_athletes, name="timeseries")
+        self._lock = threading.RLock()
+
+    def _build(self, athlete_key: str, sport: str, today: int) -> AthleteSeries:
+        columns = self.store.query_columns(athlete_key, types=[sport])
+        first_day = int(columns.start.min()) // SECONDS_PER_DAY if len(columns.start) else today
+        recent = columns.start >= (today - HISTORY_DAYS + 1) * SECONDS_PER_DAY
+        threshold = threshold_speed(columns.distance[recent], columns.moving_time[recent], sport)
+
+        series = AthleteSeries(first_day, threshold, today)
+        series.recompute_from(first_day, today, columns)
+        series.bests = best_efforts(columns, sport)
+        return series
+
+    def _first_changed_day(self, series: AthleteSeries, athlete_key: str, sport: str) -> Optional[int]:
+        """Monday of the earliest week whose rollup no longer matches the series, None if none changed"""
+        rollups = self.store.ensure_rollups(athlete_key).sums(sport, "week")
+        computed = series.weekly_sums()
+        # Every input of the load counts: an edited moving time changes the load as much as a new activity
+        changed = [week for week in set(rollups) | set(computed)
+                   if week not in rollups or week not in computed
+                   or rollups[week][0] != computed[week][0] or not np.allclose(rollups[week][1:], computed[week][1:])]
+        return min(changed) if changed else None
+
+    def get(self, athlete_key: str, sport: str = "Run", today: Optional[int] = None) -> AthleteSeries:
+        """The athlete's series through `today` (epoch day), updated for any activity changes"""
+        today = int(time.time()) // SECONDS_PER_DAY if today is None else today
+        with self._lock:
+            version = self.store.version(athlete_key)
+            series = self._series.get((athlete_key, sport))
+            if series is not None and today - series.built_day >= THRESHOLD_REFRESH_DAYS:
+                series = None
+            if series is not None and series.version != version:
+                changed_day = self._first_changed_day(series, athlete_key, sport)
+                if changed_day is not None and changed_day < series.first_day:
+                    series = None
+                elif changed_day is not None:
+                    # Days through the newest known activity's day only change through edits and deletes
+                    known_end = (series.last_start // SECONDS_PER_DAY - series.first_day + 1
+                                 if series.last_start is not None else 0)
+                    known = slice(changed_day - series.first_day, max(known_end, 0))
+                    before = (series.count[known].copy(), series.distance[known].copy(),
+                              series.moving_time[known].copy())
+                    columns = self.store.query_columns(athlete_key, start=changed_day * SECONDS_PER_DAY,
+                                                       types=[sport])
+                    series.recompute_from(changed_day, max(today, series.last_day), columns)
+                    appended = (np.array_equal(before[0], series.count[known])
+                                and np.allclose(before[1], series.distance[known])
+                                and np.allclose(before[2], series.moving_time[known]))
+                    if appended:
+                        series.bests = merge_bests(series.bests, best_efforts(columns, sport))
+                    else:
+                        # An edited or deleted activity may have been a best, look at the whole history again
+                        series.bests = best_efforts(self.store.query_columns(athlete_key, types=[sport]), sport)
+            if series is None:
+                series = self._build(athlete_key, sport, today)
+                self._series.set((athlete_key, sport), series)
+            series.version = version
+            series.extend_to(today)
+            return series
+
+    def clear(self):
+        self._series.clear()
+
+def load_payload(series: AthleteSeries, sport: str, start_day: int, end_day: int,
+                 resolution: str = "day") -> Dict[str, Any]:
+    """Series for [start_day, end_day] with rolling trends, by day or by week (sums, and levels on the last day)"""
+    days = np.arange(start_day, end_day + 1, dtype=np.int64)
+    # Rolling windows need the 27 days before the range too
+    padded = np.arange(start_day - 27, end_day + 1, dtype=np.int64)
+    index = padded - series.first_day
+    valid = (index >= 0) & (index < len(series.load))
+
+    def take(values: np.ndarray) -> np.ndarray:
+        return np.where(valid, values[np.clip(index, 0, max(len(values) - 1, 0))] if len(values) else 0.0, 0.0)
+
+    distance, moving_time = take(series.distance), take(series.moving_time)
+    distance_28d, time_28d = rolling_sum(distance, 28)[27:], rolling_sum(moving_time, 28)[27:]
+    columns = {
+        "distance_km": distance[27:] / 1000,
+        "load": take(series.load)[27:],
+        "atl": take(series.atl)[27:],
+        "ctl": take(series.ctl)[27:],
+        "distance_7d_km": rolling_sum(distance, 7)[27:] / 1000,
+        "distance_28d_km": distance_28d / 1000,
+    }
+    columns["tsb"] = columns["ctl"] - columns["atl"]
+    if sport == "Ride":
+        columns["speed_28d_kmh"] = np.divide(distance_28d * 3.6, time_28d, out=np.zeros_like(time_28d),
+                                             where=time_28d > 0)
+    else:
+        columns["pace_28d_min_km"] = np.divide(time_28d / 60, distance_28d / 1000, out=np.zeros_like(time_28d),
+                                               where=distance_28d > 0)
+
+    labels = days
+    if resolution == "week":
+        keys, inverse = np.unique(period_keys(days * SECONDS_PER_DAY, "week"), return_inverse=True)
+        last = np.zeros(len(keys), dtype=np.int64)
+        np.maximum.at(last, inverse, np.arange(len(days)))
+        for name in columns:
+            if name in ("distance_km", "load"):
+                columns[name] = np.bincount(inverse, weights=columns[name], minlength=len(keys))
+            else:
+                columns[name] = columns[name][last]
+        labels = keys
+
+    efforts = dict(BEST_EFFORTS.get(sport, DEFAULT_BEST_EFFORTS))
+    personal_bests = []
+    for name, (value, start) in sorted(series.bests.items(), key=lambda item: efforts.get(item[0], float("inf"))):
+        best = {"name": name, "date": day_label(start // SECONDS_PER_DAY)}
+        if name == "Longest":
+            best["distance_km"] = round(-value / 1000, 2)
+        else:
+            best["time"] = format_duration(value * efforts[name])
+            best["pace"] = format_speed(1 / value, sport)
+        personal_bests.append(best)
+
+    return {
+        "sport": sport,
+        "start": day_label(start_day),
+        "end": day_label(end_day),
+        "resolution": resolution,
+        "series": {"date": [day_label(day) for day in labels.tolist()],
+                   **{name: np.round(values, 2).tolist() for name, values in columns.items()}},
+        "current": series.training_load(),
+        "personal_bests": personal_bests,
+    }
+
+# Shared by the training endpoints
+load_series = TimeSeriesStore(activity_store)
@@ -0,0 +1,204 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import secrets
+import time
+from typing import Any, Dict, Optional
+from .sessions import (
+    SessionStore, MemorySessionStore, SQLiteSessionStore, get_session_backend, get_session_db_path
+)
+from .strava import refresh_access_token, StravaAPIError
+from ..utils.cache import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+TOKEN_KEY_PREFIX = "tokens:"
+
+class TokenRefreshError(Exception):
+    """The athlete's tokens are gone or Strava refused to refresh them, a new login is needed"""
+
+def token_vault_key(athlete_id: Any) -> str:
+    return f"{TOKEN_KEY_PREFIX}{athlete_id}"
+
+def load_token_key() -> bytes:
+    """256-bit key derived from STRYDE_TOKEN_KEY, random per process when it is not set
+
+    A shared (sqlite) vault needs the same key in every worker, so it refuses to start without one.
+    """
+    secret = os.getenv("STRYDE_TOKEN_KEY")
+    if not secret:
+        if get_session_backend() == "sqlite":
+            raise RuntimeError("STRYDE_TOKEN_KEY must be set with the sqlite session backend, "
+                               "other workers could not decrypt the stored tokens")
+        logger.warning("STRYDE_TOKEN_KEY not set, stored tokens only survive this process")
+        return secrets.token_bytes(32)
+    return hashlib.sha256(secret.encode()).digest()
+
+def create_token_store() -> SessionStore:
+    """Store of the vault, apart from the sessions and with no size bound or expiry
+
+    Logins that are never completed must not push anyone's tokens out, and
+    refreshed tokens stay valid however long ago the athlete logged in.
+    """
+    if get_session_backend() == "sqlite":
+        return SQLiteSessionStore(get_session_db_path(), max_size=None, table="tokens")
+    return MemorySessionStore(max_size=None)
+
+class TokenVault:
+    """Strava tokens per athlete, JWE-encrypted in the session store and refreshed ahead of expiry"""
+
+    def __init__(self, store: SessionStore, key: bytes, refresh_margin: float = 15 * 60):
+        self.store = store
+        self.refresh_margin = refresh_margin
+        self._key = key
+        self._refreshes = SingleFlight()
+
+    def _encrypt(self, tokens: Dict[str, Any]) -> str:
+        # python-jose loads its cryptography backend on import, keep it off the cold start path
+        from jose import jwe
+        return jwe.encrypt(json.dumps(tokens), self._key, algorithm="dir", encryption="A256GCM").decode()
+
+    def _decrypt(self, token: str) -> Optional[Dict[str, Any]]:
+        from jose import jwe
+        from jose.exceptions import JOSEError
+        try:
+            return json.loads(jwe.decrypt(token, self._key))
+        except (JOSEError, ValueError) as e:
+            logger.warning("Could not decrypt stored tokens: %s", e)
+            return None
+
+    def warm_up(self):
+        """Load the JWE backend ahead of the first login or token lookup"""
+        self._decrypt(self._encrypt({}))
+
+    def save(self, athlete_id: Any, token_data: Dict[str, Any]):
+        """Store the tokens of an OAuth token response"""
+        tokens = {
+            "access_token": token_data["access_token"],
+            "refresh_token": token_data.get("refresh_token"),
+            "expires_at": token_data.get("expires_at"),
+        }
+        self.store.set(token_vault_key(athlete_id), {"tokens": self._encrypt(tokens)})
+
+    def load(self, athlete_id: Any) -> Optional[Dict[str, Any]]:
+        record = self.store.get(token_vault_key(athlete_id))
+        return self._decrypt(record["tokens"]) if record else None
+
+    def delete(self, athlete_id: Any):
+        self.store.delete(token_vault_key(athlete_id))
+
+    def expires_soon(self, tokens: Dict[str, Any]) -> bool:
+        expires_at = tokens.get("expires_at")
+        return expires_at is not None and expires_at - time.time() < self.refresh_margin
+
+    async def refresh(self, athlete_id: Any) -> Dict[str, Any]:
+        """Refresh the athlete's tokens, concurrent callers share one request to Strava"""
+        return await self._refreshes.do(str(athlete_id), lambda: self._refresh(athlete_id))
+
+    async def _refresh(self, athlete_id: Any) -> Dict[str, Any]:
+        tokens = self.load(athlete_id)
+        if not tokens or not tokens.get("refresh_token"):
+            raise TokenRefreshError(f"No refresh token for athlete {athlete_id}")
+        # Another worker may have refreshed while this one was waiting
+        if not self.expires_soon(tokens):
+            return tokens
+        try:
+            token_data = await refresh_access_token(tokens["refresh_token"])
+        except Exception as e:
+            raise TokenRefreshError(str(e))
+        self.save(athlete_id, {"refresh_token": tokens["refresh_token"], **token_data})
+        logger.debug("Refreshed Strava token for athlete %s", athlete_id)
+        return self.load(athlete_id)
+
+    async def revoked(self, athlete_id: Any) -> bool:
+        """Whether Strava refuses the athlete's refresh token, confirming a deauthorization
+
+        The tokens are refreshed even when not expiring. Errors other than a refusal propagate.
+        """
+        tokens = self.load(athlete_id)
+        if not tokens or not tokens.get("refresh_token"):
+            return True
+        try:
+            token_data = await refresh_access_token(tokens["refresh_token"])
+        except StravaAPIError as e:
+            if e.status_code in (400, 401):
+                return True
+            raise
+        self.save(athlete_id, {"refresh_token": tokens["refresh_token"], **token_data})
+        return False
+
+    async def get_access_token(self, athlete_id: Any) -> Optional[str]:
+        """A valid access token for the athlete, None if the vault has none"""
+        tokens = self.load(athlete_id)
+        if tokens is None:
+            return None
+        if self.expires_soon(tokens):
+            tokens = await self.refresh(athlete_id)
+        return tokens["access_token"]
+
+    async def refresh_expiring(self) -> int:
+        """Refresh every stored token that is about to expire, returns how many were refreshed"""
+        refreshed = 0
+        for key in self.store.keys():
+            if not key.startswith(TOKEN_KEY_PREFIX):
+                continue
+            athlete_id = key[len(TOKEN_KEY_PREFIX):]
+            tokens = self.load(athlete_id)
+            if not tokens or not self.expires_soon(tokens):
+                continue
+            try:
+                await self.refresh(athlete_id)
+                refreshed += 1
+            except TokenRefreshError as e:
+                logger.warning("Background token refresh failed for athlete %s: %s", athlete_id, e)
+        return refreshed
+
+class TokenRefresher:
+    """Background task that keeps stored tokens ahead of expiry"""
+
+    def __init__(self, vault: TokenVault, interval: float):
+        self.vault = vault
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Start the loop, called from the FastAPI lifespan"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.vault.refresh_expiring()
+            except Exception:
+                logger.exception("Token refresh loop failed")
+            await asyncio.sleep(self.interval)
+
+# Tokens live on the session backend, so a SQLite backend shares them across workers
+token_vault = TokenVault(
+    create_token_store(), load_token_key(),
+    refresh_margin=float(os.getenv("STRYDE_TOKEN_REFRESH_MARGIN", str(15 * 60))),
+)
+token_refresher = TokenRefresher(token_vault, float(os.getenv("STRYDE_TOKEN_REFRESH_INTERVAL", str(5 * 60))))
+
+async def session_access_token(session: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Access token for a logged-in session, from the vault when it holds the athlete's tokens"""
+    if not session:
+        return None
+    athlete = session.get("athlete") or {}
+    if "id" in athlete:
+        token = await token_vault.get_access_token(athlete["id"])
+        if token is not None:
+            return token
+    return session.get("access_token")
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+from typing import Any, Dict, Iterable, Optional
+from .activity_store import activity_store
+from .sessions import user_sessions, athlete_session_key
+from .strava import fetch_activity
+from .streams import stream_store
+from .tokens import token_vault, session_access_token, TokenRefreshError
+
+logger = logging.getLogger(__name__)
+
+async def process_event(event: Dict[str, Any]) -> Optional[str]:
+    """Apply one Strava webhook event to the stored activities, returns what was done"""
+    object_type = event.get("object_type")
+    aspect_type = event.get("aspect_type")
+    athlete_key = str(event.get("owner_id"))
+
+    if object_type == "athlete":
+        # Athletes revoking access must not keep any of their data around, once Strava
+        # confirms it by refusing their refresh token (the event itself is unsigned)
+        if (event.get("updates") or {}).get("authorized") == "false":
+            if not await token_vault.revoked(athlete_key):
+                logger.warning("Deauthorization of athlete %s not confirmed by Strava, ignored", athlete_key)
+                return "ignored"
+            activity_store.clear(athlete_key)
+            stream_store.clear(athlete_key)
+            user_sessions.delete(athlete_session_key(athlete_key))
+            token_vault.delete(athlete_key)
+            return "deauthorized"
+        return None
+
+    if object_type != "activity":
+        return None
+
+    # An athlete that was never fully synced gets a full sync on their next visit,
+    # a single event would otherwise move the after= cursor past their history
+    if activity_store.latest_start(athlete_key) is None:
+        return "skipped"
+
+    # Every event, deletes included, is checked against the activity Strava returns
+    activity_id = event.get("object_id")
+    try:
+        # The vault holds the tokens even once the athlete's session is gone
+        session = user_sessions.get(athlete_session_key(athlete_key)) or {"athlete": {"id": athlete_key}}
+        access_token = await session_access_token(session)
+    except TokenRefreshError as e:
+        logger.info("Token refresh failed for athlete %s: %s", athlete_key, e)
+        access_token = None
+    if not access_token:
+        logger.debug("No token for athlete %s, dropping webhook event", athlete_key)
+        return "skipped"
+
+    activity = await fetch_activity(access_token, activity_id)
+    if activity is None:
+        activity_store.remove(athlete_key, [activity_id])
+        stream_store.remove(athlete_key, [activity_id])
+        return "deleted"
+    activity_store.add(athlete_key, [activity])
+    return "created" if aspect_type == "create" else "updated"
+
+async def replay_events(events: Iterable[Dict[str, Any]]) -> list:
+    """Process recorded events in order, a local stand-in for Strava's push delivery"""
+    return [await process_event(event) for event in events]
+
+class WebhookQueue:
+    """Queue of received events drained by one background worker"""
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._current: Optional[Dict[str, Any]] = None
+
+    @property
+    def running(self) -> bool:
+        return self._worker is not None and not self._worker.done()
+
+    async def start(self):
+        """Start the worker, called from the FastAPI lifespan"""
+        if not self.running:
+            self._queue = asyncio.Queue(maxsize=self.max_size)
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10.0):
+        """Stop the worker once the queue is drained or `timeout` seconds have passed
+
+        Athletes with activity events left unprocessed lose their stored activities,
+        so their next visit runs a full sync instead of resuming after the missed events.
+        """
+        if self._worker is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Webhook queue not drained within %.1fs", timeout)
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            dropped = [] if self._current is None else [self._current]
+            while not self._queue.empty():
+                dropped.append(self._queue.get_nowait())
+            self._resync(dropped)
+        self._worker = None
+        self._queue = None
+        self._current = None
+
+    @staticmethod
+    def _resync(events: Iterable[Dict[str, Any]]):
+        athletes = {str(event.get("owner_id")) for event in events if event.get("object_type") == "activity"}
+        for athlete_key in athletes:
+            activity_store.clear(athlete_key)
+        if athletes:
+            logger.warning("Dropped webhook events of %d athletes, they get a full sync on their next visit",
+                           len(athletes))
+
+    def enqueue(self, event: Dict[str, Any]) -> bool:
+        """Queue an event for the worker, returns False if it has to be processed another way"""
+        if not self.running:
+            return False
+        try:
+            self._queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def join(self):
+        """Wait until every queued event has been processed"""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def _run(self):
+        while True:
+            event = self._current = await self._queue.get()
+            try:
+                await process_event(event)
+            except Exception:
+                logger.exception("Webhook event failed")
+            finally:
+                self._current = None
+                self._queue.task_done()
+
+# Shared by the webhook router and the application lifespan
+webhook_queue = WebhookQueue()
@@ -0,0 +1,114 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterator, Optional
+from fastapi.responses import JSONResponse, Response
+from .metrics import CACHE_REQUESTS
+
+_MISSING = object()
+
+class TTLCache:
+    """In-memory mapping with per-entry expiry and least-recently-used eviction
+
+    Lookups in a cache with a `name` are counted in the cache hit metrics.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None, name: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.name = name
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def _lookup(self, key: Hashable) -> Any:
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            return _MISSING
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return _MISSING
+        self._data.move_to_end(key)
+        return value
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return a live entry and mark it as recently used"""
+        value = self._lookup(key)
+        if self.name:
+            CACHE_REQUESTS.inc(cache=self.name, result="miss" if value is _MISSING else "hit")
+        return default if value is _MISSING else value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Store an entry, `ttl` overrides the cache default for this entry"""
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.max_size:
+            self.purge()
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def purge(self):
+        """Drop every expired entry"""
+        now = time.monotonic()
+        for key in [key for key, (expires_at, _) in self._data.items() if expires_at is not None and expires_at <= now]:
+            del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self._lookup(key) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(list(self._data))
+
+class SingleFlight:
+    """Collapse concurrent calls for the same key into one in-flight call"""
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Run `fn` unless a call for `key` is already running, then share its result"""
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        # One caller giving up must not cancel the call for everyone else
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+def make_etag(payload: Any) -> str:
+    """Strong ETag for a JSON-serializable payload"""
+    body = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return '"' + hashlib.sha256(body.encode()).hexdigest()[:32] + '"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header value matches the current ETag"""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+def conditional_json_response(payload: Any, etag: str, if_none_match: Optional[str]) -> Response:
+    """Answer 304 Not Modified when the client already has this representation"""
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(payload, headers=headers)
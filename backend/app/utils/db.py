@@ -0,0 +1,9 @@
+import sqlite3
+
+def connect_sqlite(path: str) -> sqlite3.Connection:
+    """Open a SQLite database that several worker processes can share"""
+    conn = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+    if path != ":memory:":
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
@@ -6,3 +6,10 @@ def get_base_url():
     if vercel_url:
         return f"https://{vercel_url}"
     return "http://localhost:8000"
+
+def get_data_path(filename: str) -> str:
+    """Get a path for local data files - Vercel only allows writes under /tmp"""
+    default_dir = "/tmp/stryde" if os.getenv("VERCEL_URL") else "."
+    data_dir = os.getenv("STRYDE_DATA_DIR", default_dir)
+    os.makedirs(data_dir, exist_ok=True)
+    return os.path.join(data_dir, filename)
@@ -0,0 +1,55 @@
+import json
+from typing import Any, AsyncIterator
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+def _skip_whitespace(text: str, pos: int) -> int:
+    while pos < len(text) and text[pos] in _WHITESPACE:
+        pos += 1
+    return pos
+
+async def iter_json_array(chunks: AsyncIterator[str]) -> AsyncIterator[Any]:
+    """Yield the elements of a top-level JSON array as each one is complete
+
+    Only the current element's text is buffered, so a large array is never
+    decoded into one object tree.
+    """
+    buffer, pos = "", 0
+    started = False
+    expect_value = True
+
+    async for chunk in chunks:
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        while True:
+            pos = _skip_whitespace(buffer, pos)
+            if pos >= len(buffer):
+                break
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError("Expected a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                return
+            if not expect_value:
+                if buffer[pos] != ",":
+                    raise ValueError(f"Expected ',' or ']' in JSON array, got {buffer[pos]!r}")
+                expect_value = True
+                pos += 1
+                continue
+            try:
+                element, end = _decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The element continues in the next chunk
+                break
+            if end == len(buffer) and not isinstance(element, (dict, list)):
+                # A number or literal at the end of the buffer may still be cut off
+                break
+            yield element
+            pos = end
+            expect_value = False
+
+    raise ValueError("Truncated JSON array")
@@ -0,0 +1,38 @@
+import json
+import logging
+import os
+import sys
+import time
+
+# Attributes every LogRecord has, anything else was passed through `extra=`
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, with `extra=` fields as top-level keys"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS})
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def configure_logging():
+    """Set up the `app` loggers from STRYDE_LOG_LEVEL and STRYDE_LOG_FORMAT ("text" or "json")"""
+    logger = logging.getLogger("app")
+    logger.setLevel(os.getenv("STRYDE_LOG_LEVEL", "INFO").upper())
+    if any(getattr(handler, "_stryde", False) for handler in logger.handlers):
+        return
+    handler = logging.StreamHandler(sys.stderr)
+    if os.getenv("STRYDE_LOG_FORMAT", "text").lower() == "json":
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    handler._stryde = True
+    logger.addHandler(handler)
+    logger.propagate = False
@@ -0,0 +1,184 @@
+import bisect
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Seconds, from a cache hit to a slow inference call
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class Metric(ABC):
+    """A named metric with optional labels, rendered in the Prometheus text format"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    @abstractmethod
+    def samples(self) -> Iterator[str]:
+        """Sample lines of the metric, without the trailing newline"""
+
+    def render(self) -> str:
+        header = f"# HELP {self.name} {self.documentation}\n# TYPE {self.name} {self.kind}\n"
+        return header + "".join(f"{sample}\n" for sample in self.samples())
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> Iterator[str]:
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+class Gauge(Metric):
+    """A value read at scrape time from `fn`"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, fn: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.fn = fn
+
+    def samples(self) -> Iterator[str]:
+        yield f"{self.name} {_format_value(self.fn())}"
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> (per-bucket counts, sum, count)
+        self._values: Dict[Tuple[str, ...], List] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels: str):
+        """Observe how long the block takes, labels may still be filled in by the block"""
+        started = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels: str) -> int:
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def samples(self) -> Iterator[str]:
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = _format_labels(self.label_names, key, ("le", _format_value(bound)))
+                yield f"{self.name}_bucket{le} {cumulative}"
+            yield f"{self.name}_bucket{_format_labels(self.label_names, key, ('le', '+Inf'))} {count}"
+            yield f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.label_names, key)} {count}"
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        return "".join(metric.render() for metric in self._metrics.values())
+
+registry = Registry()
+
+REQUEST_LATENCY = registry.register(Histogram(
+    "stryde_http_request_duration_seconds", "Time to handle an HTTP request, by route",
+    labels=("method", "route", "status"),
+))
+STRAVA_LATENCY = registry.register(Histogram(
+    "stryde_strava_request_duration_seconds", "Time of Strava API calls, by endpoint",
+    labels=("endpoint", "status"),
+))
+SYNC_PAGES = registry.register(Histogram(
+    "stryde_strava_sync_pages", "Activity pages fetched per sync", buckets=(0, 1, 2, 3, 5, 10, 20, 50),
+))
+INFERENCE_LATENCY = registry.register(Histogram(
+    "stryde_inference_duration_seconds", "Time of training-plan inference calls, by outcome",
+    labels=("outcome",),
+))
+CACHE_REQUESTS = registry.register(Counter(
+    "stryde_cache_requests_total", "Cache lookups, by cache and result (hit or miss)",
+    labels=("cache", "result"),
+))
+
+# Timing spans of the current request, None unless the request opted in
+_spans: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("stryde_spans", default=None)
+
+def start_spans() -> Token:
+    """Collect spans for the rest of this request (and tasks started from it)"""
+    return _spans.set([])
+
+def finish_spans(token: Token) -> List[Tuple[str, float]]:
+    spans = _spans.get() or []
+    _spans.reset(token)
+    return spans
+
+@contextmanager
+def span(name: str):
+    """Time a phase of the request, a no-op unless spans were started"""
+    spans = _spans.get()
+    if spans is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans.append((name, (time.perf_counter() - started) * 1000))
+
+def server_timing(spans: List[Tuple[str, float]]) -> str:
+    """Server-Timing header value, durations in milliseconds"""
+    return ", ".join(f"{name};dur={duration:.1f}" for name, duration in spans)
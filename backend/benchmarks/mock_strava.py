@@ -0,0 +1,106 @@
+import asyncio
+import json
+import re
+import time
+from typing import Any, Dict, List, Optional, Tuple
+import httpx
+from .synthetic import generate_streams
+
+ACTIVITY_URL = re.compile(r"/api/v3/activities/(\d+)$")
+STREAMS_URL = re.compile(r"/api/v3/activities/(\d+)/streams$")
+
+class MockStrava:
+    """In-process Strava and Hugging Face APIs for benchmarks, served through httpx.MockTransport
+
+    `latency` is added to every Strava response and `inference_latency` to every
+    inference call. Requests beyond `rate_limit` (15-minute, daily) get 429s,
+    usage is reported in X-RateLimit-* headers like Strava does.
+    """
+
+    def __init__(self, activities: List[Dict[str, Any]], latency: float = 0.0, inference_latency: float = 0.0,
+                 rate_limit: Tuple[int, int] = (600, 30000), chunk_size: int = 16 * 1024):
+        # Newest first, as Strava returns them
+        self.activities = sorted(activities, key=lambda act: act["start_date"], reverse=True)
+        self.latency = latency
+        self.inference_latency = inference_latency
+        self.rate_limit = rate_limit
+        self.chunk_size = chunk_size
+        self.requests = 0
+        self.inference_requests = 0
+        self.throttled = 0
+
+    def reset(self):
+        self.requests = 0
+        self.inference_requests = 0
+        self.throttled = 0
+
+    def client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
+
+    def _rate_limit_headers(self) -> Dict[str, str]:
+        return {
+            "X-RateLimit-Limit": f"{self.rate_limit[0]},{self.rate_limit[1]}",
+            "X-RateLimit-Usage": f"{self.requests},{self.requests}",
+        }
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        if request.url.host == "api-inference.huggingface.co":
+            return await self._inference(request)
+
+        await asyncio.sleep(self.latency)
+        self.requests += 1
+        if self.requests > min(self.rate_limit):
+            self.throttled += 1
+            return httpx.Response(429, json={"message": "Rate Limit Exceeded"}, headers=self._rate_limit_headers())
+
+        path = request.url.path
+        if path == "/api/v3/athlete/activities":
+            return self._activity_page(request)
+        match = ACTIVITY_URL.search(path)
+        if match:
+            return self._activity(int(match.group(1)))
+        match = STREAMS_URL.search(path)
+        if match:
+            return self._streams(int(match.group(1)))
+        if path == "/oauth/token":
+            return httpx.Response(200, json={"access_token": "benchmark", "refresh_token": "benchmark",
+                                             "expires_at": int(time.time()) + 6 * 3600})
+        return httpx.Response(404, json={"message": "Record Not Found"})
+
+    def _activity_page(self, request: httpx.Request) -> httpx.Response:
+        params = request.url.params
+        page = int(params.get("page", 1))
+        per_page = int(params.get("per_page", 30))
+        after: Optional[str] = params.get("after")
+        activities = self.activities
+        if after is not None:
+            cutoff = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(int(after)))
+            # after= returns the oldest matching activities first
+            activities = [act for act in reversed(activities) if act["start_date"] > cutoff]
+        body = json.dumps(activities[(page - 1) * per_page:page * per_page]).encode()
+        # Delivered in chunks like a network body, so incremental parsing has something to work with
+        return httpx.Response(200, content=self._chunks(body), headers={
+            "Content-Type": "application/json", **self._rate_limit_headers()
+        })
+
+    async def _chunks(self, body: bytes):
+        for start in range(0, len(body), self.chunk_size):
+            yield body[start:start + self.chunk_size]
+
+    def _activity(self, activity_id: int) -> httpx.Response:
+        for activity in self.activities:
+            if activity["id"] == activity_id:
+                return httpx.Response(200, json=activity, headers=self._rate_limit_headers())
+        return httpx.Response(404, json={"message": "Record Not Found"}, headers=self._rate_limit_headers())
+
+    def _streams(self, activity_id: int) -> httpx.Response:
+        for activity in self.activities:
+            if activity["id"] == activity_id:
+                return httpx.Response(200, json=generate_streams(activity), headers=self._rate_limit_headers())
+        return httpx.Response(404, json={"message": "Record Not Found"}, headers=self._rate_limit_headers())
+
+    async def _inference(self, request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(self.inference_latency)
+        self.inference_requests += 1
+        # Not a JSON plan, so the service falls back to its simple plan like it does in production
+        return httpx.Response(200, json=[{"generated_text": "Monday: easy run. Tuesday: intervals."}])
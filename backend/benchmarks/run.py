@@ -0,0 +1,267 @@
+"""Benchmarks for the backend hot paths against a mocked Strava and inference API
+
+    python -m benchmarks.run --activities 2000 --latency 0.02 --output bench.json
+    python -m benchmarks.run --compare base.json bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import ExitStack
+from typing import Any, Callable, Dict, List, Optional
+from unittest.mock import patch
+
+# The app opens its SQLite files on import, keep them out of the working tree
+os.environ.setdefault("STRYDE_DATA_DIR", tempfile.mkdtemp(prefix="stryde-bench-"))
+os.environ.setdefault("STRYDE_HF_TOKEN", "benchmark")
+
+from .mock_strava import MockStrava  # noqa: E402
+from .startup import bench_startup  # noqa: E402
+from .synthetic import generate_activities  # noqa: E402
+
+def measure(fn: Callable[[], Any], repeat: int, memory: bool = True) -> Dict[str, Any]:
+    """Wall time of `repeat` calls, plus the peak traced allocation of one more call"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+
+    result = {
+        "runs": repeat,
+        "min_ms": round(min(timings), 3),
+        "median_ms": round(statistics.median(timings), 3),
+        "mean_ms": round(statistics.fmean(timings), 3),
+    }
+    if memory:
+        tracemalloc.start()
+        fn()
+        result["peak_memory_kb"] = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+        tracemalloc.stop()
+    return result
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def mocked_clients(stack: ExitStack, strava: MockStrava):
+    """Route Strava and inference calls to the mock, with a fresh rate limiter"""
+    from app.services.ratelimit import StravaRateLimiter
+
+    stack.enter_context(patch("app.services.strava.get_http_client", side_effect=strava.client))
+    stack.enter_context(patch("app.services.rag.get_http_client", side_effect=strava.client))
+    stack.enter_context(patch("app.services.strava.strava_rate_limiter", StravaRateLimiter()))
+
+def bench_fetch(strava: MockStrava, repeat: int) -> Dict[str, Any]:
+    from app.services.strava import fetch_user_activities
+
+    results = {}
+    for mode in ("streaming", "buffered"):
+        os.environ["STRYDE_STRAVA_STREAMING_JSON"] = "true" if mode == "streaming" else "false"
+        with ExitStack() as stack:
+            mocked_clients(stack, strava)
+            results[f"fetch_user_activities.{mode}"] = measure(
+                lambda: asyncio.run(fetch_user_activities("benchmark", max_pages=100)), repeat)
+    os.environ.pop("STRYDE_STRAVA_STREAMING_JSON")
+    return results
+
+def bench_analysis(activities: List[Dict[str, Any]], athletes: int, repeat: int) -> Dict[str, Any]:
+    from app.models.activity import Activity
+    from app.services.analysis import (
+        to_columns, aggregate_volume, calculate_training_volume, aggregate_group_volume
+    )
+    from app.services.pipeline import Pipeline, VolumeAggregator, CountAggregator, PaceAggregator
+    from app.services.planner import build_training_plan, history_start
+
+    records = [Activity.from_strava(act) for act in activities]
+    runs = [act for act in records if act.type == "Run"]
+    columns = to_columns(runs)
+
+    def fused():
+        return Pipeline(types=["Run"]).aggregate(
+            weekly=VolumeAggregator("week", "week_start", limit=8),
+            monthly=VolumeAggregator("month", "month", limit=6),
+            count=CountAggregator(),
+            pace=PaceAggregator(),
+        ).feed(records).results()
+
+    club = {str(i): columns for i in range(athletes)}
+    history = to_columns([act for act in runs if act.start >= history_start()])
+    return {
+        "analysis.parse_activities": measure(lambda: [Activity.from_strava(act) for act in activities], repeat),
+        "analysis.to_columns": measure(lambda: to_columns(runs), repeat),
+        "analysis.aggregate_volume": measure(lambda: (
+            aggregate_volume(columns, "week", "week_start", 8), aggregate_volume(columns, "month", "month", 6)
+        ), repeat),
+        "analysis.calculate_training_volume": measure(lambda: calculate_training_volume(runs), repeat),
+        "analysis.pipeline_fused": measure(fused, repeat),
+        "analysis.group_volume": measure(lambda: aggregate_group_volume(club, "week", "week_start", 8), repeat),
+        "planner.build_training_plan": measure(lambda: build_training_plan(history, "Run"), repeat),
+    }
+
+def bench_recommendations(strava: MockStrava, activities: List[Dict[str, Any]], repeat: int) -> Dict[str, Any]:
+    from app.models.activity import Activity
+    from app.services import rag
+
+    runs = [Activity.from_strava(act) for act in activities if act["type"] == "Run"][:14]
+
+    def cold():
+        rag.plan_cache.clear()
+        return asyncio.run(rag.generate_training_recommendations(runs, len(runs)))
+
+    with ExitStack() as stack:
+        mocked_clients(stack, strava)
+        results = {"generate_training_recommendations.cold": measure(cold, repeat, memory=False)}
+        asyncio.run(rag.generate_training_recommendations(runs, len(runs)))
+        results["generate_training_recommendations.cached"] = measure(
+            lambda: asyncio.run(rag.generate_training_recommendations(runs, len(runs))), repeat)
+    return results
+
+def bench_endpoint(strava: MockStrava, repeat: int) -> Dict[str, Any]:
+    from fastapi.testclient import TestClient
+    from app.main import app
+    from app.api.training import volume_cache
+    from app.services import rag
+    from app.services.activity_store import activity_store
+    from app.services.sessions import user_sessions
+
+    athlete_key = "1"
+    user_sessions["benchmark"] = {"authenticated": True, "access_token": "benchmark", "athlete": {"id": 1}}
+    url = "/training/volume?state=benchmark"
+
+    with ExitStack() as stack:
+        mocked_clients(stack, strava)
+        client = stack.enter_context(TestClient(app))
+
+        def cold():
+            activity_store.clear(athlete_key)
+            volume_cache.clear()
+            rag.plan_cache.clear()
+            response = client.get(url)
+            assert response.status_code == 200, response.text
+
+        results = {"training_volume.cold_sync": measure(cold, repeat, memory=False)}
+        etag = client.get(url).headers["ETag"]
+        results["training_volume.warm"] = measure(lambda: client.get(url), repeat)
+        results["training_volume.not_modified"] = measure(
+            lambda: client.get(url, headers={"If-None-Match": etag}), repeat)
+    return results
+
+def bench_streams(strava: MockStrava, activities: List[Dict[str, Any]], repeat: int,
+                  count: int = 50) -> Dict[str, Any]:
+    from app.services.strava import sync_activity_streams
+    from app.services.streams import stream_store, zone_summary, analyze_activity_streams
+
+    athlete_key = "streams"
+    activity_ids = [act["id"] for act in activities if act["type"] == "Run"][:count]
+
+    with ExitStack() as stack:
+        mocked_clients(stack, strava)
+
+        def cold():
+            strava.reset()
+            stream_store.clear(athlete_key)
+            errors = asyncio.run(sync_activity_streams("benchmark", athlete_key, activity_ids))
+            assert not errors, errors
+
+        results = {"streams.sync_cold": measure(cold, repeat, memory=False)}
+        results["streams.sync_stored"] = measure(
+            lambda: asyncio.run(sync_activity_streams("benchmark", athlete_key, activity_ids)), repeat)
+
+    results["streams.read"] = measure(
+        lambda: [stream_store.get(athlete_key, activity_id) for activity_id in activity_ids], repeat)
+    streams = [stream_store.get(athlete_key, activity_id) for activity_id in activity_ids]
+    results["streams.zone_summary"] = measure(lambda: zone_summary(streams, 3.5, None), repeat)
+    results["streams.analyze_activity"] = measure(
+        lambda: [analyze_activity_streams(activity_streams, "Run", 3.5) for activity_streams in streams], repeat)
+    return results
+
+def compare(base_path: str, head_path: str, metric: str = "median_ms"):
+    """Print how every benchmark in `head` changed relative to `base`"""
+    with open(base_path) as f:
+        base = json.load(f)["results"]
+    with open(head_path) as f:
+        head = json.load(f)["results"]
+    for name in sorted(set(base) | set(head)):
+        if name not in base or name not in head:
+            print(f"{name:45} {'only in ' + ('head' if name in head else 'base'):>30}")
+            continue
+        before, after = base[name][metric], head[name][metric]
+        change = (after - before) / before * 100 if before else 0.0
+        print(f"{name:45} {before:12.3f} -> {after:12.3f} {metric} ({change:+.1f}%)")
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--activities", type=int, default=2000, help="synthetic history length")
+    parser.add_argument("--days", type=int, default=730, help="time span of the history")
+    parser.add_argument("--sport-mix", default="Run=0.6,Ride=0.25,TrailRun=0.1,VirtualRun=0.05")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each Strava response")
+    parser.add_argument("--inference-latency", type=float, default=0.0, help="seconds added to each inference call")
+    parser.add_argument("--rate-limit", default="600,30000", help="mock Strava 15-minute,daily limits")
+    parser.add_argument("--athletes", type=int, default=30, help="club size for the group benchmark")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", action="append",
+                        choices=["fetch", "analysis", "recommendations", "endpoint", "streams", "startup"])
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "HEAD"), help="compare two result files")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    sport_mix = {sport: float(share) for sport, share in (item.split("=") for item in args.sport_mix.split(","))}
+    activities = generate_activities(args.activities, sport_mix, days=args.days, seed=args.seed)
+    strava = MockStrava(activities, latency=args.latency, inference_latency=args.inference_latency,
+                        rate_limit=tuple(int(limit) for limit in args.rate_limit.split(",")))
+
+    suites = args.only or ["fetch", "analysis", "recommendations", "endpoint", "streams", "startup"]
+    results: Dict[str, Any] = {}
+    if "fetch" in suites:
+        results.update(bench_fetch(strava, args.repeat))
+    if "analysis" in suites:
+        results.update(bench_analysis(activities, args.athletes, args.repeat))
+    if "recommendations" in suites:
+        results.update(bench_recommendations(strava, activities, args.repeat))
+    if "endpoint" in suites:
+        results.update(bench_endpoint(strava, args.repeat))
+    if "streams" in suites:
+        results.update(bench_streams(strava, activities, args.repeat))
+    if "startup" in suites:
+        # Fresh interpreters, so this measures a cold start whatever ran before
+        results.update(bench_startup(args.repeat)[0])
+
+    import numpy as np
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "params": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+            "strava_requests": strava.requests,
+            "strava_throttled": strava.throttled,
+        },
+        "results": results,
+    }
+    for name, result in results.items():
+        print(f"{name:45} median {result['median_ms']:10.3f} ms"
+              + (f"  peak {result['peak_memory_kb']:10.1f} KiB" if "peak_memory_kb" in result else ""))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
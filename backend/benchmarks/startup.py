@@ -0,0 +1,89 @@
+"""Cold start cost of the app: import time per module and warm-up time, each run in a fresh interpreter
+
+    python -m benchmarks.startup --runs 5 --top 20
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imports the app like the serverless entry point does, then runs the warm-up hook
+PROBE = """
+import asyncio, json, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+from app.main import warm_up
+steps = asyncio.run(warm_up())
+print(json.dumps({"import_ms": (imported - started) * 1000,
+                  "warm_up_ms": (time.perf_counter() - imported) * 1000, "steps": steps}))
+"""
+
+def parse_importtime(stderr: str) -> Dict[str, Tuple[int, int]]:
+    """(self, cumulative) microseconds per module from `python -X importtime` output"""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = (int(own), int(cumulative))
+    return modules
+
+def probe(env: Optional[Dict[str, str]] = None) -> Tuple[Dict[str, Any], Dict[str, Tuple[int, int]]]:
+    """One cold start in a new interpreter: its timings and its import profile"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", PROBE], cwd=BACKEND_DIR,
+                            capture_output=True, text=True, check=True, env=env)
+    return json.loads(result.stdout.strip().splitlines()[-1]), parse_importtime(result.stderr)
+
+def by_package(modules: Dict[str, Tuple[int, int]]) -> Dict[str, int]:
+    """Self import time summed per top-level package, app modules kept apart"""
+    totals: Dict[str, int] = {}
+    for name, (own, _) in modules.items():
+        package = name if name.startswith("app.") else name.split(".")[0]
+        totals[package] = totals.get(package, 0) + own
+    return totals
+
+def summarize(values: List[float]) -> Dict[str, Any]:
+    return {
+        "runs": len(values),
+        "min_ms": round(min(values), 3),
+        "median_ms": round(statistics.median(values), 3),
+        "mean_ms": round(statistics.fmean(values), 3),
+    }
+
+def bench_startup(runs: int) -> Tuple[Dict[str, Any], Dict[str, float]]:
+    """Import and warm-up timings over `runs` cold starts, and the median milliseconds per package"""
+    env = {**os.environ, "STRYDE_DATA_DIR": os.environ.get("STRYDE_DATA_DIR") or tempfile.mkdtemp()}
+    timings, packages = [], {}
+    for _ in range(runs):
+        timing, modules = probe(env)
+        timings.append(timing)
+        for package, own in by_package(modules).items():
+            packages.setdefault(package, []).append(own / 1000)
+    results = {
+        "startup.import_main": summarize([timing["import_ms"] for timing in timings]),
+        "startup.warm_up": summarize([timing["warm_up_ms"] for timing in timings]),
+    }
+    return results, {package: statistics.median(values) for package, values in packages.items()}
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=20, help="packages listed, slowest first")
+    args = parser.parse_args(argv)
+
+    results, packages = bench_startup(args.runs)
+    for name, result in results.items():
+        print(f"{name:45} median {result['median_ms']:10.3f} ms")
+    print("\nImport time per package (self time, median):")
+    for package, ms in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"  {package:43} {ms:10.3f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import math
+import random
+import time
+from typing import Any, Dict, List, Mapping, Optional
+
+# Share of each sport in a generated history
+DEFAULT_SPORT_MIX = {"Run": 0.6, "Ride": 0.25, "TrailRun": 0.1, "VirtualRun": 0.05}
+
+# (distance range m, speed range m/s) per sport
+SPORT_PROFILES = {
+    "Run": ((3000, 21000), (2.5, 4.5)),
+    "TrailRun": ((5000, 30000), (1.8, 3.5)),
+    "VirtualRun": ((3000, 15000), (2.5, 4.2)),
+    "Ride": ((15000, 120000), (6.0, 11.0)),
+}
+
+def _polyline(rng: random.Random, points: int) -> str:
+    # Strava's encoded polylines are a large share of each activity's JSON
+    return "".join(chr(rng.randint(63, 126)) for _ in range(points))
+
+def generate_activities(count: int, sport_mix: Optional[Mapping[str, float]] = None, days: int = 730,
+                        end: Optional[int] = None, seed: int = 0, polyline_points: int = 400) -> List[Dict[str, Any]]:
+    """Deterministic Strava-shaped activities, newest first like /athlete/activities
+
+    Start times are spread over the `days` before `end` (default: now, rounded to the day).
+    """
+    rng = random.Random(seed)
+    sport_mix = sport_mix or DEFAULT_SPORT_MIX
+    sports, weights = list(sport_mix), list(sport_mix.values())
+    end = end if end is not None else int(time.time()) // 86400 * 86400
+    starts = sorted((end - rng.randint(0, days * 86400) for _ in range(count)), reverse=True)
+
+    activities = []
+    for i, start in enumerate(starts):
+        sport = rng.choices(sports, weights)[0]
+        (min_distance, max_distance), (min_speed, max_speed) = SPORT_PROFILES.get(sport, SPORT_PROFILES["Run"])
+        distance = round(rng.uniform(min_distance, max_distance), 1)
+        speed = rng.uniform(min_speed, max_speed)
+        moving_time = int(distance / speed)
+        activities.append({
+            "resource_state": 2,
+            "athlete": {"id": 1, "resource_state": 1},
+            "name": f"Synthetic {sport} {i}",
+            "distance": distance,
+            "moving_time": moving_time,
+            "elapsed_time": moving_time + rng.randint(0, 600),
+            "total_elevation_gain": round(rng.uniform(0, distance / 50), 1),
+            "type": sport,
+            "sport_type": sport,
+            "id": 10_000_000 + count - i,
+            "start_date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(start)),
+            "start_date_local": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(start)),
+            "timezone": "(GMT+00:00) Europe/London",
+            "utc_offset": 0.0,
+            "achievement_count": rng.randint(0, 5),
+            "kudos_count": rng.randint(0, 30),
+            "comment_count": rng.randint(0, 3),
+            "map": {"id": f"a{i}", "summary_polyline": _polyline(rng, polyline_points), "resource_state": 2},
+            "trainer": sport == "VirtualRun",
+            "commute": False,
+            "manual": False,
+            "private": False,
+            "gear_id": None,
+            "start_latlng": [51.5 + rng.uniform(-0.1, 0.1), -0.1 + rng.uniform(-0.1, 0.1)],
+            "end_latlng": [51.5 + rng.uniform(-0.1, 0.1), -0.1 + rng.uniform(-0.1, 0.1)],
+            "average_speed": round(speed, 3),
+            "max_speed": round(speed * 1.4, 3),
+            "has_heartrate": True,
+            "average_heartrate": round(rng.uniform(120, 170), 1),
+            "max_heartrate": round(rng.uniform(170, 195), 1),
+            "elev_high": round(rng.uniform(10, 300), 1),
+            "elev_low": round(rng.uniform(0, 10), 1),
+            "pr_count": rng.randint(0, 2),
+        })
+    return activities
+
+def generate_streams(activity: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Strava-shaped 1 Hz streams (key_by_type) of a generated activity, deterministic per activity id"""
+    rng = random.Random(activity["id"])
+    seconds = max(int(activity["moving_time"]), 1)
+    average = activity["distance"] / seconds
+    velocity = [max(average * (1 + 0.15 * math.sin(t / 120) + rng.uniform(-0.05, 0.05)), 0.0) for t in range(seconds)]
+    scale = activity["distance"] / sum(velocity)
+    distance, covered = [], 0.0
+    for speed in velocity:
+        covered += speed * scale
+        distance.append(round(covered, 1))
+    heartrate = [round(activity.get("average_heartrate", 150) + 10 * math.sin(t / 120) + rng.uniform(-3, 3))
+                 for t in range(seconds)]
+
+    def stream(data: List[Any]) -> Dict[str, Any]:
+        return {"data": data, "series_type": "distance", "original_size": seconds, "resolution": "high"}
+
+    return {"time": stream(list(range(seconds))), "distance": stream(distance),
+            "heartrate": stream(heartrate), "velocity_smooth": stream([round(v * scale, 3) for v in velocity])}
@@ -0,0 +1,5 @@
+import os
+import tempfile
+
+# Keep the SQLite files the app creates on import out of the working tree
+os.environ.setdefault("STRYDE_DATA_DIR", tempfile.mkdtemp(prefix="stryde-tests-"))
@@ -102,3 +102,1455 @@ class TestUserProfile:
         data = response.json()
         assert data["username"] == "testuser"
         assert data["firstname"] == "Test"
+
+class TestActivitySync:
+    @patch('app.services.strava.fetch_user_activities')
+    def test_sync_only_requests_new_activities(self, mock_fetch, mock_activities_response):
+        import asyncio
+        from app.services.strava import sync_user_activities
+        from app.services.activity_store import activity_store
+
+        activity_store.clear("sync_athlete")
+        mock_fetch.return_value = mock_activities_response
+        assert asyncio.run(sync_user_activities("test_token", "sync_athlete")) == 2
+        assert mock_fetch.call_args.kwargs["after"] is None
+        assert [act.id for act in activity_store.get("sync_athlete")] == [2, 1]
+
+        newer_activity = {
+            "id": 3,
+            "type": "Run",
+            "distance": 8000,
+            "moving_time": 2700,
+            "start_date": "2024-01-03T10:00:00Z"
+        }
+        mock_fetch.return_value = [newer_activity]
+        assert asyncio.run(sync_user_activities("test_token", "sync_athlete")) == 1
+        assert mock_fetch.call_args.kwargs["after"] == 1704189600
+        assert [act.id for act in activity_store.get("sync_athlete")] == [3, 2, 1]
+
+class TestSharedHttpClient:
+    def test_client_is_reused_within_event_loop(self):
+        import asyncio
+        from app.services.http import get_http_client, close_http_client
+
+        async def get_twice():
+            first, second = get_http_client(), get_http_client()
+            await close_http_client()
+            return first, second
+
+        first, second = asyncio.run(get_twice())
+        assert first is second
+
+    def test_client_of_a_replaced_loop_is_closed(self):
+        import asyncio
+        import threading
+        import time
+        from app.services.http import get_http_client, close_http_client
+
+        async def get_client():
+            return get_http_client()
+
+        # Closed as its loop shuts down
+        shut_down = asyncio.run(get_client())
+        assert shut_down.is_closed
+
+        # Closed on its loop, still running in another thread, once another loop takes over
+        other_loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=other_loop.run_forever, daemon=True)
+        thread.start()
+        running = asyncio.run_coroutine_threadsafe(get_client(), other_loop).result()
+
+        async def replace():
+            client = get_http_client()
+            await close_http_client()
+            return client
+
+        assert asyncio.run(replace()) is not running
+        deadline = time.monotonic() + 5
+        while not running.is_closed and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert running.is_closed
+        other_loop.call_soon_threadsafe(other_loop.stop)
+        thread.join()
+
+    def test_lifespan_creates_and_closes_client(self):
+        from app.services import http
+
+        with TestClient(main.app) as client:
+            assert http._client is not None
+            assert client.get("/ping").status_code == 200
+        assert http._client is None
+
+class TestConcurrentActivityFetch:
+    def test_pages_fetched_in_one_window_and_merged_in_order(self):
+        import asyncio
+        import httpx
+        from app.services import strava
+
+        requested_pages = []
+
+        def handler(request):
+            page = int(request.url.params["page"])
+            requested_pages.append(page)
+            start = (page - 1) * 200
+            batch = [{"id": i, "type": "Run", "start_date": "2024-01-01T08:00:00Z"}
+                     for i in range(start, min(start + 200, 450))]
+            return httpx.Response(200, json=batch, headers={"X-RateLimit-Limit": "200,2000",
+                                                            "X-RateLimit-Usage": "10,100"})
+
+        mock_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        with patch.object(strava, "get_http_client", return_value=mock_client):
+            activities = asyncio.run(strava.fetch_user_activities("test_token", concurrency=5))
+
+        assert sorted(requested_pages) == [1, 2, 3, 4, 5]
+        assert [act.id for act in activities] == list(range(450))
+
+    def test_failed_page_stores_nothing(self):
+        import asyncio
+        import httpx
+        from app.services import strava
+        from app.services.activity_store import activity_store
+
+        def handler(request):
+            page = int(request.url.params["page"])
+            if page == 2:
+                return httpx.Response(500, json={"message": "error"})
+            start = (page - 1) * 200
+            batch = [{"id": i, "type": "Run", "start_date": f"2024-01-{1 + i % 28:02d}T08:00:00Z"}
+                     for i in range(start, min(start + 200, 450))]
+            return httpx.Response(200, json=batch)
+
+        activity_store.clear("partial")
+        mock_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        with patch.object(strava, "get_http_client", return_value=mock_client):
+            with pytest.raises(strava.StravaAPIError):
+                asyncio.run(strava.sync_user_activities("test_token", "partial"))
+        # The after= cursor stays put, the next sync starts over
+        assert activity_store.count("partial") == 0 and activity_store.latest_start("partial") is None
+        assert not activity_store.is_fresh("partial", 60)
+
+class TestStravaRateLimiter:
+    def test_no_delay_without_rate_limit_headers(self):
+        from app.services.ratelimit import StravaRateLimiter
+
+        assert StravaRateLimiter().delay() == 0
+
+    def test_slows_down_near_short_window_limit(self):
+        from app.services.ratelimit import StravaRateLimiter
+
+        limiter = StravaRateLimiter()
+        limiter.release({"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "10,100"}, 200)
+        assert limiter.delay() == 0
+        limiter.release({"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "85,100"}, 200)
+        assert 0 < limiter.delay() <= 15 * 60
+        assert limiter.allowed_concurrency(10) == 10
+        assert limiter.allowed_concurrency(20) == 10
+
+    def test_blocks_after_429_until_window_reset(self):
+        import asyncio
+        from app.services.ratelimit import StravaRateLimiter, StravaRateLimitError
+
+        limiter = StravaRateLimiter(max_wait=0)
+        limiter.release({"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "100,200"}, 429)
+        assert limiter.delay() > 0
+        with pytest.raises(StravaRateLimitError):
+            asyncio.run(limiter.acquire())
+
+class TestVolumeAnalysis:
+    def test_weekly_and_monthly_volume_shape(self, mock_activities_response):
+        from app.services.analysis import calculate_weekly_volume, calculate_monthly_volume, to_columns
+
+        columns = to_columns(mock_activities_response)
+        assert calculate_weekly_volume(columns) == [
+            {"week_start": "2024-01-01", "runs": 2, "distance_km": 15.0, "time_minutes": 90.0}
+        ]
+        assert calculate_monthly_volume(mock_activities_response) == [
+            {"month": "2024-01", "runs": 2, "distance_km": 15.0, "time_minutes": 90.0}
+        ]
+
+    def test_weeks_start_on_monday_newest_first(self):
+        from app.services.analysis import calculate_weekly_volume
+
+        activities = [
+            {"start_date": "2024-01-07T23:00:00Z", "distance": 1000, "moving_time": 300},  # Sunday
+            {"start_date": "2024-01-08T06:00:00Z", "distance": 2000, "moving_time": 600},  # Monday
+        ]
+        weeks = calculate_weekly_volume(activities)
+        assert [week["week_start"] for week in weeks] == ["2024-01-08", "2024-01-01"]
+        assert calculate_weekly_volume([]) == []
+
+class TestAggregateStore:
+    def test_rollups_follow_adds_edits_and_deletes(self, mock_activities_response):
+        from app.services.analysis import AggregateStore, aggregate_volume
+
+        store = AggregateStore()
+        store.apply("athlete", upserted=mock_activities_response)
+        assert store.read("athlete", "Run", "week", "week_start") == \
+            aggregate_volume(mock_activities_response, "week", "week_start")
+
+        edited = dict(mock_activities_response[1], distance=12000, start_date="2024-01-09T10:00:00Z")
+        store.apply("athlete", upserted=[edited], deleted_ids=[1])
+        assert store.read("athlete", "Run", "week", "week_start") == [
+            {"week_start": "2024-01-08", "runs": 1, "distance_km": 12.0, "time_minutes": 60.0}
+        ]
+        assert store.read("athlete", "Run", "month", "month") == [
+            {"month": "2024-01", "runs": 1, "distance_km": 12.0, "time_minutes": 60.0}
+        ]
+        assert store.read("athlete", "Ride", "week", "week_start") == []
+
+    def test_weekly_volume_reads_rollups_for_synced_athlete(self, mock_activities_response):
+        from app.services.activity_store import activity_store
+        from app.services.analysis import calculate_weekly_volume
+
+        activity_store.clear("rollup_athlete")
+        activity_store.add("rollup_athlete", mock_activities_response)
+        activity_store.remove("rollup_athlete", [2])
+        assert calculate_weekly_volume([], athlete_key="rollup_athlete") == [
+            {"week_start": "2024-01-01", "runs": 1, "distance_km": 5.0, "time_minutes": 30.0}
+        ]
+
+    def test_least_recently_used_athletes_are_evicted_and_rebuilt(self, tmp_path, mock_activities_response):
+        from app.services.activity_db import ActivityDatabase
+        from app.services.activity_store import ActivityStore
+        from app.services.analysis import AggregateStore, calculate_weekly_volume
+
+        rollups = AggregateStore(max_athletes=2)
+        for athlete in ("a", "b", "c"):
+            rollups.apply(athlete, upserted=mock_activities_response)
+            rollups.read("a", "Run", "week", "week_start")
+        assert rollups.has("a") and not rollups.has("b") and rollups.has("c")
+
+        store = ActivityStore(ActivityDatabase(str(tmp_path / "activities.db")))
+        store.add("evicted", mock_activities_response)
+        expected = calculate_weekly_volume(None, athlete_key="evicted")
+        with patch("app.services.activity_store.aggregate_store", rollups), \
+                patch("app.services.analysis.aggregate_store", rollups):
+            assert not store.rollups_current("evicted")
+            store.ensure_rollups("evicted")
+            assert calculate_weekly_volume(None, athlete_key="evicted") == expected
+
+    def test_volume_payload_survives_rollups_evicted_right_after_rebuild(self, tmp_path, mock_activities_response):
+        import asyncio
+        from app.api.training import build_volume_payload
+        from app.services.activity_db import ActivityDatabase
+        from app.services.activity_store import ActivityStore
+        from app.services.analysis import AggregateStore
+
+        store = ActivityStore(ActivityDatabase(str(tmp_path / "activities.db")))
+        rollups = AggregateStore(max_athletes=0)
+        with patch("app.services.activity_store.aggregate_store", rollups), \
+                patch("app.services.analysis.aggregate_store", rollups), \
+                patch("app.api.training.activity_store", store):
+            store.add("evicted_payload", mock_activities_response)
+            payload = asyncio.run(build_volume_payload("evicted_payload"))["payload"]
+        assert not rollups.has("evicted_payload")
+        assert payload["weekly_volume"] == [
+            {"week_start": "2024-01-01", "runs": 2, "distance_km": 15.0, "time_minutes": 90.0}
+        ]
+
+class TestSessionStore:
+    def test_memory_store_evicts_least_recently_used(self):
+        from app.services.sessions import MemorySessionStore
+
+        store = MemorySessionStore(max_size=2)
+        store["a"] = {"authenticated": False}
+        store["b"] = {"authenticated": False}
+        assert "a" in store
+        store["c"] = {"authenticated": False}
+        assert sorted(store.keys()) == ["a", "c"]
+
+    def test_memory_store_expires_entries(self):
+        from app.services.sessions import MemorySessionStore
+
+        store = MemorySessionStore()
+        store.set("pending", {"authenticated": False}, ttl=0)
+        assert "pending" not in store
+        assert store.get("pending") is None
+
+    def test_sqlite_store_is_shared_between_instances(self, tmp_path):
+        from app.services.sessions import SQLiteSessionStore
+
+        path = str(tmp_path / "sessions.db")
+        worker_a = SQLiteSessionStore(path, max_size=2)
+        worker_b = SQLiteSessionStore(path, max_size=2)
+        worker_a["state"] = {"authenticated": True, "access_token": "token", "athlete": {"id": 1}}
+        assert worker_b["state"]["athlete"] == {"id": 1}
+
+        worker_b.set("expired", {"authenticated": False}, ttl=0)
+        assert "expired" not in worker_a
+        worker_a["second"] = {"authenticated": False}
+        worker_a["third"] = {"authenticated": False}
+        assert len(worker_b) == 2
+        with pytest.raises(KeyError):
+            worker_b["state"]
+
+    def test_expired_sessions_are_not_counted(self, tmp_path):
+        from app.services.sessions import MemorySessionStore, SQLiteSessionStore, SessionStore
+
+        with pytest.raises(TypeError):
+            SessionStore()
+        for store in (MemorySessionStore(), SQLiteSessionStore(str(tmp_path / "sessions.db"))):
+            store["live"] = {"authenticated": True}
+            store.set("expired", {"authenticated": False}, ttl=0)
+            assert len(store) == 1 and store.keys() == ["live"]
+
+    def test_sqlite_reads_write_the_access_time_at_most_once_per_interval(self, tmp_path):
+        import time
+        from app.services.sessions import SQLiteSessionStore, ACCESS_WRITE_INTERVAL
+
+        store = SQLiteSessionStore(str(tmp_path / "sessions.db"))
+        now = time.time()
+        with patch("app.services.sessions.time.time", return_value=now):
+            store["state"] = {"authenticated": True}
+        for offset in (1, ACCESS_WRITE_INTERVAL - 1, ACCESS_WRITE_INTERVAL):
+            with patch("app.services.sessions.time.time", return_value=now + offset):
+                assert store["state"] == {"authenticated": True}
+        accessed_at = store._conn.execute("SELECT accessed_at FROM sessions").fetchone()[0]
+        assert accessed_at == now + ACCESS_WRITE_INTERVAL
+
+class TestConditionalResponses:
+    @patch('app.api.training.get_cached_training_recommendations', return_value={"focus": "base"})
+    @patch('app.services.strava.fetch_user_activities')
+    def test_unchanged_volume_returns_304_without_syncing(self, mock_fetch, mock_plan, client,
+                                                          mock_activities_response):
+        from app.services.sessions import user_sessions
+        from app.services.activity_store import activity_store
+
+        activity_store.clear("777")
+        user_sessions["etag_state"] = {"authenticated": True, "access_token": "test_token", "athlete": {"id": 777}}
+        mock_fetch.return_value = mock_activities_response
+
+        first = client.get("/training/volume?state=etag_state")
+        assert first.status_code == 200
+        assert first.json()["total_activities"] == 2
+        etag = first.headers["ETag"]
+
+        second = client.get("/training/volume?state=etag_state", headers={"If-None-Match": etag})
+        assert second.status_code == 304
+        assert mock_fetch.call_count == 1
+
+        activity_store.add("777", [dict(mock_activities_response[0], id=3, start_date="2024-01-05T10:00:00Z")])
+        third = client.get("/training/volume?state=etag_state", headers={"If-None-Match": etag})
+        assert third.status_code == 200
+        assert third.headers["ETag"] != etag
+        assert third.json()["total_activities"] == 3
+
+    def test_profile_supports_if_none_match(self, client, mock_strava_response):
+        from app.services.sessions import user_sessions
+
+        user_sessions["profile_state"] = {"authenticated": True, "access_token": "test_token",
+                                          "athlete": mock_strava_response}
+        first = client.get("/user/profile?state=profile_state")
+        assert first.status_code == 200
+        second = client.get("/user/profile?state=profile_state", headers={"If-None-Match": first.headers["ETag"]})
+        assert second.status_code == 304
+
+class TestPlanCache:
+    @patch('app.services.rag.query_huggingface')
+    def test_concurrent_requests_share_one_inference_call(self, mock_query, mock_activities_response):
+        import asyncio
+        import json
+        from app.services import rag
+
+        async def slow_plan(prompt):
+            await asyncio.sleep(0.01)
+            return json.dumps({"week_plan": [], "focus": "base"})
+
+        async def three_dashboards():
+            return await asyncio.gather(*(rag.generate_training_recommendations(mock_activities_response)
+                                          for _ in range(3)))
+
+        rag.plan_cache.clear()
+        mock_query.side_effect = slow_plan
+        plans = asyncio.run(three_dashboards())
+        assert plans == [{"week_plan": [], "focus": "base"}] * 3
+        assert mock_query.call_count == 1
+
+        asyncio.run(rag.generate_training_recommendations(mock_activities_response))
+        assert mock_query.call_count == 1
+
+        newer_run = dict(mock_activities_response[0], id=3, distance=7000)
+        asyncio.run(rag.generate_training_recommendations([newer_run] + mock_activities_response))
+        assert mock_query.call_count == 2
+
+class TestBackgroundPlanJobs:
+    @patch('app.services.rag.query_huggingface')
+    @patch('app.services.strava.fetch_user_activities')
+    def test_volume_returns_before_plan_is_enriched(self, mock_fetch, mock_query, mock_activities_response):
+        import asyncio
+        import json
+        from app.services import rag
+        from app.services.sessions import user_sessions
+        from app.services.activity_store import activity_store
+
+        plan_released = asyncio.Event()
+
+        async def blocked_plan(prompt):
+            await plan_released.wait()
+            return json.dumps({"focus": "base"})
+
+        rag.plan_cache.clear()
+        activity_store.clear("888")
+        user_sessions["job_state"] = {"authenticated": True, "access_token": "test_token", "athlete": {"id": 888}}
+        mock_fetch.return_value = mock_activities_response
+        mock_query.side_effect = blocked_plan
+
+        with TestClient(main.app) as client, patch.dict("os.environ", {"STRYDE_PLAN_ENRICHMENT": "true"}):
+            volume = client.get("/training/volume?state=job_state").json()
+            assert volume["weekly_volume"][0]["runs"] == 2
+            # The local plan is served right away, the model only enriches it
+            assert volume["calendar"]["source"] == "planner"
+            job_url = volume["calendar_job"]["url"]
+            assert client.get(job_url).json()["status"] == "running"
+
+            client.portal.call(plan_released.set)
+            plan = client.get(f"{job_url}?wait=5").json()
+            assert plan["status"] == "done"
+            assert plan["calendar"]["enrichment"] == {"focus": "base"}
+
+            events = client.get(volume["calendar_job"]["events_url"]).text
+            assert '"enrichment": {"focus": "base"}' in events
+            calendar = client.get("/training/volume?state=job_state").json()["calendar"]
+            assert calendar["source"] == "planner+model" and calendar["days"] == volume["calendar"]["days"]
+
+    def test_unknown_plan_job_is_404(self, client):
+        assert client.get("/training/plan/missing").status_code == 404
+
+class TestStreamingVolume:
+    def test_stream_sends_partial_pages_then_final_payload(self, client):
+        import json
+        from app.services.sessions import user_sessions
+        from app.services.activity_store import activity_store
+        from app.models.activity import Activity
+
+        pages = [
+            [{"id": i, "type": "Run", "distance": 5000, "moving_time": 1500,
+              "start_date": f"2024-02-{i + 1:02d}T08:00:00Z"} for i in range(20, 0, -1)],
+            [{"id": 0, "type": "Ride", "distance": 30000, "moving_time": 3600,
+              "start_date": "2024-01-15T08:00:00Z"}],
+        ]
+
+        async def fake_pages(access_token, max_pages=10, after=None, concurrency=None):
+            for page in pages:
+                yield [Activity.from_strava(act) for act in page]
+
+        activity_store.clear("999")
+        user_sessions["stream_state"] = {"authenticated": True, "access_token": "test_token", "athlete": {"id": 999}}
+        with patch("app.api.training.iter_user_activity_pages", side_effect=fake_pages):
+            response = client.get("/training/volume/stream?state=stream_state")
+
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        events = [json.loads(line) for line in response.text.splitlines()]
+        assert [event["type"] for event in events] == ["partial", "partial", "final"]
+        assert events[0]["activities_fetched"] == 20
+        assert events[1]["monthly_volume"] == events[2]["monthly_volume"]
+        assert events[2]["total_activities"] == 20
+        assert len(activity_store.get("999")) == 21
+
+    def test_failed_page_ends_stream_without_storing(self, client):
+        import json
+        from app.services.sessions import user_sessions
+        from app.services.activity_store import activity_store
+        from app.services.strava import StravaAPIError
+        from app.models.activity import Activity
+
+        async def fake_pages(access_token, max_pages=10, after=None, concurrency=None):
+            yield [Activity.from_strava({"id": 1, "type": "Run", "distance": 5000, "moving_time": 1500,
+                                         "start_date": "2024-02-01T08:00:00Z"})]
+            raise StravaAPIError(500, "Strava returned 500 for activity page 2")
+
+        activity_store.clear("998")
+        user_sessions["stream_fail"] = {"authenticated": True, "access_token": "test_token", "athlete": {"id": 998}}
+        with patch("app.api.training.iter_user_activity_pages", side_effect=fake_pages):
+            response = client.get("/training/volume/stream?state=stream_fail")
+
+        events = [json.loads(line) for line in response.text.splitlines()]
+        assert [event["type"] for event in events] == ["partial", "error"] and events[1]["status_code"] == 502
+        assert activity_store.count("998") == 0 and not activity_store.is_fresh("998", 60)
+
+class TestStravaWebhooks:
+    def test_subscription_handshake(self, client):
+        with patch.dict("os.environ", {"STRAVA_VERIFY_TOKEN": "stryde"}):
+            response = client.get("/webhooks/strava?hub.mode=subscribe&hub.challenge=abc&hub.verify_token=stryde")
+            assert response.json() == {"hub.challenge": "abc"}
+            response = client.get("/webhooks/strava?hub.mode=subscribe&hub.challenge=abc&hub.verify_token=wrong")
+            assert response.status_code == 403
+
+    @patch('app.services.webhooks.fetch_activity')
+    def test_replayed_events_update_stored_activities(self, mock_fetch_activity, mock_activities_response):
+        import asyncio
+        import json
+        import os
+        from app.services.webhooks import replay_events
+        from app.services.sessions import user_sessions, athlete_session_key
+        from app.services.activity_store import activity_store
+        from app.services.analysis import calculate_weekly_volume
+
+        fetched = {
+            3: {"id": 3, "type": "Run", "distance": 8000, "moving_time": 2700, "start_date": "2024-01-04T10:00:00Z"},
+            2: dict(mock_activities_response[1], name="Long run", distance=21000),
+        }
+        mock_fetch_activity.side_effect = lambda token, activity_id: fetched.get(activity_id)
+
+        activity_store.clear("4242")
+        activity_store.add("4242", mock_activities_response)
+        user_sessions[athlete_session_key(4242)] = {"authenticated": True, "access_token": "test_token",
+                                                    "athlete": {"id": 4242}}
+        with open(os.path.join(os.path.dirname(__file__), "fixtures", "webhook_events.json")) as f:
+            events = json.load(f)
+
+        outcomes = asyncio.run(replay_events(events))
+        assert outcomes == ["created", "updated", "deleted", "skipped"]
+        assert [act.id for act in activity_store.get("4242")] == [3, 2]
+        assert calculate_weekly_volume([], athlete_key="4242") == [
+            {"week_start": "2024-01-01", "runs": 2, "distance_km": 29.0, "time_minutes": 105.0}
+        ]
+        assert activity_store.latest_start("5151") is None
+
+    @patch('app.services.webhooks.fetch_activity', return_value=None)
+    def test_received_events_are_processed_by_the_worker(self, mock_fetch_activity, mock_activities_response):
+        from app.services.webhooks import webhook_queue
+        from app.services.sessions import user_sessions, athlete_session_key
+        from app.services.activity_store import activity_store
+
+        activity_store.clear("4343")
+        activity_store.add("4343", mock_activities_response)
+        user_sessions[athlete_session_key(4343)] = {"authenticated": True, "access_token": "test_token",
+                                                    "athlete": {"id": 4343}}
+        event = {"object_type": "activity", "object_id": 1, "aspect_type": "delete", "owner_id": 4343,
+                 "subscription_id": 1}
+        with patch.dict("os.environ", {"STRAVA_VERIFY_TOKEN": "stryde", "STRAVA_SUBSCRIPTION_ID": "1"}):
+            with TestClient(main.app) as client:
+                assert client.post("/webhooks/strava", json=event).json() == {"status": "received"}
+                client.portal.call(webhook_queue.join)
+        assert [act.id for act in activity_store.get("4343")] == [2]
+
+    def test_events_refused_without_configured_subscription(self, client):
+        event = {"object_type": "activity", "object_id": 1, "aspect_type": "delete", "owner_id": 4343,
+                 "subscription_id": 2}
+        with patch.dict("os.environ", {"STRAVA_VERIFY_TOKEN": ""}):
+            assert client.post("/webhooks/strava", json=event).status_code == 404
+        with patch.dict("os.environ", {"STRAVA_VERIFY_TOKEN": "stryde", "STRAVA_SUBSCRIPTION_ID": "1"}):
+            assert client.post("/webhooks/strava", json=event).status_code == 403
+
+    @patch('app.services.webhooks.fetch_activity')
+    def test_forged_events_confirmed_with_strava(self, mock_fetch_activity, mock_activities_response):
+        import asyncio
+        from app.services.webhooks import process_event
+        from app.services.sessions import user_sessions, athlete_session_key
+        from app.services.activity_store import activity_store
+        from app.services.strava import StravaAPIError
+        from app.services.tokens import token_vault
+
+        activity_store.clear("4444")
+        activity_store.add("4444", mock_activities_response)
+        user_sessions[athlete_session_key(4444)] = {"authenticated": True, "access_token": "test_token",
+                                                    "athlete": {"id": 4444}}
+        token_vault.save(4444, {"access_token": "a1", "refresh_token": "r1", "expires_at": 4102444800})
+        mock_fetch_activity.return_value = mock_activities_response[0]
+
+        delete = {"object_type": "activity", "object_id": 1, "aspect_type": "delete", "owner_id": 4444}
+        assert asyncio.run(process_event(delete)) == "updated"
+        assert sorted(act.id for act in activity_store.get("4444")) == [1, 2]
+
+        deauthorize = {"object_type": "athlete", "object_id": 4444, "aspect_type": "update", "owner_id": 4444,
+                       "updates": {"authorized": "false"}}
+        renewed = {"access_token": "a2", "refresh_token": "r2", "expires_at": 4102444800}
+        with patch("app.services.tokens.refresh_access_token", return_value=renewed):
+            assert asyncio.run(process_event(deauthorize)) == "ignored"
+        assert len(activity_store.get("4444")) == 2
+        with patch("app.services.tokens.refresh_access_token", side_effect=StravaAPIError(400, "invalid_grant")):
+            assert asyncio.run(process_event(deauthorize)) == "deauthorized"
+        assert activity_store.latest_start("4444") is None and token_vault.load(4444) is None
+
+    def test_events_left_on_stop_trigger_a_full_sync(self, mock_activities_response):
+        import asyncio
+        from app.services.webhooks import WebhookQueue
+        from app.services.activity_store import activity_store
+
+        activity_store.clear("4545")
+        activity_store.add("4545", mock_activities_response)
+
+        async def stalled(event):
+            await asyncio.sleep(60)
+
+        async def run():
+            queue = WebhookQueue()
+            await queue.start()
+            for object_id in (1, 2):
+                queue.enqueue({"object_type": "activity", "object_id": object_id, "aspect_type": "update",
+                               "owner_id": 4545})
+            await asyncio.sleep(0)
+            await queue.stop(timeout=0.01)
+
+        with patch("app.services.webhooks.process_event", side_effect=stalled):
+            asyncio.run(run())
+        assert activity_store.latest_start("4545") is None
+
+class TestActivityDatabase:
+    def test_store_survives_restart_and_serves_indexed_queries(self, tmp_path, mock_activities_response):
+        from app.services.activity_db import ActivityDatabase
+        from app.services.activity_store import ActivityStore
+        from app.services.analysis import to_columns
+
+        path = str(tmp_path / "activities.db")
+        ride = {"id": 5, "type": "Ride", "distance": 40000, "moving_time": 5400, "start_date": "2024-01-03T10:00:00Z",
+                "map": {"summary_polyline": "abc"}}
+        ActivityStore(ActivityDatabase(path)).add("athlete", mock_activities_response + [ride])
+
+        restarted = ActivityStore(ActivityDatabase(path))
+        assert restarted.latest_start("athlete") == 1704276000
+        assert restarted.count("athlete", types=["Run"]) == 2
+        assert [act.id for act in restarted.query("athlete", types=["Run"], limit=1)] == [2]
+        ride = restarted.query("athlete", types=["Ride"])[0]
+        assert ride.start_date == "2024-01-03T10:00:00Z" and not hasattr(ride, "map")
+        assert [act.id for act in restarted.query("athlete", start=1704103201, end=1704189601)] == [2]
+
+        columns = restarted.query_columns("athlete", types=["Run"])
+        expected = to_columns(restarted.query("athlete", types=["Run"]))
+        assert columns.start.tolist() == expected.start.tolist()
+        assert columns.distance.tolist() == [10000.0, 5000.0]
+
+    def test_rollups_rebuilt_after_another_worker_writes(self, tmp_path, mock_activities_response):
+        from app.services.activity_db import ActivityDatabase
+        from app.services.activity_store import ActivityStore
+        from app.services.analysis import calculate_weekly_volume
+
+        path = str(tmp_path / "activities.db")
+        worker_a, worker_b = ActivityStore(ActivityDatabase(path)), ActivityStore(ActivityDatabase(path))
+        worker_a.clear("shared")
+        worker_a.add("shared", mock_activities_response[:1])
+        worker_b.add("shared", mock_activities_response[1:])
+
+        worker_a.ensure_rollups("shared")
+        assert calculate_weekly_volume(None, athlete_key="shared")[0]["runs"] == 2
+
+    def test_rebuild_runs_unlocked_and_keeps_writes_made_meanwhile(self, tmp_path, mock_activities_response):
+        from app.services.activity_db import ActivityDatabase
+        from app.services.activity_store import ActivityStore
+        from app.services.analysis import AggregateStore, calculate_weekly_volume
+
+        store = ActivityStore(ActivityDatabase(str(tmp_path / "activities.db")))
+        store.clear("rebuilt")
+        store.add("rebuilt", mock_activities_response[:1])
+        store.db.bump_version("rebuilt")
+        build, writes = AggregateStore.build.__func__, []
+
+        def build_with_write(cls, athlete_key, activities):
+            assert not store._lock.locked()
+            if not writes:
+                writes.append(athlete_key)
+                store.add(athlete_key, mock_activities_response[1:])
+            return build(cls, athlete_key, activities)
+
+        with patch.object(AggregateStore, "build", classmethod(build_with_write)):
+            store.ensure_rollups("rebuilt")
+        assert store.rollups_current("rebuilt")
+        assert calculate_weekly_volume(None, athlete_key="rebuilt")[0]["runs"] == 2
+
+class TestActivityRecord:
+    def test_strava_json_projected_to_slotted_record(self):
+        from app.models.activity import Activity
+
+        activity = Activity.from_strava({"id": 7, "type": "Run", "start_date": "2024-01-01T08:00:00Z",
+                                         "distance": 5000, "moving_time": 1500, "average_heartrate": None,
+                                         "map": {"summary_polyline": "abc"}, "athlete": {"id": 1}})
+        assert activity.start == 1704096000
+        assert activity.start_date == "2024-01-01T08:00:00Z"
+        assert activity.distance == 5000.0 and activity.average_heartrate is None
+        assert not hasattr(activity, "__dict__")
+        assert Activity.coerce(activity) is activity
+
+class TestStreamingJsonParsing:
+    def test_array_elements_decoded_across_chunk_boundaries(self):
+        import asyncio
+        import json
+        from app.utils.jsonstream import iter_json_array
+
+        items = [{"id": 1, "name": "Morning \"Run\""}, 12345, [1, 2], "x", None]
+        text = json.dumps(items)
+
+        async def chunks(size):
+            for i in range(0, len(text), size):
+                yield text[i:i + size]
+
+        async def collect(size):
+            return [item async for item in iter_json_array(chunks(size))]
+
+        for size in (1, 3, 7, len(text)):
+            assert asyncio.run(collect(size)) == items
+
+    def test_truncated_array_is_an_error(self):
+        import asyncio
+        from app.utils.jsonstream import iter_json_array
+
+        async def chunks():
+            yield '[{"id": 1}, {"id"'
+
+        async def collect():
+            return [item async for item in iter_json_array(chunks())]
+
+        with pytest.raises(ValueError):
+            asyncio.run(collect())
+
+    def test_types_filtered_while_parsing_without_ending_pagination_early(self):
+        import asyncio
+        import httpx
+        from app.services import strava
+
+        def handler(request):
+            page = int(request.url.params["page"])
+            count = 200 if page == 1 else 10
+            batch = [{"id": page * 1000 + i, "type": "Run" if i % 4 == 0 else "Ride",
+                      "start_date": "2024-01-01T08:00:00Z", "map": {"summary_polyline": "abc"}}
+                     for i in range(count)]
+            return httpx.Response(200, json=batch)
+
+        mock_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        with patch.object(strava, "get_http_client", return_value=mock_client):
+            runs = asyncio.run(strava.fetch_user_activities("test_token", concurrency=1, types={"Run"}))
+
+        assert len(runs) == 50 + 3
+        assert {act.type for act in runs} == {"Run"}
+
+class TestTrainingPipeline:
+    def test_fused_pass_matches_separate_aggregations(self, mock_activities_response):
+        from app.services.analysis import aggregate_volume
+        from app.services.pipeline import Aggregator, Pipeline, VolumeAggregator, CountAggregator, PaceAggregator
+
+        ride = {"id": 3, "type": "Ride", "distance": 40000, "moving_time": 5400, "start_date": "2024-01-03T10:00:00Z"}
+        results = Pipeline(types=["Run"]).aggregate(
+            weekly=VolumeAggregator("week", "week_start", limit=8),
+            monthly=VolumeAggregator("month", "month", limit=6),
+            count=CountAggregator(),
+            pace=PaceAggregator(),
+        ).feed(mock_activities_response[:1]).feed(mock_activities_response[1:] + [ride]).results()
+
+        assert results["weekly"] == aggregate_volume(mock_activities_response, "week", "week_start", limit=8)
+        assert results["monthly"] == aggregate_volume(mock_activities_response, "month", "month", limit=6)
+        assert results["count"] == 2
+        assert results["pace"]["distance_km"] == 15.0
+        assert results["pace"]["best_pace_min_km"] == 6.0
+        with pytest.raises(TypeError):
+            Aggregator()
+
+    def test_store_source_pushes_filter_and_limit_into_query(self, mock_activities_response):
+        from app.services.activity_store import activity_store
+        from app.services.pipeline import Pipeline, RecentAggregator
+
+        activity_store.clear("pipeline")
+        activity_store.add("pipeline", mock_activities_response + [
+            {"id": 3, "type": "Ride", "distance": 40000, "moving_time": 5400, "start_date": "2024-01-03T10:00:00Z"}
+        ])
+        recent = Pipeline(types=["Run"]).aggregate(recent=RecentAggregator(1)).run_store(
+            activity_store, "pipeline", limit=1)["recent"]
+        assert recent.start.tolist() == [1704189600]
+
+    @patch('app.services.strava.fetch_user_activities')
+    def test_volume_for_another_sport(self, mock_fetch, client, mock_activities_response):
+        from app.services.sessions import user_sessions
+        from app.services.activity_store import activity_store
+
+        activity_store.clear("888")
+        user_sessions["sport_state"] = {"authenticated": True, "access_token": "test_token", "athlete": {"id": 888}}
+        mock_fetch.return_value = mock_activities_response + [
+            {"id": 3, "type": "Ride", "distance": 40000, "moving_time": 5400, "start_date": "2024-01-03T10:00:00Z"}
+        ]
+
+        rides = client.get("/training/volume?state=sport_state&sport=Ride").json()
+        runs = client.get("/training/volume?state=sport_state").json()
+        assert rides["sport"] == "Ride" and rides["total_activities"] == 1
+        assert rides["weekly_volume"][0]["distance_km"] == 40.0
+        assert runs["total_activities"] == 2
+        assert mock_fetch.call_count == 1
+        assert rides["calendar"]["days"][-1]["workout"] == "Long Ride"
+        assert runs["calendar"]["days"][-1]["workout"] == "Long Run"
+        assert client.get("/training/volume?state=sport_state&sport=Swim").status_code == 422
+
+class TestTokenVault:
+    def test_tokens_are_encrypted_at_rest(self):
+        from app.services.sessions import MemorySessionStore
+        from app.services.tokens import TokenVault
+
+        store = MemorySessionStore()
+        vault = TokenVault(store, b"k" * 32)
+        vault.save(1, {"access_token": "secret-access", "refresh_token": "secret-refresh", "expires_at": 2})
+
+        assert "secret" not in store.get("tokens:1")["tokens"]
+        assert vault.load(1)["refresh_token"] == "secret-refresh"
+        assert TokenVault(store, b"x" * 32).load(1) is None
+
+    def test_concurrent_refreshes_share_one_request(self):
+        import asyncio
+        import time
+        from app.services.sessions import MemorySessionStore
+        from app.services.tokens import TokenVault
+
+        vault = TokenVault(MemorySessionStore(), b"k" * 32, refresh_margin=600)
+        vault.save(1, {"access_token": "old", "refresh_token": "r1", "expires_at": int(time.time()) + 60})
+
+        async def fake_refresh(refresh_token):
+            await asyncio.sleep(0.01)
+            return {"access_token": "new", "refresh_token": "r2", "expires_at": int(time.time()) + 6 * 3600}
+
+        async def get_many():
+            return await asyncio.gather(*(vault.get_access_token(1) for _ in range(5)))
+
+        with patch("app.services.tokens.refresh_access_token", side_effect=fake_refresh) as mock_refresh:
+            assert asyncio.run(get_many()) == ["new"] * 5
+            assert asyncio.run(vault.refresh_expiring()) == 0
+        assert mock_refresh.call_count == 1
+        assert vault.load(1)["refresh_token"] == "r2"
+
+    def test_vault_survives_session_eviction_and_expiry(self, tmp_path):
+        import time
+        from app.services.sessions import SQLiteSessionStore
+        from app.services.tokens import TokenVault
+
+        path = str(tmp_path / "sessions.db")
+        sessions = SQLiteSessionStore(path, max_size=2, ttl=60)
+        vault = TokenVault(SQLiteSessionStore(path, max_size=None, table="tokens"), b"k" * 32)
+        vault.save(1, {"access_token": "a1", "refresh_token": "r1", "expires_at": 2})
+        for i in range(5):
+            sessions[f"pending_{i}"] = {"authenticated": False}
+        with patch("app.services.sessions.time.time", return_value=time.time() + 30 * 24 * 3600):
+            assert vault.load(1)["access_token"] == "a1"
+        assert len(sessions) == 2
+
+    def test_shared_vault_requires_a_key(self):
+        from app.services.tokens import load_token_key
+
+        with patch.dict("os.environ", {"STRYDE_SESSION_BACKEND": "sqlite", "STRYDE_TOKEN_KEY": ""}):
+            with pytest.raises(RuntimeError):
+                load_token_key()
+        with patch.dict("os.environ", {"STRYDE_SESSION_BACKEND": "memory", "STRYDE_TOKEN_KEY": ""}):
+            assert len(load_token_key()) == 32
+
+    @patch('app.api.auth.fetch_strava_user')
+    @patch('app.api.auth.exchange_code_for_token')
+    def test_callback_keeps_tokens_out_of_the_session(self, mock_exchange, mock_user, client):
+        from app.services.sessions import user_sessions
+        from app.services.tokens import token_vault
+
+        mock_exchange.return_value = {"access_token": "a1", "refresh_token": "r1", "expires_at": 4102444800}
+        mock_user.return_value = {"id": 6161, "username": "vault"}
+        user_sessions["vault_state"] = {"authenticated": False}
+
+        response = client.get("/auth/callback?code=c&state=vault_state", follow_redirects=False)
+        assert response.status_code == 307
+        assert "access_token" not in user_sessions["vault_state"]
+        assert token_vault.load(6161) == {"access_token": "a1", "refresh_token": "r1", "expires_at": 4102444800}
+
+    def test_failed_refresh_requires_new_login(self, client):
+        from app.services.sessions import user_sessions
+        from app.services.tokens import token_vault
+
+        token_vault.save(6262, {"access_token": "a1", "refresh_token": "r1", "expires_at": 0})
+        user_sessions["expired_state"] = {"authenticated": True, "athlete": {"id": 6262}}
+        with patch("app.services.tokens.refresh_access_token", side_effect=Exception("invalid_grant")):
+            response = client.get("/training/volume?state=expired_state")
+        assert response.status_code == 401
+
+class TestBatchVolume:
+    def test_group_volume_matches_per_athlete_aggregation(self, mock_activities_response):
+        from app.services.analysis import aggregate_group_volume, aggregate_volume, to_columns
+
+        other = [{"id": 9, "type": "Run", "distance": 3000, "moving_time": 1000, "start_date": "2024-01-09T10:00:00Z"}]
+        per_athlete, group = aggregate_group_volume(
+            {"a": to_columns(mock_activities_response), "b": to_columns(other), "c": to_columns([])},
+            "week", "week_start", limit=8)
+
+        assert per_athlete["a"] == aggregate_volume(mock_activities_response, "week", "week_start")
+        assert per_athlete["c"] == []
+        assert [(row["week_start"], row["runs"], row["athletes"]) for row in group] == [
+            ("2024-01-08", 1, 1), ("2024-01-01", 2, 1)
+        ]
+
+    def test_batch_syncs_athletes_concurrently_and_reports_failures(self, client, mock_activities_response):
+        from app.services.sessions import user_sessions
+        from app.services.activity_store import activity_store
+        from app.services.ratelimit import StravaRateLimitError
+        from app.services.strava import StravaAPIError
+
+        for athlete in ("701", "702", "703"):
+            activity_store.clear(athlete)
+        activity_store.add("702", mock_activities_response[:1])
+        user_sessions["coach_a"] = {"authenticated": True, "access_token": "token_a", "athlete": {"id": 701}}
+        user_sessions["coach_b"] = {"authenticated": True, "access_token": "token_b", "athlete": {"id": 702}}
+        user_sessions["coach_c"] = {"authenticated": True, "access_token": "token_c", "athlete": {"id": 703}}
+
+        async def fake_fetch(access_token, after=None, **kwargs):
+            if access_token == "token_b":
+                raise StravaRateLimitError("Strava rate limit exceeded")
+            if access_token == "token_c":
+                raise StravaAPIError(401, "Strava returned 401 for activity page 1")
+            return mock_activities_response
+
+        with patch("app.services.strava.fetch_user_activities", side_effect=fake_fetch):
+            response = client.post("/training/batch", json={"states": ["coach_a", "coach_b", "coach_c", "missing"]})
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["athletes"]["coach_a"]["total_activities"] == 2
+        assert data["athletes"]["coach_b"]["total_activities"] == 1
+        assert "rate limit" in data["athletes"]["coach_b"]["error"]
+        assert data["athletes"]["coach_c"]["error"] == "Strava authorization expired"
+        assert not activity_store.is_fresh("703", 60)
+        assert data["athletes"]["missing"] == {"error": "Not authenticated"}
+        assert data["group"]["athletes"] == 3 and data["group"]["total_activities"] == 3
+        assert data["group"]["weekly_volume"][0]["athletes"] == 2
+        assert client.post("/training/batch", json={"states": ["coach_a"], "sport": "Swim"}).status_code == 422
+
+    def test_token_only_athletes_are_keyed_by_digest(self, client, mock_activities_response):
+        import hashlib
+        from app.services.sessions import user_sessions
+        from app.services.activity_store import activity_store
+
+        key = "token:" + hashlib.sha256(b"secret_token").hexdigest()
+        activity_store.clear(key)
+        user_sessions["token_only"] = {"authenticated": True, "access_token": "secret_token"}
+        with patch("app.services.strava.fetch_user_activities", return_value=mock_activities_response):
+            response = client.post("/training/batch", json={"states": ["token_only"]})
+
+        athlete = response.json()["athletes"]["token_only"]
+        assert athlete["athlete_id"] is None and athlete["total_activities"] == 2
+        assert "secret_token" not in response.text
+        assert activity_store.count(key) == 2 and activity_store.count("secret_token") == 0
+
+class TestCPUExecutor:
+    def test_columns_pack_to_24_bytes_per_activity(self, mock_activities_response):
+        from app.services.analysis import to_columns, pack_columns, unpack_columns
+
+        columns = to_columns(mock_activities_response)
+        packed = pack_columns(columns)
+        assert len(packed) == 2 * 24
+        assert [field.tolist() for field in unpack_columns(packed)] == [field.tolist() for field in columns]
+
+    def test_small_work_stays_inline(self):
+        import asyncio
+        from app.services.executor import CPUExecutor
+
+        executor = CPUExecutor("process", threshold=100)
+        assert asyncio.run(executor.run(sum, [1, 2, 3], size=3)) == 6
+        assert executor._pools == {}
+
+    def test_process_pool_matches_inline(self, mock_activities_response):
+        import asyncio
+        from app.services.analysis import to_columns, group_training_volume
+        from app.services.executor import CPUExecutor
+
+        columns = {"a": to_columns(mock_activities_response), "b": to_columns(mock_activities_response[:1])}
+        executor = CPUExecutor("process", max_workers=1, threshold=0)
+        try:
+            offloaded = asyncio.run(executor.run(group_training_volume, columns, size=3))
+        finally:
+            executor.shutdown()
+        assert offloaded == group_training_volume(columns)
+
+class TestBenchmarkHarness:
+    def test_synthetic_history_is_deterministic(self):
+        from benchmarks.synthetic import generate_activities
+
+        first = generate_activities(50, {"Run": 1, "Ride": 1}, days=30, end=1704067200, seed=3)
+        assert first == generate_activities(50, {"Run": 1, "Ride": 1}, days=30, end=1704067200, seed=3)
+        assert {act["type"] for act in first} == {"Run", "Ride"}
+        assert [act["start_date"] for act in first] == sorted((act["start_date"] for act in first), reverse=True)
+
+    def test_mock_strava_pages_and_rate_limits(self):
+        import asyncio
+        from benchmarks.mock_strava import MockStrava
+        from benchmarks.synthetic import generate_activities
+        from app.services import strava
+        from app.services.ratelimit import StravaRateLimiter, StravaRateLimitError
+
+        mock = MockStrava(generate_activities(450, end=1704067200), rate_limit=(100, 1000))
+        with patch.object(strava, "get_http_client", side_effect=mock.client), \
+                patch.object(strava, "strava_rate_limiter", StravaRateLimiter()):
+            assert len(asyncio.run(strava.fetch_user_activities("token", concurrency=3))) == 450
+        assert mock.throttled == 0 and mock.requests == 3
+
+        mock.rate_limit = (2, 1000)
+        mock.reset()
+        with patch.object(strava, "get_http_client", side_effect=mock.client), \
+                patch.object(strava, "strava_rate_limiter", StravaRateLimiter(stop_ratio=2, max_wait=0)):
+            with pytest.raises(StravaRateLimitError):
+                asyncio.run(strava.fetch_user_activities("token", concurrency=1))
+        # The limiter reads the mock's usage headers and gives up before Strava would answer 429
+        assert mock.requests == 2 and mock.throttled == 0
+
+class TestMetrics:
+    def test_histogram_renders_cumulative_buckets(self):
+        from app.utils.metrics import Histogram, Metric
+
+        with pytest.raises(TypeError):
+            Metric("test_untyped", "Test")
+        histogram = Histogram("test_seconds", "Test", labels=("route",), buckets=(0.1, 1.0))
+        histogram.observe(0.05, route="/a")
+        histogram.observe(0.5, route="/a")
+        histogram.observe(5, route="/a")
+        text = histogram.render()
+        assert 'test_seconds_bucket{route="/a",le="0.1"} 1' in text
+        assert 'test_seconds_bucket{route="/a",le="1"} 2' in text
+        assert 'test_seconds_bucket{route="/a",le="+Inf"} 3' in text
+        assert 'test_seconds_count{route="/a"} 3' in text
+
+    def test_named_cache_counts_hits_and_misses(self):
+        from app.utils.cache import TTLCache
+        from app.utils.metrics import CACHE_REQUESTS
+
+        cache = TTLCache(name="test")
+        cache.get("key")
+        cache.set("key", 1)
+        cache.get("key")
+        assert "key" in cache
+        assert CACHE_REQUESTS.value(cache="test", result="hit") == 1
+        assert CACHE_REQUESTS.value(cache="test", result="miss") == 1
+
+    def test_metrics_endpoint_reports_route_latency(self, client):
+        client.get("/ping")
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert 'stryde_http_request_duration_seconds_count{method="GET",route="/ping",status="200"}' in response.text
+        assert "stryde_session_store_size" in response.text
+
+    def test_timing_spans_are_opt_in(self, client):
+        from app.api.training import volume_cache
+        from app.services.sessions import user_sessions
+
+        user_sessions["timing"] = {"authenticated": True, "access_token": "token", "athlete": {"id": 77}}
+        with patch("app.api.training.sync_user_activities", return_value=0):
+            assert "Server-Timing" not in client.get("/training/volume?state=timing").headers
+            # A cached payload skips analysis, start cold so every phase runs
+            volume_cache.clear()
+            response = client.get("/training/volume?state=timing", headers={"X-Stryde-Timing": "1"})
+        timing = response.headers["Server-Timing"]
+        assert [part.split(";")[0] for part in timing.split(", ")] == ["fetch", "analyze", "plan", "total"]
+
+    def test_inference_outcome_is_recorded(self):
+        import asyncio
+        from app.services import rag
+        from app.utils.metrics import INFERENCE_LATENCY
+
+        before = INFERENCE_LATENCY.count(outcome="error")
+        with patch.object(rag, "query_huggingface", side_effect=RuntimeError("down")):
+            assert asyncio.run(rag.generate_plan(5.0, 20.0, "summary")) is None
+        assert INFERENCE_LATENCY.count(outcome="error") == before + 1
+
+class TestPlanner:
+    def test_plan_is_deterministic_and_periodized(self):
+        from benchmarks.synthetic import generate_activities
+        from app.services.planner import build_training_plan
+
+        today = 1760000000
+        activities = generate_activities(60, {"Run": 1}, days=84, end=today)
+        plan = build_training_plan(activities, "Run", today=today)
+        assert plan == build_training_plan(activities, "Run", today=today)
+        assert [week["phase"] for week in plan["weeks"]] == ["build", "build", "build", "recovery"]
+        assert plan["days"] == plan["weeks"][0]["days"]
+        assert [day["day"] for day in plan["days"]][0] == "Monday"
+        long_runs = [week["long_run_km"] for week in plan["weeks"]]
+        assert long_runs[0] < long_runs[1] < long_runs[2] and long_runs[3] < long_runs[2]
+        assert set(plan["load"]) == {"atl", "ctl", "tsb", "ramp_rate"}
+
+    def test_training_load_follows_recent_history(self):
+        import numpy as np
+        from app.services.planner import training_load
+
+        steady = training_load(np.full(84, 50.0))
+        assert steady["atl"] == steady["ctl"] == 50.0 and steady["tsb"] == 0
+        spike = training_load(np.concatenate([np.full(77, 50.0), np.full(7, 150.0)]))
+        assert spike["atl"] > spike["ctl"] and spike["tsb"] < 0 and spike["ramp_rate"] > 0
+
+    def test_fatigued_athlete_starts_with_recovery(self):
+        import time
+        from app.services.planner import build_training_plan, DAY
+
+        today = 1760000000
+        # A week of long hard days after a quiet month and a half
+        activities = [{"id": i, "type": "Run", "distance": 20000, "moving_time": 5400,
+                       "start_date": time.strftime("%Y-%m-%dT10:00:00Z", time.gmtime(today - i * DAY))}
+                      for i in range(7)]
+        plan = build_training_plan(activities, "Run", today=today)
+        assert plan["weeks"][0]["phase"] == "recovery"
+
+    def test_one_huge_run_leaves_volume_for_the_other_sessions(self):
+        from app.services.planner import build_training_plan, LONG_RUN_MAX_SHARE
+
+        today = 1760000000
+        activities = [{"id": 1, "type": "Run", "distance": 42195, "moving_time": 14400,
+                       "start_date": "2025-10-05T08:00:00Z"}]
+        plan = build_training_plan(activities, "Run", today=today)
+        for week in plan["weeks"]:
+            assert week["long_run_km"] <= round(week["distance_km"] * LONG_RUN_MAX_SHARE, 1) + 0.1
+            assert all(day["distance_km"] > 0 for day in week["days"] if day["workout"] != "Rest")
+
+    def test_pace_zones_for_runs_and_rides(self):
+        from app.services.planner import pace_zones
+
+        assert pace_zones(1000 / 240)["threshold"] == "4:13-3:55/km"
+        assert pace_zones(10.0, "Ride")["easy"] == "27-31 km/h"
+
+class TestRetrieval:
+    def test_vector_index_upserts_deletes_and_ranks(self):
+        import numpy as np
+        from app.services.retrieval import VectorIndex, embed, tokenize
+
+        index = VectorIndex(capacity=1)
+        for key, text in [("a", "easy long run"), ("b", "hard intervals"), ("c", "easy recovery run")]:
+            index.upsert(key, embed(tokenize(text)), key)
+        assert [key for _, key in index.search(embed(tokenize("easy run")), 2)] == ["a", "c"]
+        assert index.search(embed(tokenize("easy run")), 1, exclude=["a"])[0][1] == "c"
+
+        index.upsert("a", embed(tokenize("hard intervals")), "a")
+        index.delete("b")
+        assert len(index) == 2 and "b" not in index
+        assert index.search(embed(tokenize("hard intervals")), 1)[0][1] == "a"
+        assert np.allclose(embed(["token"]), embed(["token"]))
+
+    def test_index_only_reembeds_changed_weeks(self, mock_activities_response):
+        from app.services.activity_store import activity_store
+        from app.services.retrieval import TrainingIndex
+
+        index = TrainingIndex(activity_store)
+        activity_store.clear("retrieval")
+        activity_store.add("retrieval", mock_activities_response + [
+            {"id": 3, "type": "Run", "distance": 8000, "moving_time": 2400, "start_date": "2024-01-10T10:00:00Z"}
+        ])
+        history = index.update("retrieval")
+        assert sorted(history.signatures) == [19723, 19730]
+
+        activity_store.add("retrieval", [
+            {"id": 4, "type": "Run", "distance": 4000, "moving_time": 1200, "start_date": "2024-01-11T10:00:00Z"}
+        ])
+        with patch.object(index, "_embed_weeks", wraps=index._embed_weeks) as embed_weeks:
+            index.update("retrieval")
+            index.update("retrieval")
+        assert embed_weeks.call_count == 1 and embed_weeks.call_args.args[2] == [19730]
+        assert "2 runs, 12.0 km" in history.index.get(19730)["text"]
+
+        # Emptying a week changes the trend of the week after it
+        trend = history.index.get(19730)["features"]
+        activity_store.remove("retrieval", [1, 2])
+        with patch.object(index, "_embed_weeks", wraps=index._embed_weeks) as embed_weeks:
+            index.update("retrieval")
+        assert sorted(history.signatures) == [19730] and embed_weeks.call_args.args[2] == [19730]
+        assert history.index.get(19730)["features"] != trend
+
+    def test_prompt_gets_bounded_retrieved_context(self, mock_activities_response):
+        import asyncio
+        import json
+        from app.services import rag
+        from app.services.activity_store import activity_store
+        from app.services.retrieval import format_context, MAX_CONTEXT_CHARS
+
+        activity_store.clear("prompt")
+        activity_store.add("prompt", mock_activities_response)
+        rag.plan_cache.clear()
+        with patch.object(rag, "query_huggingface", return_value=json.dumps({"focus": "base"})) as query:
+            asyncio.run(rag.generate_training_recommendations(mock_activities_response, athlete_key="prompt"))
+        prompt = query.call_args.args[0]
+        assert "This week: Week of 2024-01-01: 2 runs, 15.0 km" in prompt
+        assert "Suggested workout:" in prompt
+
+        context = {"current": None, "similar_weeks": [{"text": "x" * 500}] * 10, "templates": []}
+        assert len(format_context(context)) <= MAX_CONTEXT_CHARS
+
+    def test_prompt_names_the_sessions_of_the_sport(self):
+        import asyncio
+        from app.services import rag
+
+        with patch.object(rag, "query_huggingface", side_effect=RuntimeError("down")) as query:
+            asyncio.run(rag.generate_plan(40.0, 200.0, "summary", sport="Ride"))
+        prompt = query.call_args.args[0]
+        assert "endurance rides, intervals, tempo rides, and a long ride" in prompt and " runs" not in prompt
+
+class TestTrainingLoad:
+    def test_ewma_series_matches_the_recursion(self):
+        import numpy as np
+        from app.services.timeseries import ewma_series
+
+        values = np.random.default_rng(1).uniform(0, 150, 1000)
+        expected, previous = [], 20.0
+        for value in values:
+            previous += (value - previous) / 42
+            expected.append(previous)
+        assert np.allclose(ewma_series(values, 42, initial=20.0), expected)
+
+    def test_incremental_updates_match_a_rebuild(self):
+        import numpy as np
+        from benchmarks.synthetic import generate_activities
+        from app.services.activity_store import activity_store
+        from app.services.timeseries import TimeSeriesStore, SECONDS_PER_DAY
+
+        end = 1760000000
+        today = end // SECONDS_PER_DAY
+        activities = generate_activities(400, {"Run": 1}, days=730, end=end)
+        activities.sort(key=lambda activity: activity["start_date"])
+        activity_store.clear("series")
+        activity_store.add("series", activities[:-5])
+        store = TimeSeriesStore(activity_store)
+        # The threshold is re-estimated on a rebuild, pin it to compare the series alone
+        with patch("app.services.timeseries.threshold_speed", return_value=3.5):
+            store.get("series", "Run", today)
+            activity_store.add("series", activities[-5:])
+            with patch.object(store, "_build", wraps=store._build) as build:
+                series = store.get("series", "Run", today)
+            assert build.call_count == 0
+            rebuilt = TimeSeriesStore(activity_store).get("series", "Run", today)
+            for name in ("distance", "load", "atl", "ctl"):
+                assert np.allclose(getattr(series, name), getattr(rebuilt, name))
+            assert series.bests == rebuilt.bests
+
+            # Removing the longest run brings the next longest back
+            longest = max(activities, key=lambda activity: activity["distance"])
+            activity_store.remove("series", [longest["id"]])
+            series = store.get("series", "Run", today)
+            assert series.bests == TimeSeriesStore(activity_store).get("series", "Run", today).bests
+            assert -series.bests["Longest"][0] < longest["distance"]
+
+    def test_edited_moving_time_updates_the_load(self, mock_activities_response):
+        import numpy as np
+        from app.services.activity_store import activity_store
+        from app.services.timeseries import TimeSeriesStore, epoch_day_of
+
+        today = epoch_day_of("2024-01-14")
+        activity_store.clear("edited")
+        activity_store.add("edited", mock_activities_response)
+        store = TimeSeriesStore(activity_store)
+        with patch("app.services.timeseries.threshold_speed", return_value=3.5):
+            before = store.get("edited", "Run", today).load.copy()
+            activity_store.add("edited", [dict(mock_activities_response[0], moving_time=3000)])
+            series = store.get("edited", "Run", today)
+            rebuilt = TimeSeriesStore(activity_store).get("edited", "Run", today)
+        assert not np.allclose(series.load, before)
+        assert np.allclose(series.load, rebuilt.load) and np.allclose(series.ctl, rebuilt.ctl)
+
+    def test_edit_on_the_newest_day_rebuilds_the_bests(self, mock_activities_response):
+        from app.services.activity_store import activity_store
+        from app.services.timeseries import TimeSeriesStore, epoch_day_of
+
+        today = epoch_day_of("2024-01-14")
+        activity_store.clear("edited_last")
+        activity_store.add("edited_last", mock_activities_response)
+        store = TimeSeriesStore(activity_store)
+        with patch("app.services.timeseries.threshold_speed", return_value=3.5):
+            assert -store.get("edited_last", "Run", today).bests["Longest"][0] == 10000
+            activity_store.add("edited_last", [dict(mock_activities_response[1], distance=3000)])
+            series = store.get("edited_last", "Run", today)
+        assert -series.bests["Longest"][0] == 5000
+
+    def test_series_and_planner_share_one_load_definition(self):
+        from benchmarks.synthetic import generate_activities
+        from app.services.activity_store import activity_store
+        from app.services.planner import training_load
+        from app.services.timeseries import TimeSeriesStore, SECONDS_PER_DAY
+
+        end = 1760000000
+        activities = generate_activities(200, {"Run": 1}, days=365, end=end)
+        activity_store.clear("shared_load")
+        activity_store.add("shared_load", activities[:-20])
+        store = TimeSeriesStore(activity_store)
+        store.get("shared_load", "Run", end // SECONDS_PER_DAY - 30)
+        activity_store.add("shared_load", activities[-20:])
+        series = store.get("shared_load", "Run", end // SECONDS_PER_DAY)
+        assert series.training_load() == training_load(series.load)
+
+    def test_load_endpoint_by_day_and_week(self, client, mock_activities_response):
+        from app.services.activity_store import activity_store
+        from app.services.sessions import user_sessions
+
+        activity_store.clear("81")
+        activity_store.add("81", mock_activities_response)
+        user_sessions["load"] = {"authenticated": True, "access_token": "token", "athlete": {"id": 81}}
+        with patch("app.api.training.sync_user_activities", return_value=0):
+            daily = client.get("/training/load?state=load&start=2024-01-01&end=2024-01-14")
+            weekly = client.get("/training/load?state=load&start=2024-01-01&end=2024-01-14&resolution=week")
+            backwards = client.get("/training/load?state=load&start=2024-01-14&end=2024-01-01")
+            cached = client.get("/training/load?state=load&start=2024-01-01&end=2024-01-14",
+                                headers={"If-None-Match": daily.headers["ETag"]})
+        assert daily.status_code == 200
+        series = daily.json()["series"]
+        assert len(series["date"]) == 14 and series["distance_km"][:2] == [5.0, 10.0]
+        assert series["distance_7d_km"][6] == 15.0 and series["pace_28d_min_km"][1] == 6.0
+        weekly = weekly.json()["series"]
+        assert weekly["date"] == ["2024-01-01", "2024-01-08"] and weekly["distance_km"] == [15.0, 0.0]
+        assert weekly["ctl"][0] == series["ctl"][6]
+        assert series["ctl"][0] == series["load"][0]
+        assert [best["name"] for best in daily.json()["personal_bests"]] == ["5K", "10K", "Longest"]
+        assert backwards.status_code == 400
+        assert cached.status_code == 304
+
+class TestActivityStreams:
+    @staticmethod
+    def steady_streams(seconds: int = 500, speed: float = 4.0, heartrate: int = 150):
+        return {"time": list(range(seconds + 1)), "distance": [speed * t for t in range(seconds + 1)],
+                "heartrate": [heartrate] * (seconds + 1), "velocity_smooth": [speed] * (seconds + 1)}
+
+    def test_store_round_trips_narrow_columns(self, tmp_path):
+        import os
+        import numpy as np
+        from app.services.streams import StreamStore
+
+        store = StreamStore(str(tmp_path))
+        streams = self.steady_streams()
+        streams["velocity_smooth"][10] = 3.217
+        store.put("athlete", 1, streams)
+        store.put("athlete", 2, {})
+        assert store.missing("athlete", [1, 2, 3]) == [3]
+
+        stored = store.get("athlete", 1)
+        assert np.allclose(stored["distance"], streams["distance"])
+        assert stored["velocity_smooth"][10] == 3.217 and stored["heartrate"].dtype == np.float64
+        # 11 bytes per sample instead of 32 for four float64 columns
+        assert os.path.getsize(store._path("athlete", 1)) < 501 * 12
+        assert store.get("athlete", 2) == {} and store.get("athlete", 3) is None
+
+        store.clear("athlete")
+        assert store.missing("athlete", [1, 2]) == [1, 2]
+
+    def test_splits_and_zones(self):
+        import numpy as np
+        from app.services.streams import analyze_activity_streams
+
+        streams = {key: np.asarray(values, dtype=np.float64) for key, values in self.steady_streams().items()}
+        analysis = analyze_activity_streams(streams, "Run", threshold=4.0, max_hr=200)
+        assert [(split["distance_km"], split["time"], split["pace"]) for split in analysis["splits"]] == [
+            (1.0, 250, "4:10/km"), (1.0, 250, "4:10/km")]
+        assert analysis["splits"][0]["average_heartrate"] == 150
+        zones = {zone["zone"]: zone["seconds"] for zone in analysis["heart_rate_zones"]}
+        assert zones["Z3 tempo"] == 500 and sum(zones.values()) == 500
+        assert {zone["zone"]: zone["share"] for zone in analysis["pace_zones"]}["threshold"] == 1.0
+
+        # A long pause is not moving time, nor is the one sample spanning it
+        streams["time"][250:] += 600
+        assert sum(split["time"] for split in analyze_activity_streams(streams, "Run", 4.0, 200)["splits"]) == 499
+
+    def test_streams_are_fetched_concurrently_once(self):
+        import asyncio
+        from app.services import strava
+        from app.services.streams import stream_store
+
+        in_flight, peak, calls = 0, 0, []
+
+        async def fake_fetch(token, activity_id):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            calls.append(activity_id)
+            return {} if activity_id == 5 else self.steady_streams(60)
+
+        stream_store.clear("concurrent")
+        with patch.object(strava, "fetch_activity_streams", side_effect=fake_fetch):
+            assert asyncio.run(strava.sync_activity_streams("token", "concurrent", range(1, 9), concurrency=4)) == {}
+            assert asyncio.run(strava.sync_activity_streams("token", "concurrent", range(1, 9))) == {}
+        assert sorted(calls) == list(range(1, 9)) and peak == 4
+        assert stream_store.get("concurrent", 5) == {}
+
+    def test_activity_analysis_endpoint(self, client, mock_activities_response):
+        import asyncio
+        from app.services.activity_store import activity_store
+        from app.services.sessions import user_sessions, athlete_session_key
+        from app.services.streams import stream_store
+        from app.services.webhooks import process_event
+
+        activity_store.clear("82")
+        stream_store.clear("82")
+        activity_store.add("82", mock_activities_response)
+        user_sessions["streams"] = {"authenticated": True, "access_token": "token", "athlete": {"id": 82}}
+        with patch("app.api.training.sync_user_activities", return_value=0), \
+                patch("app.services.strava.fetch_activity_streams", return_value=self.steady_streams()) as fetch:
+            response = client.get("/training/activities/2/analysis?state=streams&max_hr=200")
+            client.get("/training/activities/2/analysis?state=streams&split=500")
+            missing = client.get("/training/activities/99/analysis?state=streams")
+        assert response.status_code == 200 and fetch.call_count == 1
+        assert response.json()["sport"] == "Run" and len(response.json()["splits"]) == 2
+        assert missing.status_code == 404
+
+        user_sessions[athlete_session_key(82)] = user_sessions["streams"]
+        with patch("app.services.webhooks.fetch_activity", return_value=None):
+            asyncio.run(process_event({"object_type": "activity", "aspect_type": "delete", "owner_id": 82,
+                                       "object_id": 2}))
+        assert stream_store.get("82", 2) is None
+
+    def test_failed_stream_fetch_status_follows_the_error_type(self, client, mock_activities_response):
+        from app.services.activity_store import activity_store
+        from app.services.ratelimit import StravaRateLimitError
+        from app.services.sessions import user_sessions
+        from app.services.strava import StravaAPIError
+        from app.services.streams import stream_store
+
+        activity_store.clear("84")
+        stream_store.clear("84")
+        activity_store.add("84", mock_activities_response)
+        user_sessions["stream_errors"] = {"authenticated": True, "access_token": "token", "athlete": {"id": 84}}
+        url = "/training/activities/2/analysis?state=stream_errors"
+        with patch("app.api.training.sync_user_activities", return_value=0):
+            with patch("app.services.strava.fetch_activity_streams", side_effect=StravaRateLimitError("slow down")):
+                assert client.get(url).status_code == 429
+            with patch("app.services.strava.fetch_activity_streams", side_effect=StravaAPIError(500, "rate limit")):
+                assert client.get(url).status_code == 502
+
+    def test_zones_fetch_a_few_streams_and_fill_the_rest_in_the_background(self, client):
+        import asyncio
+        from benchmarks.synthetic import generate_activities
+        from app.services.activity_store import activity_store
+        from app.services.sessions import user_sessions
+        from app.services.streams import stream_store
+        from app.services.strava import filling_streams
+
+        activities = generate_activities(12, {"Run": 1}, days=20)
+        activity_store.clear("83")
+        stream_store.clear("83")
+        activity_store.add("83", activities)
+        user_sessions["zones"] = {"authenticated": True, "access_token": "token", "athlete": {"id": 83}}
+        newest = sorted(activities, key=lambda activity: activity["start_date"], reverse=True)
+        with patch.dict("os.environ", {"STRYDE_STRAVA_STREAM_FETCHES": "5"}), \
+                patch("app.api.training.sync_user_activities", return_value=0), \
+                patch("app.api.training.stream_jobs") as jobs, \
+                patch("app.services.strava.fetch_activity_streams", return_value=self.steady_streams()) as fetch:
+            response = client.get("/training/zones?state=zones&days=28").json()
+            assert fetch.call_count == 5
+            assert sorted(call.args[1] for call in fetch.call_args_list) == \
+                sorted(activity["id"] for activity in newest[:5])
+            assert response["activities"] == 12 and response["analyzed"] == 5 and response["pending"] == 7
+
+            # Streams the background fill took on are neither fetched inline nor queued again
+            again = client.get("/training/zones?state=zones&days=28").json()
+            assert fetch.call_count == 5 and jobs.submit.call_count == 1 and again["pending"] == 7
+
+            fill = jobs.submit.call_args.args[0]
+            assert asyncio.run(fill()) == {}
+        assert stream_store.missing("83", [activity["id"] for activity in activities]) == []
+        assert filling_streams("83") == set()
+
+class TestStartup:
+    def test_heavy_modules_load_on_first_use(self):
+        import os
+        import subprocess
+        import sys
+
+        probe = "import sys, main; print(sorted(m for m in ('httpx', 'jose', 'openai') if m in sys.modules))"
+        result = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        assert result.stdout.strip() == "[]"
+
+    def test_warmup_creates_pooled_clients(self, client):
+        from app.services import http
+
+        response = client.get("/warmup")
+        assert response.status_code == 200
+        assert set(response.json()["warmed"]) == {"http_client", "token_vault"}
+        assert http._client is not None
+
+    def test_importtime_is_attributed_per_package(self):
+        from benchmarks.startup import by_package, parse_importtime
+
+        stderr = ("import time: self [us] | cumulative | imported package\n"
+                  "import time:       120 |        120 |     httpx._types\n"
+                  "import time:       300 |        420 |   httpx\n"
+                  "import time:        80 |        500 | app.services.http\n")
+        modules = parse_importtime(stderr)
+        assert modules["httpx"] == (300, 420)
+        assert by_package(modules) == {"httpx": 420, "app.services.http": 80}
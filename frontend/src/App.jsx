@@ -49,6 +49,24 @@ function App() {
     }
   }
 
+  const pollTrainingPlan = async (jobUrl) => {
+    // The enriched plan is generated in the background, long-poll until it replaces the local one
+    for (let attempt = 0; attempt < 5; attempt++) {
+      try {
+        const response = await fetch(`${API_URL}${jobUrl}?wait=25`)
+        if (!response.ok) return
+        const job = await response.json()
+        if (job.calendar) {
+          setFitnessData((current) => current && { ...current, calendar: job.calendar })
+          return
+        }
+      } catch (error) {
+        console.error('Error fetching training plan:', error)
+        return
+      }
+    }
+  }
+
   const fetchTrainingVolume = async (state, accessToken) => {
     if (!state) return
     setFitnessLoading(true)
@@ -63,6 +81,9 @@ function App() {
           console.log('🔍 DEBUG: Training data received:', trainingData)
           console.log('🔍 DEBUG: Calendar data:', trainingData.calendar)
           setFitnessData(trainingData)
+          if (trainingData.calendar_job) {
+            pollTrainingPlan(trainingData.calendar_job.url)
+          }
         } else {
           console.error('❌ DEBUG: Failed to fetch training data:', response.status, response.statusText)
         }